@@ -15,11 +15,14 @@ import sys
 import os
 
 from biomaj.options import Options
+from biomajmanager.fleet import FleetSnapshot
+from biomajmanager.inventory import LinkInventory
 from biomajmanager.manager import Manager
 from biomajmanager.writer import Writer
 from biomajmanager.news import News, RSS
+from biomajmanager.scanner import LinkCleaner
 from biomajmanager.utils import Utils
-from biomajmanager.links import Links
+from biomajmanager.links import Links, LinkPlan
 from tabulate import tabulate
 __author__ = 'Emmanuel Quevillon'
 
@@ -35,6 +38,8 @@ def main():
                              'keep.old.version']. [-b available]")
     parser.add_argument('-D', '--save_versions', dest="save_versions", action="store_true", default=False,
                         help="Prints info about all banks into version file. (Requires permissions)")
+    parser.add_argument('--ensure_indexes', dest="ensure_indexes", action="store_true", default=False,
+                        help="Create database indexes needed by the manager and check queries use them.")
     parser.add_argument('-H', '--history', dest="history", action="store_true", default=False,
                         help="Prints banks releases history. [-b] available.")
     parser.add_argument('-i', '--info', dest="info", action="store_true", default=False,
@@ -45,10 +50,22 @@ def main():
                         help="Check if the bank required symlinks to be created (Permissions required). [-b REQUIRED]")
     parser.add_argument('-l', '--links', dest="links", action="store_true", default=False,
                         help="Just (re)create symlink, don't do any bank switch. (Permissions required). [-b REQUIRED]")
+    parser.add_argument('--rebuild_inventory', dest="rebuild_inventory", action="store_true", default=False,
+                        help="Rebuild the links inventory (cache.dir) from the links found in production directory.")
+    parser.add_argument('--reconcile', dest="reconcile", action="store_true", default=False,
+                        help="With --links, only create new links and remove stale ones, using the bank links \
+                             manifest.")
+    parser.add_argument('--rollback_links', dest="rollback_links", action="store_true", default=False,
+                        help="Publish back the bank links tree published before the last switch. \
+                             (Permissions required). [-b REQUIRED]")
     parser.add_argument('-L', '--bank_formats', dest="bank_formats", action="store_true", default=False,
                         help="List supported formats and index for each banks. [-b] available.")
     parser.add_argument('-M', '--to_mongo', dest="to_mongo", action="store_true", default=False,
                         help="[PLUGIN] Load bank(s) history into mongo database (bioweb). [-b and --db_type REQUIRED]")
+    parser.add_argument('--incremental', dest="incremental", action="store_true", default=False,
+                        help="With --to_mongo, only send new or changed history documents.")
+    parser.add_argument('--prune', dest="prune", action="store_true", default=False,
+                        help="With --to_mongo, remove documents not found in bank history anymore.")
     parser.add_argument('-N', '--news', dest="news", action="store_true", default=False,
                         help="Create news to display at BiomajWatcher. [Default output txt]")
     parser.add_argument('-n', '--simulate', dest="simulate", action="store_true", default=False,
@@ -58,7 +75,7 @@ def main():
     parser.add_argument('-R', '--rss', dest="rss", action="store_true", default=False,
                         help="Create RSS feed. [-o available]")
     parser.add_argument('-s', '--switch', dest="switch", action="store_true", default=False,
-                        help="Switch a bank to its new version. [-b REQUIRED]")
+                        help="Switch a bank to its new version. (Permissions required). [-b REQUIRED]")
     parser.add_argument('-X', '--synchronize_db', dest="synchronizedb", action="store_true", default=False,
                         help="Synchronize database and bank data on disk")
     parser.add_argument('-U', '--show_update', dest="show_update", action="store_true", default=False,
@@ -82,7 +99,7 @@ def main():
                         help="Check for broken symlinks in production directory.")
     parser.add_argument('-C', '--clean_links', dest="cleanlinks", metavar="path to clean", type=str,
                         const=True, nargs='?',
-                        help="Remove old/broken links (Permissions required)")
+                        help="Remove old/broken links (Permissions required), use --simulate for a dry run")
     parser.add_argument('-c', '--config', dest="config",
                         help="BioMAJ global.properties configuration file")
     parser.add_argument('--db_type', dest="db_type",
@@ -90,6 +107,8 @@ def main():
     parser.add_argument('-E', '--failed-process', dest="failedprocess", metavar='session id', type=float,
                         const=True, nargs='?',
                         help="Get failed process(es) for a bank. Session id can be used. [-b REQUIRED]")
+    parser.add_argument('--link_plan', dest="link_plan", metavar="plan file",
+                        help="Link plan file, saved by --check_links and applied by --links. [-b REQUIRED]")
     parser.add_argument('-o', '--out', dest="out",
                         help="Output file")
     parser.add_argument('-F', '--format', dest="oformat",
@@ -119,21 +138,19 @@ def main():
 
     if options.bank_formats:
         formats = []
-        banks = []
         Utils.start_timer()
         manager = Manager(global_cfg=options.config)
+        # Banks formats are read once into the formats catalog, used for both header and rows
+        banks = FleetSnapshot(fields=['name'])
         supp_formats= ['raw']
-        supp_formats += manager.formats_available()
+        supp_formats += manager.formats_available(banks=banks)
         if options.bank:
-            banks.append(options.bank)
-        else:
-            banks = Manager.get_bank_list()
-        for bank in banks:
-            manager.set_bank_from_name(name=bank)
-            dbformats = manager.formats_as_string()
-            dbformats['raw'] = manager.bank.config.get('db.formats')
-            formats.append({'name': bank, 'formats': dbformats,
-                            'fullname': manager.bank.config.get('db.fullname').replace('"', '')})
+            banks = FleetSnapshot(banks=[options.bank], fields=['name'])
+        catalog = manager.get_format_catalog(banks=banks.get_names())
+        for entry in catalog.get_matrix(banks=banks.get_names()):
+            dbformats = dict(entry['formats'])
+            dbformats['raw'] = entry['raw']
+            formats.append({'name': entry['name'], 'formats': dbformats, 'fullname': entry['fullname']})
 
         if options.oformat:
             writer = Writer(config=manager.config, output=options.out, template_dir=options.template_dir)
@@ -163,12 +180,15 @@ def main():
         sys.exit(0)
 
     if options.brokenlinks:
+        Utils.start_timer()
         brokenlinks = options.brokenlinks
+        workers = None
         if type(brokenlinks) == bool:
             manager = Manager(global_cfg=options.config)
-            options.brokenlinks = os.path.join(manager.get_production_dir(), 'index')
-        brkln = Utils.get_broken_links(path=brokenlinks)
-        print("%d broken link(s)" % brkln)
+            brokenlinks = os.path.join(manager.get_production_dir(), 'index')
+            workers = manager.get_workers()
+        brkln = Utils.get_broken_links(path=brokenlinks, workers=workers)
+        print("%d broken link(s) (%f sec)" % (brkln, Utils.elapsed_time()))
         sys.exit(0)
 
     if options.check_links:
@@ -176,7 +196,7 @@ def main():
             Utils.error("A bank name is required")
         manager = Manager(bank=options.bank, global_cfg=options.config)
         linker = Links(manager=manager)
-        if linker.check_links():
+        if linker.check_links(save=options.link_plan):
             print("[%s] %d link(s) need to be created" % (options.bank, linker.created_links))
         else:
             print("[%s] All links OK" % options.bank)
@@ -187,10 +207,15 @@ def main():
         manager = Manager(global_cfg=options.config)
         cleanlinks = options.cleanlinks
         if type(cleanlinks) == bool:
-            for key in Links.DIRS.iterkeys():
-                for ddir in Links.DIRS[key]:
-                    path = os.path.join(manager.get_production_dir(), ddir['target'])
-                    Utils.clean_symlinks(path=path, delete=True)
+            cleaner = LinkCleaner(manager.get_production_dir(), workers=manager.get_workers(),
+                                  dry_run=Manager.get_simulate())
+            counts = cleaner.clean(Links.get_target_dirs())
+            for tool in sorted(counts):
+                Utils.ok("[%s] %d link(s) %s" % (tool, counts[tool], 'to remove' if cleaner.dry_run else 'removed'))
+                if Manager.get_verbose():
+                    for link in cleaner.links[tool]:
+                        Utils.uprint("\t%s" % link)
+            print("%d link(s) %s" % (sum(counts.values()), 'to remove' if cleaner.dry_run else 'removed'))
         else:
             Utils.clean_symlinks(path=cleanlinks, delete=True)
         Utils.stop_timer()
@@ -222,17 +247,12 @@ def main():
         sys.exit(0)
 
     if options.history:
-        bank_list = []
         history = []
-        if not options.bank:
-            bank_list = Manager.get_bank_list()
-        else:
-            bank_list.append(options.bank)
-
         Utils.start_timer()
-        for bank in bank_list:
-            manager = Manager(bank=bank, global_cfg=options.config)
-            history.append({'name': bank, 'history': manager.history()})
+        manager = Manager(global_cfg=options.config)
+        for bank in FleetSnapshot(banks=[options.bank] if options.bank else None):
+            manager.set_bank(bank=bank)
+            history.append({'name': bank.name, 'history': manager.history()})
         if options.oformat:
             if options.oformat == 'json':
                 print(json.dumps([h for hist in history for h in hist]))
@@ -280,9 +300,16 @@ def main():
         Utils.start_timer()
         manager = Manager(bank=options.bank, global_cfg=options.config)
         linker = Links(manager=manager)
-        linker.do_links()
+        if options.link_plan:
+            linker.do_links(plan=LinkPlan.load(options.link_plan))
+        elif options.reconcile:
+            linker.reconcile()
+        else:
+            linker.do_links()
         etime = Utils.elapsed_time()
         print("[%s] %d link(s) created (%f sec)" % (options.bank, linker.created_links, etime))
+        if options.reconcile:
+            print("[%s] %d stale link(s) removed" % (options.bank, linker.removed_links))
         sys.exit(0)
 
     if options.news:
@@ -306,14 +333,12 @@ def main():
         sys.exit(0)
 
     if options.pending:
-        bank_list = []
-        if not options.bank:
-            bank_list = Manager.get_bank_list()
-        else:
-            bank_list.append(options.bank)
         info = []
-        for bank in bank_list:
-            manager = Manager(bank=bank, global_cfg=options.config)
+        manager = Manager(global_cfg=options.config)
+        banks = FleetSnapshot(banks=[options.bank] if options.bank else None,
+                              fields=['name', 'pending', 'sessions.id', 'sessions.last_update_time'])
+        for bank in banks:
+            manager.set_bank(bank=bank)
             pending = manager.get_pending_sessions()
             if pending:
                 if options.oformat:
@@ -321,20 +346,19 @@ def main():
                     writer.write(template='pending.j2.' + options.oformat, data={'pending': pending})
                 else:
                     seen = {}
-                    for pend in pending:
+                    for pend in manager.get_pending_sessions_last_run():
                         release = pend['release']
                         sess_id = pend['id']
                         # As for now we have pending as many time as they are run
                         if sess_id in seen:
                             continue
-                        last_run = manager.get_session_from_id(sess_id)
+                        last_run = pend['last_update_time']
                         if last_run is not None:
-                            last_run = Utils.time2datefmt(last_run['last_update_time'], Utils.DATE_FMT)
+                            last_run = Utils.time2datefmt(last_run, Utils.DATE_FMT)
                         else:
                             last_run = "N/A"
-                        info.append([bank, sess_id, str(release), str(last_run)])
+                        info.append([bank.name, sess_id, str(release), str(last_run)])
                         seen[sess_id] = True
-            manager.set_bank_from_name(name=bank)
         if info:
             info.insert(0, ["Bank", "Session", "Release", "Last Run"])
             print("Pending banks:")
@@ -345,20 +369,12 @@ def main():
 
     if options.prodrelease:
         # Search for bank having production release entries greater than limit. Default to 'keep.old.version'
-        banks = []
-        if options.bank:
-            banks.append(options.bank)
-        else:
-            banks = Manager.get_bank_list()
-        info = []
         max_release = options.prodrelease
         if type(max_release) == bool:
             max_release = None
-        for bank in banks:
-            manager = Manager(bank=bank, global_cfg=options.config)
-            exceed = manager.check_production_size(max_release=max_release)
-            if len(exceed):
-                info.append(exceed)
+        manager = Manager(global_cfg=options.config)
+        info = manager.check_production_sizes(max_release=max_release,
+                                              banks=[options.bank] if options.bank else None)
         if info:
             print("%d banks have exceeded production release limit" % int(len(info)))
             info.insert(0, ["Bank", "Production release", "Limit"])
@@ -372,6 +388,12 @@ def main():
         rss.generate_rss(rss_file=options.out)
         sys.exit(0)
 
+    if options.ensure_indexes:
+        manager = Manager(global_cfg=options.config)
+        if not manager.ensure_indexes():
+            Utils.warn("Some queries do not use any index")
+        sys.exit(0)
+
     if options.save_versions:
         manager = Manager(global_cfg=options.config)
         manager.save_banks_version()
@@ -402,21 +424,50 @@ def main():
             print("No bank need to be updated")
         sys.exit(0)
 
+    if options.rebuild_inventory:
+        Utils.start_timer()
+        manager = Manager(global_cfg=options.config)
+        inventory = LinkInventory()
+        if inventory.path is None:
+            Utils.error("'cache.dir' not set or does not exist, no links inventory available")
+        count = inventory.rebuild(manager.get_production_dir(), manager.config.get('GENERAL', 'data.dir'))
+        print("%d link(s) recorded into %s (%f sec)" % (count, inventory.path, Utils.elapsed_time()))
+        sys.exit(0)
+
+    if options.rollback_links:
+        if not options.bank:
+            Utils.error("A bank name is required")
+        manager = Manager(bank=options.bank, global_cfg=options.config)
+        linker = Links(manager=manager)
+        Utils.ok("[%s] Stopping running jobs ..." % manager.bank.name)
+        manager.stop_running_jobs(args=[manager.get_bank_data_dir()])
+        linker.rollback()
+        Utils.ok("[%s] Restarting stopped jobs ..." % manager.bank.name)
+        manager.restart_stopped_jobs()
+        print("[%s] Links rolled back, %d link(s) created, %d link(s) removed" %
+              (options.bank, linker.created_links, linker.removed_links))
+        sys.exit(0)
+
     if options.switch:
         if not options.bank:
             Utils.error("A bank name is required")
         manager = Manager(bank=options.bank, global_cfg=options.config)
         if manager.can_switch():
             Utils.ok("[%s] Ready to switch" % manager.bank.name)
+            last_prod_ok = manager.get_last_production_ok()
+            # Links of the new release are built aside, only their publication needs the jobs to be stopped
+            Utils.ok("[%s] Staging links ..." % manager.bank.name)
+            linker = Links(manager=manager)
+            tree = linker.stage(last_prod_ok)
             Utils.ok("[%s] Publishing ..." % manager.bank.name)
             Utils.ok("[%s] Stopping running jobs ..." % manager.bank.name)
             manager.stop_running_jobs(args=[manager.get_bank_data_dir()])
             # Inspired from biomaj-cli.py
             manager.bank.load_session()
-            last_prod_ok = manager.get_last_production_ok()
             session = manager.get_session_from_id(last_prod_ok['session'])
             manager.bank.session._session = session
             manager.bank.publish()
+            linker.publish(tree)
             Utils.ok("[%s] Restarting stopped jobs ..." % manager.bank.name)
             manager.restart_stopped_jobs()
             Utils.ok("[%s] Bank published!" % manager.bank.name)
@@ -433,20 +484,30 @@ def main():
     if options.to_mongo:
         if not options.db_type:
             Utils.error("--db_type required")
-        bank_list = []
-        if not options.bank:
-            bank_list = Manager.get_bank_list()
+        if options.db_type.lower() not in ['mongodb', 'mysql']:
+            Utils.error("%s not supported. Only mysql or mongodb" % options.db_type)
+        manager = Manager(global_cfg=options.config)
+        manager.load_plugins()
+        fleet = FleetSnapshot(banks=[options.bank] if options.bank else None)
+        if options.db_type.lower() == 'mongodb':
+            def histories():
+                for bank in fleet:
+                    manager.set_bank(bank=bank)
+                    yield bank.name, manager.history()
+            Utils.start_timer()
+            report = manager.plugins.bioweb.export_fleet(histories(), incremental=options.incremental,
+                                                         prune=options.prune)
+            Utils.stop_timer()
+            print("%d bank(s), %d document(s) sent, %d removed (%f sec)" %
+                  (len(report), sum([bank['sent'] for bank in report]), sum([bank['removed'] for bank in report]),
+                   Utils.elapsed_time()))
+            failed = [bank['bank'] for bank in report if bank['errors']]
+            if failed:
+                Utils.error("Can't update bioweb.catalog for bank(s) %s" % ', '.join(failed))
         else:
-            bank_list.append(options.bank)
-        for bank in bank_list:
-            manager = Manager(bank=bank, global_cfg=options.config)
-            manager.load_plugins()
-            if options.db_type.lower() == 'mongodb':
-                manager.plugins.bioweb.update_bioweb()
-            elif options.db_type.lower() == 'mysql':
+            for bank in fleet:
+                manager.set_bank(bank=bank)
                 manager.plugins.bioweb.update_bioweb_from_mysql()
-            else:
-                Utils.error("%s not supported. Only mysql or mongodb" % options.db_type)
         sys.exit(0)
 
     if options.tool:
@@ -468,19 +529,17 @@ def main():
         sys.exit(0)
 
     if options.vdbs:
-        banks_list = []
-        if options.bank:
-            banks_list.append(options.bank)
-        else:
-            banks_list = Manager.get_bank_list()
         virtual_banks = {}
         Utils.start_timer()
-        for bank in banks_list:
-            manager = Manager(bank=bank, global_cfg=options.config)
+        manager = Manager(global_cfg=options.config)
+        banks = FleetSnapshot(banks=[options.bank] if options.bank else None,
+                              fields=['name', 'current', 'sessions.id', 'sessions.release', 'sessions.remoterelease'])
+        for bank in banks:
+            manager.set_bank(bank=bank)
             info = manager.get_bank_sections(tool=options.vdbs)
             info['info'] = {'version': manager.current_release(),
                             'description': manager.bank.config.get('db.fullname')}
-            virtual_banks[bank] = info
+            virtual_banks[bank.name] = info
         if virtual_banks.items():
             writer = Writer(template_dir=options.template_dir, config=manager.config, output=options.out)
             writer.write(template='virtual_banks.j2.html',
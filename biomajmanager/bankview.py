@@ -0,0 +1,431 @@
+"""Read only views of banks, fetching from the database only the fields needed"""
+from biomaj.mongo_connector import MongoConnector
+from biomaj_core.config import BiomajConfig
+from biomajmanager.config import ConfigCache
+from biomajmanager.utils import Utils
+import getpass
+import os
+
+__author__ = 'tuco'
+
+
+class BankView(object):
+
+    """
+    Read only view of a bank, can be used in place of :class:`biomaj.bank.Bank` by the Manager
+
+    Only the fields requested with :py:func:`fetch` are retrieved from the database, using Mongo projections.
+    Accessing a field of the document that has not been fetched loads the complete bank document. Accessing a
+    field only partially fetched (sub fields or projection operator) fetches the complete field, unless the
+    partial field has been declared by the running method (see :py:func:`push_fields`).
+    """
+
+    # Marker for a field not fetched yet
+    _MISSING = object()
+
+    def __init__(self, name, document=None, fields=None):
+        """
+        Create the bank view
+
+        :param name: Bank name
+        :type name: str
+        :param document: Bank document already fetched from the database
+        :type document: dict
+        :param fields: List of fields used to fetch 'document'. If None, 'document' is considered complete
+        :type fields: list
+        :raises SystemExit: If cannot connect to the database
+        """
+        self.name = name
+        self.banks = BankView.get_collection()
+        self._config = None
+        # Fetched fields, top level field name as key and projection as value:
+        # None for the complete field, set of sub fields or projection operator ($slice, $elemMatch)
+        self._specs = {}
+        # Complete document loaded
+        self._loaded = False
+        # Sessions fetched with $elemMatch, keyed by session id
+        self._sessions = {}
+        # Stack of top level fields declared by the running methods, partial fields of the last one are trusted
+        self._declared = []
+        self._document = BankDocument(self)
+        dict.__setitem__(self._document, 'name', name)
+        if document is not None:
+            dict.update(self._document, document)
+            if fields is None:
+                self._loaded = True
+            else:
+                for field in fields:
+                    top, spec = BankView._parse_field(field)
+                    self._specs[top] = BankView._merge_specs(self._specs.get(top, BankView._MISSING), spec)
+
+    @property
+    def bank(self):
+        """
+        Bank document, fields not fetched are loaded on first access
+
+        :return: Bank document
+        :rtype: :class:`biomajmanager.bankview.BankDocument`
+        """
+        return self._document
+
+    @property
+    def config(self):
+        """
+        Bank configuration, loaded on first access and shared with other views of the bank
+
+        :return: Bank configuration
+        :rtype: :class:`biomaj_core.config.BiomajConfig`
+        :raises SystemExit: If bank configuration cannot be loaded
+        """
+        if self._config is None:
+            try:
+                self._config = ConfigCache.get_bank_config(self.name)
+            except Exception as err:
+                Utils.error("Can't load configuration for bank %s: %s" % (self.name, str(err)))
+        return self._config
+
+    @staticmethod
+    def get_collection():
+        """
+        Get the 'banks' collection, connecting to the database if needed
+
+        :return: MongoDB banks collection
+        :rtype: :class:`pymongo.collection.Collection`
+        :raises SystemExit: If biomaj configuration cannot be loaded
+        """
+        if BiomajConfig.global_config is None:
+            try:
+                BiomajConfig.load_config()
+            except Exception as err:
+                Utils.error("Problem loading biomaj configuration: %s" % str(err))
+        if MongoConnector.db is None:
+            MongoConnector(BiomajConfig.global_config.get('GENERAL', 'db.url'),
+                           BiomajConfig.global_config.get('GENERAL', 'db.name'))
+        return MongoConnector.banks
+
+    def fetch(self, fields):
+        """
+        Fetch fields from the database, only the ones not already fetched are requested
+
+        A field is either a field name ('current'), a dotted sub field ('production.session') or a tuple
+        (field, projection operator) like ('production', {'$slice': -1}). If a field is requested with a
+        projection which does not match the one it has been fetched with, the complete field is fetched.
+
+        :param fields: List of fields to fetch
+        :type fields: list
+        :return: Bank document
+        :rtype: :class:`biomajmanager.bankview.BankDocument`
+        :raises SystemExit: If bank not found in the database
+        """
+        if self._loaded:
+            return self._document
+        wanted = {}
+        for field in fields:
+            top, spec = BankView._parse_field(field)
+            if top == 'name' or self._covers(top, spec):
+                continue
+            wanted[top] = BankView._merge_specs(wanted.get(top, self._specs.get(top, BankView._MISSING)), spec)
+        if not wanted:
+            return self._document
+
+        projection = {'_id': 0, 'name': 1}
+        for top, spec in wanted.items():
+            if spec is None or isinstance(spec, dict):
+                projection[top] = 1 if spec is None else spec
+            else:
+                for sub in spec:
+                    projection['.'.join([top, sub])] = 1
+        document = self._find_one(projection)
+        for top, spec in wanted.items():
+            if top in document:
+                dict.__setitem__(self._document, top, document[top])
+            else:
+                dict.pop(self._document, top, None)
+            self._specs[top] = spec
+        return self._document
+
+    def get_production(self, release):
+        """
+        Get production field for release, same as :py:func:`biomaj.bank.Bank.get_production`
+
+        :param release: Release name or production dir name
+        :type release: str
+        :return: Production document or None
+        :rtype: dict
+        """
+        release = str(release)
+        production = None
+        for prod in self.fetch(['production']).get('production', []):
+            if prod.get('release') == release or prod.get('prod_dir') == release:
+                production = prod
+        return production
+
+    def get_properties(self):
+        """
+        Get bank properties, same as :py:func:`biomaj.bank.Bank.get_properties`
+
+        :return: Properties
+        :rtype: dict
+        """
+        owner = getpass.getuser()
+        document = self.fetch(['properties'])
+        if 'properties' in document and 'owner' in document['properties']:
+            owner = document['properties']['owner']
+        return {'visibility': self.config.get('visibility.default'),
+                'type': self.config.get('db.type').split(','),
+                'tags': [],
+                'owner': owner,
+                'desc': self.config.get('db.fullname')}
+
+    def get_session(self, session_id):
+        """
+        Get a session from its id, fetching only this session from the database using $elemMatch
+
+        :param session_id: Session id
+        :type session_id: float
+        :return: Session document or None
+        :rtype: dict
+        """
+        if self.is_fetched('sessions', complete=True) or self.is_declared('sessions'):
+            for session in self._document.get('sessions', []):
+                if session.get('id') == session_id:
+                    return session
+            return None
+        if session_id not in self._sessions:
+            document = self._find_one({'_id': 0, 'sessions': {'$elemMatch': {'id': session_id}}})
+            sessions = document.get('sessions', [])
+            self._sessions[session_id] = sessions[0] if sessions else None
+        return self._sessions[session_id]
+
+    def is_declared(self, field):
+        """
+        Check a top level field has been declared by the running method, see :py:func:`push_fields`
+
+        :param field: Top level field name
+        :type field: str
+        :return: Boolean
+        :rtype: bool
+        """
+        return len(self._declared) > 0 and field in self._declared[-1]
+
+    def is_fetched(self, field, complete=False):
+        """
+        Check a top level field has been fetched from the database
+
+        :param field: Top level field name
+        :type field: str
+        :param complete: Only consider the field fetched without sub fields or projection operator
+        :type complete: bool
+        :return: Boolean
+        :rtype: bool
+        """
+        if self._loaded or field == 'name':
+            return True
+        if complete:
+            return field in self._specs and self._specs[field] is None
+        return field in self._specs
+
+    def is_loaded(self):
+        """
+        Check the complete bank document has been loaded
+
+        :return: Boolean
+        :rtype: bool
+        """
+        return self._loaded
+
+    def is_locked(self):
+        """
+        Checks if bank is locked, same as :py:func:`biomaj.bank.Bank.is_locked`
+
+        :return: Boolean
+        :rtype: bool
+        """
+        data_dir = self.config.get('data.dir')
+        lock_dir = self.config.get('lock.dir', default=data_dir)
+        return os.path.exists(os.path.join(lock_dir, self.name + '.lock'))
+
+    def load(self):
+        """
+        Load the complete bank document from the database
+
+        :return: Bank document
+        :rtype: :class:`biomajmanager.bankview.BankDocument`
+        :raises SystemExit: If bank not found in the database
+        """
+        if not self._loaded:
+            document = self._find_one(None)
+            dict.clear(self._document)
+            dict.update(self._document, document)
+            self._loaded = True
+            self._specs = {}
+            self._sessions = {}
+        return self._document
+
+    def pop_fields(self):
+        """Remove the fields declared by the method which returned, see :py:func:`push_fields`"""
+        self._declared.pop()
+
+    def push_fields(self, fields):
+        """
+        Fetch and declare the fields used by the method about to run
+
+        Until :py:func:`pop_fields` is called, fields fetched partially as declared here are read as they are.
+        Other partial fields are fetched completely on access.
+
+        :param fields: List of fields, as for :py:func:`fetch`
+        :type fields: list
+        :return: Bank document
+        :rtype: :class:`biomajmanager.bankview.BankDocument`
+        :raises SystemExit: If bank not found in the database
+        """
+        document = self.fetch(fields)
+        self._declared.append(set([BankView._parse_field(field)[0] for field in fields]))
+        return document
+
+    def _covers(self, top, spec):
+        """
+        Check a field projection is already fetched
+
+        :param top: Top level field name
+        :type top: str
+        :param spec: Projection, None, set of sub fields or projection operator
+        :type spec: None, set or dict
+        :return: Boolean
+        :rtype: bool
+        """
+        if self._loaded:
+            return True
+        if top not in self._specs:
+            return False
+        fetched = self._specs[top]
+        if fetched is None:
+            return True
+        if spec is None:
+            return False
+        if isinstance(fetched, dict) or isinstance(spec, dict):
+            return fetched == spec
+        for sub in spec:
+            if not [f for f in fetched if sub == f or sub.startswith(f + '.')]:
+                return False
+        return True
+
+    def _find_one(self, projection):
+        """
+        Get the bank document from the database
+
+        :param projection: Projection to apply
+        :type projection: dict
+        :return: Bank document
+        :rtype: dict
+        :raises SystemExit: If bank not found in the database or cannot connect to the database
+        """
+        from pymongo.errors import PyMongoError
+        try:
+            document = self.banks.find_one({'name': self.name}, projection)
+        except PyMongoError as err:
+            Utils.error("Can't connect to MongoDB: %s" % str(err))
+        if document is None:
+            Utils.error("[%s] Bank not found in database" % self.name)
+        return document
+
+    @staticmethod
+    def _merge_specs(fetched, spec):
+        """
+        Merge two projections of the same top level field
+
+        :param fetched: Projection already known, or :py:const:`BankView._MISSING`
+        :type fetched: None, set or dict
+        :param spec: Projection to add
+        :type spec: None, set or dict
+        :return: Merged projection, None if the complete field is needed
+        :rtype: None, set or dict
+        """
+        if fetched is BankView._MISSING:
+            return spec
+        if fetched is None or spec is None:
+            return None
+        if isinstance(fetched, set) and isinstance(spec, set):
+            return fetched | spec
+        if fetched == spec:
+            return fetched
+        return None
+
+    @staticmethod
+    def _parse_field(field):
+        """
+        Split a field into its top level name and its projection
+
+        :param field: Field name, dotted field name or tuple (field name, projection operator)
+        :type field: str or tuple
+        :return: Top level field name, projection
+        :rtype: tuple
+        """
+        if isinstance(field, tuple):
+            return field[0], field[1]
+        parts = field.split('.', 1)
+        if len(parts) == 1:
+            return parts[0], None
+        return parts[0], set([parts[1]])
+
+
+class BankDocument(dict):
+
+    """Bank document of a :class:`BankView`, fetching from the database the fields not fetched on access"""
+
+    def __init__(self, view):
+        """
+        Create the document
+
+        :param view: Bank view owning the document
+        :type view: :class:`biomajmanager.bankview.BankView`
+        """
+        dict.__init__(self)
+        self.view = view
+
+    def __contains__(self, key):
+        self._check_field(key)
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        self._check_field(key)
+        return dict.__getitem__(self, key)
+
+    def __iter__(self):
+        self.view.load()
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        """Same as :py:func:`dict.get`, fetching the field if needed"""
+        self._check_field(key)
+        return dict.get(self, key, default)
+
+    def items(self):
+        """Same as :py:func:`dict.items`, loading the complete document first"""
+        self.view.load()
+        return dict.items(self)
+
+    def keys(self):
+        """Same as :py:func:`dict.keys`, loading the complete document first"""
+        self.view.load()
+        return dict.keys(self)
+
+    def values(self):
+        """Same as :py:func:`dict.values`, loading the complete document first"""
+        self.view.load()
+        return dict.values(self)
+
+    def _check_field(self, key):
+        """
+        Make sure a field can be read from the document
+
+        The complete document is loaded if the field has not been fetched. If the field has only been
+        partially fetched and not declared by the running method, the complete field is fetched.
+
+        :param key: Top level field name
+        :type key: str
+        """
+        if not self.view.is_fetched(key):
+            self.view.load()
+        elif not self.view.is_fetched(key, complete=True) and not self.view.is_declared(key):
+            self.view.fetch([key])
@@ -0,0 +1,205 @@
+"""Catalog of the formats provided by the banks, built from the banks properties"""
+from biomajmanager.config import PropertiesStore
+from biomajmanager.utils import Utils
+import threading
+
+__author__ = 'tuco'
+
+
+class FormatCatalog(object):
+
+    """
+    Banks to formats matrix, indexed by tool and version
+
+    Each bank entry is built from its 'db.packages', 'db.formats' and 'db.fullname' properties, read from
+    :class:`biomajmanager.config.PropertiesStore`. :py:func:`update` only rebuilds the entries of the banks
+    whose properties changed since they were indexed.
+    """
+
+    def __init__(self, banks=None):
+        """
+        Create the catalog
+
+        :param banks: List of bank names to add to the catalog
+        :type banks: list
+        """
+        # Banks entries, bank name as key
+        self.banks = {}
+        # Index of the banks providing a format, tool name as key and {version: set(bank names)} as value
+        self.tools = {}
+        # Bank properties each entry has been built from, bank name as key
+        self.sources = {}
+        self.lock = threading.Lock()
+        if banks is not None:
+            self.update(banks)
+
+    def __contains__(self, name):
+        return name in self.banks
+
+    def __len__(self):
+        return len(self.banks)
+
+    def get_bank(self, name):
+        """
+        Get the catalog entry of a bank
+
+        :param name: Bank name
+        :type name: str
+        :return: {'name': name, 'formats': {'tool1': [versions], ...}, 'raw': db.formats, 'fullname': db.fullname}
+                 or None if bank not in catalog
+        :rtype: dict
+        """
+        return self.banks.get(name)
+
+    def get_banks(self, tool, version=None):
+        """
+        Get the banks providing a format
+
+        :param tool: Tool name, or 'tool@version'
+        :type tool: str
+        :param version: Tool version. If None, any version of the tool
+        :type version: str
+        :return: Sorted list of bank names
+        :rtype: list
+        """
+        if version is None and '@' in tool:
+            tool, version = tool.split('@', 1)
+        versions = self.tools.get(tool, {})
+        if version is not None:
+            return sorted(versions.get(version, []))
+        banks = set()
+        for names in versions.values():
+            banks.update(names)
+        return sorted(banks)
+
+    def get_formats(self, name):
+        """
+        Get the formats provided by a bank
+
+        :param name: Bank name
+        :type name: str
+        :return: {'tool1': [list of version], 'tool2': [list of version] ...}
+        :rtype: dict
+        """
+        entry = self.banks.get(name)
+        if entry is None:
+            return {}
+        return entry['formats']
+
+    def get_matrix(self, banks=None):
+        """
+        Get the banks entries, as used by the 'banks_formats' templates
+
+        :param banks: List of bank names, default all banks of the catalog
+        :type banks: list
+        :return: List of banks entries, see :py:func:`get_bank`
+        :rtype: list
+        """
+        if banks is None:
+            banks = sorted(self.banks)
+        return [self.banks[name] for name in banks if name in self.banks]
+
+    def get_tools(self, banks=None):
+        """
+        Get the tools provided by a list of banks
+
+        :param banks: List of bank names, default all banks of the catalog
+        :type banks: list
+        :return: List of tools names, sorted case insensitive
+        :rtype: list
+        """
+        if banks is None:
+            tools = [tool for tool, versions in self.tools.items() if versions]
+        else:
+            tools = set()
+            for name in banks:
+                tools.update(self.get_formats(name))
+        return sorted(tools, key=str.lower)
+
+    def has_format(self, name, tool, version=None):
+        """
+        Check a bank provides a format
+
+        :param name: Bank name
+        :type name: str
+        :param tool: Tool name, or 'tool@version'
+        :type tool: str
+        :param version: Tool version. If None, any version of the tool
+        :type version: str
+        :return: Boolean
+        :rtype: bool
+        """
+        return name in self.get_banks(tool, version=version)
+
+    @staticmethod
+    def parse_packages(value):
+        """
+        Split a 'db.packages' property value
+
+        :param value: Value of 'db.packages'
+        :type value: str
+        :return: List of packages ('<pack_name>@<pack_version>')
+        :rtype: list
+        """
+        if not value:
+            return []
+        return [pack for pack in value.replace('\\', '').replace('\n', '').strip().split(',') if pack]
+
+    def remove(self, name):
+        """
+        Remove a bank from the catalog
+
+        :param name: Bank name
+        :type name: str
+        :return: True if bank was in the catalog
+        :rtype: bool
+        """
+        with self.lock:
+            self.sources.pop(name, None)
+            entry = self.banks.pop(name, None)
+            if entry is None:
+                return False
+            for tool, versions in entry['formats'].items():
+                for version in versions:
+                    names = self.tools.get(tool, {}).get(version)
+                    if names is not None:
+                        names.discard(name)
+                        if not names:
+                            del self.tools[tool][version]
+                if tool in self.tools and not self.tools[tool]:
+                    del self.tools[tool]
+        return True
+
+    def update(self, banks):
+        """
+        Add banks to the catalog, or rebuild their entries if their properties changed
+
+        :param banks: List of bank names
+        :type banks: list
+        :return: Number of banks entries (re)built
+        :rtype: int
+        """
+        built = 0
+        for name in banks:
+            properties = PropertiesStore.get_bank_properties(name)
+            if properties is None:
+                Utils.warn("[%s] Bank properties file not found" % name)
+                self.remove(name)
+                continue
+            if self.sources.get(name) is properties:
+                continue
+            self.remove(name)
+            formats = {}
+            for pack in FormatCatalog.parse_packages(properties.get('db.packages')):
+                (tool, version) = pack.split('@')
+                formats.setdefault(tool, []).append(version)
+            entry = {'name': name, 'formats': formats, 'raw': properties.get('db.formats'),
+                     'fullname': (properties.get('db.fullname') or '').replace('"', '')}
+            with self.lock:
+                for tool, versions in formats.items():
+                    for version in versions:
+                        self.tools.setdefault(tool, {}).setdefault(version, set()).add(name)
+                self.banks[name] = entry
+                self.sources[name] = properties
+            built += 1
+        return built
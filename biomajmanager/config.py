@@ -0,0 +1,439 @@
+"""Caches of configuration files, each file is parsed once until it changes on disk"""
+from biomaj.options import Options
+from biomaj_core.config import BiomajConfig
+from biomajmanager.utils import Utils
+import json
+import os
+import sqlite3
+import threading
+try:
+    from ConfigParser import ConfigParser, Error
+except ImportError:
+    from configparser import ConfigParser, Error
+
+__author__ = 'tuco'
+
+
+class ConfigCache(object):
+
+    """
+    Cache of global (global.properties + manager.properties), banks and properties files configurations
+
+    Cached configurations are checked against the path, modification time and size of the files they
+    have been read from. Long running callers can force a reload with :py:func:`ConfigCache.invalidate`.
+    """
+
+    # Manager configurations, (global file, manager file) as key
+    managers = {}
+    # Banks configurations, bank name as key
+    banks = {}
+    # Plain properties files parsers, tuple of files as key
+    parsers = {}
+    # Lock used to update the cache
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_bank_config(name):
+        """
+        Get the configuration of a bank
+
+        :param name: Bank name
+        :type name: str
+        :return: Bank configuration
+        :rtype: :class:`biomaj_core.config.BiomajConfig`
+        :raises Exception: If bank configuration cannot be loaded, see :class:`biomaj_core.config.BiomajConfig`
+        """
+        if BiomajConfig.global_config is None:
+            BiomajConfig.load_config()
+        stamps = ConfigCache.get_stamps([BiomajConfig.config_file,
+                                         os.path.join(BiomajConfig.global_config.get('GENERAL', 'conf.dir'),
+                                                      name + '.properties')])
+        cached = ConfigCache.banks.get(name)
+        # Bank configuration relies on the global configuration, it must be the same
+        if cached is not None and cached[0] == stamps and cached[2] is BiomajConfig.global_config:
+            return cached[1]
+        # Built without the lock, banks workers (see Manager.map_banks) load their configurations concurrently
+        options = Options()
+        options.no_log = True
+        config = BiomajConfig(name, options)
+        with ConfigCache.lock:
+            # Another worker may have stored this configuration meanwhile, all of them share the same one
+            cached = ConfigCache.banks.get(name)
+            if cached is not None and cached[0] == stamps and cached[2] is BiomajConfig.global_config:
+                return cached[1]
+            ConfigCache.banks[name] = (stamps, config, BiomajConfig.global_config)
+        return config
+
+    @staticmethod
+    def get_global_file(global_cfg=None):
+        """
+        Get the path of the global configuration file, searched as :py:func:`BiomajConfig.load_config` does
+
+        :param global_cfg: Path to global.properties
+        :type global_cfg: str
+        :return: Path to global.properties or None
+        :rtype: str
+        """
+        if global_cfg is None:
+            env_file = os.environ.get('BIOMAJ_CONF')
+            if env_file is not None and os.path.exists(env_file):
+                global_cfg = env_file
+            elif os.path.exists('global.properties'):
+                global_cfg = 'global.properties'
+        if global_cfg is None:
+            return None
+        return os.path.abspath(global_cfg)
+
+    @staticmethod
+    def get_manager_config(cfg=None, global_cfg=None):
+        """
+        Get the manager configuration (global.properties + manager.properties) if already loaded and unchanged
+
+        :param cfg: Path to manager.properties
+        :type cfg: str
+        :param global_cfg: Path to global.properties
+        :type global_cfg: str
+        :return: Configuration or None
+        :rtype: :class:`configparser.ConfigParser`
+        """
+        key = (ConfigCache.get_global_file(global_cfg), cfg)
+        cached = ConfigCache.managers.get(key)
+        # Someone else may have loaded another global configuration
+        if cached is None or cached[1] is not BiomajConfig.global_config:
+            return None
+        if cached[0] != ConfigCache.get_stamps([stamp[0] for stamp in cached[0]]):
+            return None
+        return cached[1]
+
+    @staticmethod
+    def get_parser(files):
+        """
+        Get a parser for a list of properties files, without any BioMAJ processing
+
+        :param files: List of files to read, in order
+        :type files: list
+        :return: Parser
+        :rtype: :class:`configparser.ConfigParser`
+        """
+        key = tuple(files)
+        stamps = ConfigCache.get_stamps(files)
+        cached = ConfigCache.parsers.get(key)
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+        parser = ConfigParser()
+        parser.read(files)
+        with ConfigCache.lock:
+            cached = ConfigCache.parsers.get(key)
+            if cached is not None and cached[0] == stamps:
+                return cached[1]
+            ConfigCache.parsers[key] = (stamps, parser)
+        return parser
+
+    @staticmethod
+    def get_stamps(files):
+        """
+        Get the path, modification time and size of files
+
+        :param files: List of files
+        :type files: list
+        :return: Tuple of (path, mtime, size), mtime and size are None for a missing file
+        :rtype: tuple
+        """
+        stamps = []
+        for path in files:
+            try:
+                stat = os.stat(path)
+                stamps.append((path, stat.st_mtime, stat.st_size))
+            except OSError:
+                stamps.append((path, None, None))
+        return tuple(stamps)
+
+    @staticmethod
+    def invalidate(bank=None):
+        """
+        Remove configurations from the cache, they are read again on next access
+
+        :param bank: Bank name to remove from the cache. If None, clear the whole cache
+        :type bank: str
+        :return: True
+        :rtype: bool
+        """
+        with ConfigCache.lock:
+            if bank is not None:
+                ConfigCache.banks.pop(bank, None)
+            else:
+                ConfigCache.managers = {}
+                ConfigCache.banks = {}
+                ConfigCache.parsers = {}
+        return True
+
+    @staticmethod
+    def set_manager_config(config, cfg=None, global_cfg=None):
+        """
+        Store the manager configuration freshly loaded
+
+        :param config: Manager configuration
+        :type config: :class:`configparser.ConfigParser`
+        :param cfg: Path to manager.properties, as given to :py:func:`biomajmanager.manager.Manager.load_config`
+        :type cfg: str
+        :param global_cfg: Path to global.properties, as given to
+                           :py:func:`biomajmanager.manager.Manager.load_config`
+        :type global_cfg: str
+        :return: Configuration
+        :rtype: :class:`configparser.ConfigParser`
+        """
+        files = [BiomajConfig.config_file]
+        conf_dir = os.path.dirname(BiomajConfig.config_file)
+        files.append(cfg if cfg else os.path.join(conf_dir, 'manager.properties'))
+        with ConfigCache.lock:
+            ConfigCache.managers[(ConfigCache.get_global_file(global_cfg), cfg)] = (ConfigCache.get_stamps(files),
+                                                                                   config)
+        return config
+
+
+class PropertiesStore(object):
+
+    """
+    Persistent cache of banks properties, shared between runs of the manager
+
+    Properties of the [GENERAL] section of each bank (global.properties + <bank>.properties) are parsed once
+    and stored into a SQLite database located in 'cache.dir'. Stored properties are checked against the
+    path, modification time and size of the files they have been read from.
+    """
+
+    # Name of the SQLite database file, created in 'cache.dir'
+    FILE = 'biomaj-manager-properties.db'
+    # Banks properties read during this run, bank name as key
+    banks = {}
+    # Banks properties read from the database, bank name as key
+    stored = None
+    # Path of the database 'stored' has been read from
+    path = None
+    # Lock used to update the cache
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_bank_properties(name):
+        """
+        Get the properties of a bank, parsing the bank properties file only if it changed since last run
+
+        :param name: Bank name
+        :type name: str
+        :return: Bank properties or None if bank properties file does not exist
+        :rtype: :class:`biomajmanager.config.BankProperties`
+        """
+        if BiomajConfig.global_config is None:
+            BiomajConfig.load_config()
+        bank_file = os.path.join(BiomajConfig.global_config.get('GENERAL', 'conf.dir'), name + '.properties')
+        if not os.path.isfile(bank_file):
+            return None
+        stamps = json.dumps(ConfigCache.get_stamps([BiomajConfig.config_file, bank_file]))
+        cached = PropertiesStore.banks.get(name)
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+
+        stored = PropertiesStore._load().get(name)
+        if stored is not None and stored[0] == stamps:
+            values = stored[1]
+        else:
+            values = PropertiesStore._parse([BiomajConfig.config_file, bank_file])
+            PropertiesStore._save(name, stamps, values)
+        properties = BankProperties(name, values)
+        with PropertiesStore.lock:
+            PropertiesStore.banks[name] = (stamps, properties)
+        return properties
+
+    @staticmethod
+    def get_path():
+        """
+        Get the path of the SQLite database, from 'cache.dir' of the global configuration
+
+        :return: Path to the database or None if 'cache.dir' is not set or does not exist
+        :rtype: str
+        """
+        if BiomajConfig.global_config is None:
+            BiomajConfig.load_config()
+        if not BiomajConfig.global_config.has_option('GENERAL', 'cache.dir'):
+            return None
+        cache_dir = BiomajConfig.global_config.get('GENERAL', 'cache.dir')
+        if not os.path.isdir(cache_dir):
+            return None
+        return os.path.join(cache_dir, PropertiesStore.FILE)
+
+    @staticmethod
+    def invalidate(bank=None):
+        """
+        Remove banks properties from the cache and from the database, they are parsed again on next access
+
+        :param bank: Bank name to remove from the cache. If None, clear the whole cache
+        :type bank: str
+        :return: True
+        :rtype: bool
+        """
+        with PropertiesStore.lock:
+            if bank is not None:
+                PropertiesStore.banks.pop(bank, None)
+                if PropertiesStore.stored is not None:
+                    PropertiesStore.stored.pop(bank, None)
+            else:
+                PropertiesStore.banks = {}
+                PropertiesStore.stored = None
+        path = PropertiesStore.get_path()
+        if path is not None and os.path.exists(path):
+            if bank is not None:
+                PropertiesStore._execute(path, "DELETE FROM properties WHERE bank = ?", (bank,))
+            else:
+                PropertiesStore._execute(path, "DELETE FROM properties")
+        return True
+
+    @staticmethod
+    def _connect(path):
+        """
+        Open the database, creating the properties table if needed
+
+        :param path: Path to the database
+        :type path: str
+        :return: Connection
+        :rtype: :class:`sqlite3.Connection`
+        """
+        connection = sqlite3.connect(path, timeout=10)
+        connection.execute("CREATE TABLE IF NOT EXISTS properties "
+                           "(bank TEXT PRIMARY KEY, stamps TEXT NOT NULL, properties TEXT NOT NULL)")
+        return connection
+
+    @staticmethod
+    def _execute(path, query, args=()):
+        """
+        Execute an update query on the database, warns if it fails
+
+        :param path: Path to the database
+        :type path: str
+        :param query: SQL query
+        :type query: str
+        :param args: Query arguments
+        :type args: tuple
+        :return: Boolean
+        :rtype: bool
+        """
+        try:
+            with PropertiesStore.lock:
+                connection = PropertiesStore._connect(path)
+                try:
+                    with connection:
+                        connection.execute(query, args)
+                finally:
+                    connection.close()
+        except sqlite3.Error as err:
+            Utils.warn("Can't update properties cache %s: %s" % (path, str(err)))
+            return False
+        return True
+
+    @staticmethod
+    def _load():
+        """
+        Read all the stored banks properties from the database, once per database
+
+        :return: Stored properties, bank name as key and (stamps, properties) as value
+        :rtype: dict
+        """
+        path = PropertiesStore.get_path()
+        if PropertiesStore.stored is not None and PropertiesStore.path == path:
+            return PropertiesStore.stored
+        stored = {}
+        if path is not None and os.path.exists(path):
+            try:
+                connection = PropertiesStore._connect(path)
+                try:
+                    for bank, stamps, properties in connection.execute("SELECT bank, stamps, properties "
+                                                                       "FROM properties"):
+                        stored[bank] = (stamps, json.loads(properties))
+                finally:
+                    connection.close()
+            except (sqlite3.Error, ValueError) as err:
+                Utils.warn("Can't read properties cache %s: %s" % (path, str(err)))
+        with PropertiesStore.lock:
+            PropertiesStore.stored = stored
+            PropertiesStore.path = path
+        return stored
+
+    @staticmethod
+    def _parse(files):
+        """
+        Parse the [GENERAL] section of properties files
+
+        :param files: List of files to read, in order
+        :type files: list
+        :return: Properties, property name as key
+        :rtype: dict
+        """
+        parser = ConfigParser()
+        parser.read(files)
+        values = {}
+        if not parser.has_section('GENERAL'):
+            return values
+        for option in parser.options('GENERAL'):
+            try:
+                values[option] = parser.get('GENERAL', option)
+            except Error:
+                values[option] = parser.get('GENERAL', option, raw=True)
+        return values
+
+    @staticmethod
+    def _save(name, stamps, values):
+        """
+        Store the properties of a bank into the database
+
+        :param name: Bank name
+        :type name: str
+        :param stamps: Files stamps, as json
+        :type stamps: str
+        :param values: Properties
+        :type values: dict
+        :return: Boolean
+        :rtype: bool
+        """
+        with PropertiesStore.lock:
+            if PropertiesStore.stored is not None:
+                PropertiesStore.stored[name] = (stamps, values)
+        path = PropertiesStore.get_path()
+        if path is None:
+            return False
+        return PropertiesStore._execute(path, "INSERT OR REPLACE INTO properties (bank, stamps, properties) "
+                                              "VALUES (?, ?, ?)", (name, stamps, json.dumps(values)))
+
+
+class BankProperties(object):
+
+    """Properties of a bank read from :class:`PropertiesStore`, looked up as :py:func:`BiomajConfig.get` does"""
+
+    def __init__(self, name, values):
+        """
+        Create the bank properties
+
+        :param name: Bank name
+        :type name: str
+        :param values: Properties of the [GENERAL] section, property name as key
+        :type values: dict
+        """
+        self.name = name
+        self.values = values
+
+    def get(self, prop, default=None):
+        """
+        Get a property, from environment (BIOMAJ_X_Y_Z for property x.y.z), bank properties or BioMAJ defaults
+
+        :param prop: Property name
+        :type prop: str
+        :param default: Default value if property is not set
+        :type default: str
+        :return: Property value
+        :rtype: str
+        """
+        env_prop = 'BIOMAJ_' + prop.upper().replace('.', '_')
+        if env_prop in os.environ:
+            return os.environ[env_prop]
+        if prop in self.values:
+            return self.values[prop]
+        if prop in BiomajConfig.DEFAULTS:
+            return BiomajConfig.DEFAULTS[prop]
+        return default
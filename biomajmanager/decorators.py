@@ -1,13 +1,39 @@
 """Global decorators for BioMAJ Manager"""
+from biomajmanager.bankview import BankView
 from biomajmanager.utils import Utils
 from functools import wraps
 __author__ = 'tuco'
 
 
+def bank_fields(*fields):
+    """
+    Decorator function that declares the bank document fields a method needs
+
+    When the Manager bank is a :class:`biomajmanager.bankview.BankView`, only those fields are fetched
+    from the database before calling the method (see :py:func:`bank_required`). Fields are given as
+    for :py:func:`biomajmanager.bankview.BankView.fetch`. Declared fields must cover all the fields the
+    method reads, including the ones read by the undecorated methods it calls.
+
+    :param fields: Fields needed by the decorated function
+    :type fields: str or tuple
+    :return: Decorated function
+    :rtype: func
+    """
+    def _set_bank_fields(func):
+        """Store the fields within the decorated function"""
+        func.bank_fields = fields
+        return func
+    return _set_bank_fields
+
+
 def bank_required(func):
     """
     Decorator function that checks a bank name is set
 
+    If the bank is a :class:`biomajmanager.bankview.BankView`, the fields declared with :py:func:`bank_fields`
+    are fetched from the database and declared for the time of the call. Without declared fields, nothing
+    is fetched beforehand and the fields read are fetched on access.
+
     :param func: Decorated function
     :type func: Function
     :return: Result of function called
@@ -20,7 +46,15 @@ def bank_required(func):
         self = args[0]
         if self.bank is None:
             Utils.error("A bank name is required")
-        return func(*args, **kwargs)
+        fields = getattr(func, 'bank_fields', None)
+        if fields is None or not isinstance(self.bank, BankView):
+            return func(*args, **kwargs)
+        view = self.bank
+        view.push_fields(fields)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            view.pop_fields()
     return _check_bank_required
 
 def deprecated(func):
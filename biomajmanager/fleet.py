@@ -0,0 +1,130 @@
+"""Fleet wide access to banks documents, loaded with a single database query"""
+from biomajmanager.bankview import BankView
+from biomajmanager.utils import Utils
+
+__author__ = 'tuco'
+
+
+class FleetSnapshot(object):
+
+    """Snapshot of banks documents fetched from the database in one projected query"""
+
+    # Default fields fetched from the database. Sessions 'status' and 'process' subtrees
+    # are left out as they are the biggest part of a bank document
+    FIELDS = ['name', 'current', 'last_update_session', 'pending', 'production', 'properties', 'status',
+              'sessions.id', 'sessions.release', 'sessions.remoterelease', 'sessions.workflow_status',
+              'sessions.deleted', 'sessions.last_update_time', 'sessions.dir_version']
+
+    def __init__(self, banks=None, visibility='public', fields=None):
+        """
+        Create the snapshot and load banks documents from the database
+
+        :param banks: List of bank names to load. If None, load all banks matching 'visibility'
+        :type banks: list
+        :param visibility: Type of bank visibility, default to 'public'. Supported ['all', 'public', 'private']
+        :type visibility: str
+        :param fields: List of fields to fetch from the database, default :py:const:`FleetSnapshot.FIELDS`.
+                       See :py:func:`biomajmanager.bankview.BankView.fetch` for supported fields
+        :type fields: list
+        :raises SystemExit: If visibility argument is not one of ('all', 'public', 'private')
+        """
+        if visibility not in ['all', 'public', 'private']:
+            Utils.error("Bank visibility '%s' not supported. Only one of ['all', 'public', 'private']" % visibility)
+        self.names = banks
+        self.visibility = visibility
+        self.fields = fields if fields is not None else FleetSnapshot.FIELDS
+        self.banks = {}
+        self.load()
+
+    def __contains__(self, name):
+        return name in self.banks
+
+    def __iter__(self):
+        """Iterate over banks views, sorted by bank name"""
+        for name in sorted(self.banks):
+            yield self.banks[name]
+
+    def __len__(self):
+        return len(self.banks)
+
+    @staticmethod
+    def get_collection():
+        """
+        Get the 'banks' collection, connecting to the database if needed
+
+        :return: MongoDB banks collection
+        :rtype: :class:`pymongo.collection.Collection`
+        :raises SystemExit: If biomaj configuration cannot be loaded
+        """
+        return BankView.get_collection()
+
+    def get(self, name):
+        """
+        Get the view of a bank from the snapshot
+
+        :param name: Bank name
+        :type name: str
+        :return: Bank view or None
+        :rtype: :class:`biomajmanager.fleet.BankSnapshot`
+        """
+        return self.banks.get(name)
+
+    def get_names(self):
+        """
+        Get the sorted list of banks names found in the snapshot
+
+        :return: List of banks names
+        :rtype: list
+        """
+        return sorted(self.banks)
+
+    def load(self):
+        """
+        (Re)load the banks documents from the database using a single query
+
+        :return: Number of banks loaded
+        :rtype: int
+        :raises SystemExit: If cannot connect to MongoDB
+        """
+        from pymongo.errors import PyMongoError
+        if self.names is not None:
+            query = {'name': {'$in': list(self.names)}}
+        else:
+            query = {'properties.visibility': self.visibility}
+        projection = {'_id': 0, 'name': 1}
+        for field in self.fields:
+            if isinstance(field, tuple):
+                projection[field[0]] = field[1]
+            else:
+                projection[field] = 1
+
+        self.banks = {}
+        try:
+            for document in FleetSnapshot.get_collection().find(query, projection):
+                # Avoid document without bank name
+                if 'name' in document:
+                    self.banks[document['name']] = BankSnapshot(document, fields=self.fields)
+        except PyMongoError as err:
+            Utils.error("Can't connect to MongoDB: %s" % str(err))
+
+        if self.names is not None:
+            for name in self.names:
+                if name not in self.banks:
+                    Utils.warn("[%s] Bank not found in database" % name)
+        return len(self.banks)
+
+
+class BankSnapshot(BankView):
+
+    """Read only view of a bank built from a document loaded by :class:`FleetSnapshot`"""
+
+    def __init__(self, document, fields=None):
+        """
+        Create the bank view
+
+        :param document: Bank document from the database
+        :type document: dict
+        :param fields: List of fields used to fetch 'document'. If None, 'document' is considered complete
+        :type fields: list
+        """
+        BankView.__init__(self, document['name'], document=document, fields=fields)
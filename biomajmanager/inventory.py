@@ -0,0 +1,342 @@
+"""Inventory of the links of the production directory, stored into a SQLite database"""
+from biomaj_core.config import BiomajConfig
+from biomajmanager.utils import Utils
+import os
+import sqlite3
+import threading
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+__author__ = 'tuco'
+
+
+class LinkInventory(object):
+
+    """
+    Persistent inventory of the links of 'production.dir', stored into a SQLite database located in 'cache.dir'
+
+    Each link is recorded with the bank and the bank version directory it points into, a directory of the bank
+    'data.dir' (e.g. 'alu_54') or 'current'. Links are recorded by :class:`biomajmanager.links.Links` when they are
+    created or removed, :py:func:`rebuild` reads them back from disk.
+    """
+
+    # Name of the SQLite database file, created in 'cache.dir'
+    FILE = 'biomaj-manager-links.db'
+    lock = threading.Lock()
+
+    def __init__(self, path=None):
+        """
+        Open the inventory
+
+        :param path: Path to the database, default :py:func:`get_path`. If no path is available, the inventory is
+                     disabled and nothing is recorded
+        :type path: str
+        """
+        self.path = path if path is not None else LinkInventory.get_path()
+
+    def add(self, bank, links):
+        """
+        Record links, replacing the ones already recorded with the same path
+
+        :param bank: Bank name
+        :type bank: str
+        :param links: List of (link path relative to 'production.dir', version, 'symlink'|'hardlink', link source)
+        :type links: list
+        :return: Number of recorded links
+        :rtype: int
+        """
+        rows = [(link, bank, version, os.path.dirname(link), LinkInventory.get_tool(link), op, source)
+                for link, version, op, source in links]
+        if not rows or not self._execute("INSERT OR REPLACE INTO links (path, bank, version, target_dir, tool, op, "
+                                          "source) VALUES (?, ?, ?, ?, ?, ?, ?)", rows):
+            return 0
+        return len(rows)
+
+    def clear(self, bank=None):
+        """
+        Remove all the links of the inventory
+
+        :param bank: Only remove the links of this bank
+        :type bank: str
+        :return: Boolean
+        :rtype: bool
+        """
+        if bank is None:
+            return self._execute("DELETE FROM links", [()])
+        return self._execute("DELETE FROM links WHERE bank = ?", [(bank,)])
+
+    def get_banks(self, target_dir=None, tool=None):
+        """
+        Get the banks having links into a target directory or for a tool
+
+        :param target_dir: Target directory relative to 'production.dir' (e.g. 'index/blast+'), sub directories
+                           included
+        :type target_dir: str
+        :param tool: Tool name (e.g. 'blast+', 'ftp')
+        :type tool: str
+        :return: Sorted list of bank names
+        :rtype: list
+        """
+        where, args = LinkInventory._get_filters(target_dir=target_dir, tool=tool)
+        return sorted([row[0] for row in self._query("SELECT DISTINCT bank FROM links" + where, args)])
+
+    def get_links(self, bank=None, release=None, target_dir=None, tool=None):
+        """
+        Get the links of the inventory
+
+        :param bank: Bank name
+        :type bank: str
+        :param release: Release directory name (production 'prod_dir', e.g. 'alu_54'). Links recorded through
+                        'current' are returned if 'current' points to this release directory
+        :type release: str
+        :param target_dir: Target directory relative to 'production.dir' (e.g. 'index/blast+'), sub directories
+                           included
+        :type target_dir: str
+        :param tool: Tool name (e.g. 'blast+', 'ftp')
+        :type tool: str
+        :return: List of {'path', 'bank', 'version', 'target_dir', 'tool', 'op', 'source'}, sorted by path
+        :rtype: list
+        """
+        where, args = LinkInventory._get_filters(bank=bank, target_dir=target_dir, tool=tool)
+        if release is not None:
+            versions = "version = ?"
+            args.append(release)
+            current = [name for name in self._get_current_banks(bank) if LinkInventory._get_current(name) == release]
+            if current:
+                versions = "(%s OR (version = 'current' AND bank IN (%s)))" % (versions, ', '.join('?' * len(current)))
+                args.extend(current)
+            where += (' AND ' if where else ' WHERE ') + versions
+        fields = ['path', 'bank', 'version', 'target_dir', 'tool', 'op', 'source']
+        return [dict(zip(fields, row)) for row in self._query("SELECT %s FROM links%s ORDER BY path" %
+                                                              (', '.join(fields), where), args)]
+
+    @staticmethod
+    def get_path():
+        """
+        Get the path of the SQLite database, from 'cache.dir' of the global configuration
+
+        :return: Path to the database or None if 'cache.dir' is not set or does not exist
+        :rtype: str
+        """
+        if BiomajConfig.global_config is None:
+            BiomajConfig.load_config()
+        if not BiomajConfig.global_config.has_option('GENERAL', 'cache.dir'):
+            return None
+        cache_dir = BiomajConfig.global_config.get('GENERAL', 'cache.dir')
+        if not os.path.isdir(cache_dir):
+            return None
+        return os.path.join(cache_dir, LinkInventory.FILE)
+
+    @staticmethod
+    def get_tool(link):
+        """
+        Get the tool a link is created for, from its path
+
+        :param link: Link path relative to 'production.dir'
+        :type link: str
+        :return: Tool name, the directory under 'index' (e.g. 'blast+') or the top directory (e.g. 'ftp')
+        :rtype: str
+        """
+        parts = link.split(os.sep)
+        if parts[0] == 'index' and len(parts) > 2:
+            return parts[1]
+        return parts[0]
+
+    def rebuild(self, prod_dir, data_dir):
+        """
+        Rebuild the inventory from the symlinks found in 'production.dir'
+
+        Each symlink value is resolved without following the links of the bank directory, so links through 'current'
+        are recorded as such. Links through a published links tree are recorded with the tree release directory.
+        Hard links and symlinks pointing outside 'data.dir' are not recorded.
+
+        :param prod_dir: Production directory
+        :type prod_dir: str
+        :param data_dir: BioMAJ 'data.dir'
+        :type data_dir: str
+        :return: Number of recorded links
+        :rtype: int
+        :raises SystemExit: If production directory does not exist
+        """
+        if not os.path.isdir(prod_dir):
+            Utils.error("Production directory %s does not exist" % str(prod_dir))
+        data_dir = os.path.normpath(data_dir)
+        trees_dir = os.path.join(prod_dir, Utils.TREES_DIR)
+        banks = {}
+        for dir_path in Utils.iter_dirs(prod_dir, leaves=False, full=True):
+            rel_dir = os.path.relpath(dir_path, prod_dir)
+            # Manifests and staged trees directories are not inventoried
+            if rel_dir.split(os.sep)[0] in Utils.MANAGED_DIRS:
+                continue
+            try:
+                entries = [entry for entry in scandir(dir_path) if entry.is_symlink()]
+            except OSError as err:
+                Utils.warn("Can't read %s: %s" % (dir_path, str(err)))
+                continue
+            for entry in entries:
+                source = os.readlink(entry.path)
+                target = os.path.normpath(os.path.join(dir_path, source))
+                if target.startswith(trees_dir + os.sep):
+                    # Published links tree: .trees/<bank>/current/...
+                    parts = os.path.relpath(target, trees_dir).split(os.sep)
+                    version = LinkInventory._get_tree(os.path.join(trees_dir, parts[0], parts[1])) \
+                        if len(parts) > 1 else None
+                elif target.startswith(data_dir + os.sep):
+                    parts = os.path.relpath(target, data_dir).split(os.sep)
+                    version = parts[1] if len(parts) > 1 else None
+                else:
+                    continue
+                if version is None:
+                    continue
+                link = os.path.normpath(os.path.join(rel_dir, entry.name))
+                banks.setdefault(parts[0], []).append((link, version, 'symlink', source))
+        self.clear()
+        return sum([self.add(bank, links) for bank, links in banks.items()])
+
+    def remove(self, links):
+        """
+        Remove links from the inventory
+
+        :param links: List of links paths, relative to 'production.dir'
+        :type links: list
+        :return: Boolean
+        :rtype: bool
+        """
+        if not links:
+            return True
+        return self._execute("DELETE FROM links WHERE path = ?", [(link,) for link in links])
+
+    def _connect(self):
+        """
+        Open the database, creating the links table and its indexes if needed
+
+        :return: Connection
+        :rtype: :class:`sqlite3.Connection`
+        """
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("CREATE TABLE IF NOT EXISTS links (path TEXT PRIMARY KEY, bank TEXT NOT NULL, "
+                           "version TEXT NOT NULL, target_dir TEXT NOT NULL, tool TEXT NOT NULL, op TEXT NOT NULL, "
+                           "source TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS links_bank ON links (bank, version)")
+        connection.execute("CREATE INDEX IF NOT EXISTS links_target_dir ON links (target_dir)")
+        connection.execute("CREATE INDEX IF NOT EXISTS links_tool ON links (tool, bank)")
+        return connection
+
+    def _execute(self, query, rows):
+        """
+        Execute an update query on the database for each row, in a single transaction. Warns if it fails
+
+        :param query: SQL query
+        :type query: str
+        :param rows: List of query arguments
+        :type rows: list
+        :return: Boolean
+        :rtype: bool
+        """
+        if self.path is None:
+            return False
+        try:
+            with LinkInventory.lock:
+                connection = self._connect()
+                try:
+                    with connection:
+                        connection.executemany(query, rows)
+                finally:
+                    connection.close()
+        except sqlite3.Error as err:
+            Utils.warn("Can't update links inventory %s: %s" % (self.path, str(err)))
+            return False
+        return True
+
+    def _get_current_banks(self, bank=None):
+        """
+        Get the banks having links recorded through 'current'
+
+        :param bank: Only check this bank
+        :type bank: str
+        :return: List of bank names
+        :rtype: list
+        """
+        if bank is not None:
+            return [row[0] for row in self._query("SELECT DISTINCT bank FROM links WHERE bank = ? "
+                                                  "AND version = 'current'", [bank])]
+        return [row[0] for row in self._query("SELECT DISTINCT bank FROM links WHERE version = 'current'", [])]
+
+    @staticmethod
+    def _get_current(bank):
+        """
+        Get the release directory name the 'current' link of a bank points to
+
+        :param bank: Bank name
+        :type bank: str
+        :return: Release directory name or None
+        :rtype: str
+        """
+        if BiomajConfig.global_config is None:
+            BiomajConfig.load_config()
+        return LinkInventory._get_tree(os.path.join(BiomajConfig.global_config.get('GENERAL', 'data.dir'),
+                                                    bank, 'current'))
+
+    @staticmethod
+    def _get_filters(bank=None, target_dir=None, tool=None):
+        """
+        Build the WHERE clause of a query
+
+        :return: WHERE clause, list of arguments
+        :rtype: tuple
+        """
+        clauses = []
+        args = []
+        if bank is not None:
+            clauses.append("bank = ?")
+            args.append(bank)
+        if target_dir is not None:
+            # Range on the index instead of LIKE, '0' is the character following '/'
+            target_dir = target_dir.rstrip(os.sep)
+            clauses.append("(target_dir = ? OR (target_dir > ? AND target_dir < ?))")
+            args.extend([target_dir, target_dir + os.sep, target_dir + chr(ord(os.sep) + 1)])
+        if tool is not None:
+            clauses.append("tool = ?")
+            args.append(tool)
+        if not clauses:
+            return '', args
+        return ' WHERE ' + ' AND '.join(clauses), args
+
+    @staticmethod
+    def _get_tree(link):
+        """
+        Get the name of the directory a symlink points to
+
+        :param link: Symlink path
+        :type link: str
+        :return: Directory name or None if not a symlink
+        :rtype: str
+        """
+        if not os.path.islink(link):
+            return None
+        return os.path.basename(os.readlink(link).rstrip(os.sep))
+
+    def _query(self, query, args):
+        """
+        Run a select query on the database
+
+        :param query: SQL query
+        :type query: str
+        :param args: Query arguments
+        :type args: list
+        :return: List of rows
+        :rtype: list
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        try:
+            connection = self._connect()
+            try:
+                return connection.execute(query, args).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as err:
+            Utils.warn("Can't read links inventory %s: %s" % (self.path, str(err)))
+            return []
@@ -1,7 +1,17 @@
 """Automatically create symbolic links from bank data dir to defined target"""
+from biomajmanager.inventory import LinkInventory
 from biomajmanager.utils import Utils
 from biomajmanager.manager import Manager
+from multiprocessing.pool import ThreadPool
+import errno
+import json
 import os
+import shutil
+import threading
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 __author__ = 'tuco'
 
@@ -31,6 +41,15 @@ class Links(object):
         'uncompressed': [{'target': 'release', 'fallback': 'flat'},
                          {'target': 'index/golden', 'requires': 'golden'}],
         }
+    # Directory, relative to 'production.dir', where banks links manifests are stored
+    MANIFEST_DIR = Utils.MANIFEST_DIR
+    # Default number of workers used to create links in parallel
+    WORKERS = 4
+    # Directory, relative to 'production.dir', where banks links trees are staged, one tree per release
+    TREES_DIR = Utils.TREES_DIR
+    # Names of the symlinks to the published and previously published trees, in the bank trees directory
+    CURRENT_TREE = 'current'
+    PREVIOUS_TREE = 'previous'
     # This creates a clone of the source directory (files and subdirs) into target
     CLONE_DIRS = {'index': [{'source': 'bowtie'}, {'source': 'bwa'}, {'source': 'gatk'}, {'source': 'picard'},
                             {'source': 'samtools'}, {'source': 'fusioncatcher'}, {'source': 'golden'},
@@ -74,6 +93,27 @@ class Links(object):
         bank_data_dir = self.manager.get_current_link()
         self.bank_data_dir = bank_data_dir
         self.created_links = 0
+        self.removed_links = 0
+        # Lock used to update counters and snapshots from workers
+        self.lock = threading.Lock()
+        # Entries of the target directories, read once with scandir. Directory path as key,
+        # {entry name: is symlink} as value
+        self.snapshots = {}
+        # Plan being built, see build_plan
+        self.plan = None
+        # Entries planned but not created yet, same layout as snapshots
+        self.planned = {}
+        # Check existing entries on disk while building a plan
+        self.check_existing = True
+        # Links requested again while building the plan, see check_links
+        self.duplicates = 0
+        # Relative link sources, computed once per source directory
+        self.writer = LinkWriter()
+        # Links inventory, links created by apply_plan are recorded once the plan is applied
+        self.inventory = LinkInventory()
+        self.records = []
+        # Changes of the links of 'production.dir' computed by stage for publish, see _get_public_links
+        self.publication = None
 
     def add_link(self, inc=1):
         """
@@ -84,24 +124,96 @@ class Links(object):
         :return: Number of links "virtually" created
         :rtype: int
         """
-        self.created_links += inc
+        with self.lock:
+            self.created_links += inc
+            return self.created_links
+
+    def apply_plan(self, plan, workers=None):
+        """
+        Create the directories and links of a plan
+
+        Operations are split into groups by target directory (e.g. 'index/blast2', 'ftp'), groups are applied
+        in parallel. Entries already created since the plan has been built are skipped and not counted.
+        A group stops at its first error, other groups are completed and all the errors are reported.
+
+        :param plan: Plan to apply
+        :type plan: :class:`biomajmanager.links.LinkPlan`
+        :param workers: Number of workers, default :py:func:`get_workers`
+        :type workers: int
+        :return: Number of created links
+        :rtype: int
+        :raises SystemExit: If plan has been built for another bank
+        :raises SystemExit: If a directory or a link cannot be created
+        """
+        if plan.bank is not None and plan.bank != self.bank_name:
+            Utils.error("[%s] Link plan has been built for bank %s" % (self.bank_name, plan.bank))
+        groups = self._get_groups(plan)
+        if workers is None:
+            workers = self.get_workers()
+        if workers < 2 or len(groups) < 2:
+            results = [self._apply_group(group) for group in groups]
+        else:
+            pool = ThreadPool(min(workers, len(groups)))
+            try:
+                results = pool.map(self._apply_group, groups)
+            finally:
+                pool.close()
+                pool.join()
+        self._save_records()
+        failed = [(group, error) for group, error in results if error is not None]
+        if failed:
+            for group, error in failed:
+                Utils.warn("[%s] Links of %s not completed: %s" % (self.bank_name, group, error))
+            Utils.error("[%s] %d link group(s) failed: %s" % (self.bank_name, len(failed),
+                                                              ', '.join([group for group, _ in failed])))
         return self.created_links
 
-    def check_links(self, **kwargs):
+    def build_plan(self, dirs=None, files=None, clone_dirs=None, existing=True):
+        """
+        Build the plan of the directories and links to create, nothing is created on disk
+
+        Simulate and verbose modes are left untouched. See :py:func:`do_links` for parameters.
+
+        :param existing: Leave out directories and links already on disk. If False, the plan lists all
+                         the directories and links of the release
+        :type existing: bool
+        :return: Link plan
+        :rtype: :class:`biomajmanager.links.LinkPlan`
+        """
+        self.plan = LinkPlan(bank=self.bank_name, release=self.manager.current_release())
+        self.planned = {}
+        self.check_existing = existing
+        self.duplicates = 0
+        try:
+            self._walk(dirs=dirs, files=files, clone_dirs=clone_dirs)
+            plan = self.plan
+        finally:
+            self.plan = None
+            self.planned = {}
+            self.check_existing = True
+        return plan
+
+    def check_links(self, save=None, **kwargs):
         """
         Check if some link(s) need to be (re)created.
 
-        It uses :py:func:`do_links` and set simulate and verbose mode to True
+        It uses :py:func:`build_plan`, see :py:func:`do_links` for other parameters. A link requested twice
+        (e.g. by 'clone_dirs' and 'files') is created once, but counted twice.
 
-        :return: Number of links "virtually" created
+        :param save: File to save the link plan to, it can then be applied with :py:func:`do_links`
+        :type save: str
+        :return: Number of links to create
         :rtype: int
+        :raises SystemExit: If user noth allowed to create link, see :py:data:`global.properties:admin`
         """
-        Manager.set_simulate(True)
-        Manager.set_verbose(False)
-        self.do_links(**kwargs)
+        self._check_user()
+        plan = self.build_plan(**kwargs)
+        if save is not None:
+            plan.save(save)
+        self.created_links = len(plan.get_links()) + self.duplicates
         return self.created_links
 
-    def do_links(self, dirs=None, files=None, clone_dirs=None):
+    def do_links(self, dirs=None, files=None, clone_dirs=None, plan=None, workers=None):
         """
         Create a list of links
 
@@ -111,46 +223,376 @@ class Links(object):
         :type files: dict {'source1': ['target1','target2', ...], 'source2': [], ...},
         :param clone_dirs: Directory to clone
         :type clone_dirs: dict
+        :param plan: Link plan to apply, built by :py:func:`build_plan`. If given, 'dirs', 'files' and
+                     'clone_dirs' are not used
+        :type plan: :class:`biomajmanager.links.LinkPlan`
+        :param workers: Number of workers used to create links, default :py:func:`get_workers`
+        :type workers: int
         :return: Number of created links
         :rtype: int
         :raises SystemExit: If user noth allowed to create link, see :py:data:`global.properties:admin`
         """
-        props = self.manager.bank.get_properties()
-        admin = None
-        if 'owner' in props and props['owner']:
-            admin = props['owner']
-        if Utils.user() != admin:
-            Utils.error("%s is not allowed to create link(s)" % Utils.user())
+        self._check_user()
+        if plan is None:
+            plan = self.build_plan(dirs=dirs, files=files, clone_dirs=clone_dirs)
+        if Manager.get_simulate():
+            self._show_plan(plan)
+            return self.add_link(inc=len(plan.get_links()))
+        self.apply_plan(plan, workers=workers)
+        if plan.get_links():
+            manifest = self.load_manifest()
+            links = manifest['links'] if manifest is not None else {}
+            links.update(self._get_manifest_links(plan))
+            self.save_manifest(links, release=plan.release)
+        return self.created_links
 
-        # Our default internal use
-        if dirs is None:
-            dirs = Links.DIRS
-        # EXPERIMENTAL AS OF 12 May 2016, New Structure for BioMAJ Links
-        if clone_dirs is None:
-            clone_dirs = Links.CLONE_DIRS
-        if files is None:
-            files = {
-                'golden': [{'target': 'index/golden'}],
-                'blast2': [{'target': 'fasta'}, {'target': 'index/blast2'}],
-                'hmmer': [{'target': 'index/hmmer'}],
-                'fasta': [{'target': 'fasta', 'remove_ext': True}],
-                'bdb': [{'target': 'index/bdb', 'remove_ext': True}]
-            }
+    def get_workers(self):
+        """
+        Get the number of workers used to create links in parallel ('links.workers', section MANAGER)
 
-        for target, sources in list(clone_dirs.items()):
+        :return: Number of workers, default :py:const:`Links.WORKERS`
+        :rtype: int
+        :raises SystemExit: If 'links.workers' is not a positive integer
+        """
+        workers = Links.WORKERS
+        if self.manager.config.has_option('MANAGER', 'links.workers'):
+            try:
+                workers = int(self.manager.config.get('MANAGER', 'links.workers'))
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                Utils.error("'links.workers' must be a positive integer, got '%s'" %
+                            self.manager.config.get('MANAGER', 'links.workers'))
+        return workers
+
+    def get_manifest_file(self):
+        """
+        Get the path of the bank links manifest
+
+        :return: Path to the manifest file
+        :rtype: str
+        """
+        return os.path.join(self.prod_dir, Links.MANIFEST_DIR, self.bank_name + '.json')
+
+    @staticmethod
+    def get_target_dirs():
+        """
+        Get the directories links are created into, from :py:const:`Links.DIRS` and :py:const:`Links.CLONE_DIRS`
+
+        :return: Sorted list of directories, relative to 'production.dir'
+        :rtype: list
+        """
+        targets = set()
+        for dirs in Links.DIRS.values():
+            for ddir in dirs:
+                targets.add(ddir['target'])
+        for target, sources in Links.CLONE_DIRS.items():
             for source in sources:
-                self._clone_structure(target=target, **source)
+                targets.add(os.path.join(target, source['source']))
+        return sorted(targets)
 
-        for source, targets in list(dirs.items()):
-            for target in targets:
-                self._generate_dir_link(source=source, **target)
+    def get_tree_dir(self, name=None):
+        """
+        Get the path of a staged links tree
 
-        for source, targets in list(files.items()):
-            for target in targets:
-                self._generate_files_link(source=source, **target)
+        :param name: Tree name, see :py:func:`stage`. If None, path of the bank trees directory
+        :type name: str
+        :return: Path to the tree
+        :rtype: str
+        """
+        path = os.path.join(self.prod_dir, Links.TREES_DIR, self.bank_name)
+        if name is None:
+            return path
+        return os.path.join(path, name)
+
+    def load_manifest(self):
+        """
+        Load the bank links manifest, listing the links created by :py:func:`do_links` and :py:func:`reconcile`
 
+        :return: {'bank': name, 'release': release, 'links': {link path relative to 'production.dir':
+                 {'op': 'symlink'|'hardlink', 'source': link source}}} or None if no manifest found
+        :rtype: dict
+        :raises SystemExit: If manifest file cannot be read
+        """
+        manifest_file = self.get_manifest_file()
+        if not os.path.isfile(manifest_file):
+            return None
+        try:
+            with open(manifest_file) as fin:
+                manifest = json.load(fin)
+        except (IOError, ValueError) as err:
+            Utils.error("[%s] Can't read links manifest %s: %s" % (self.bank_name, manifest_file, str(err)))
+        if 'links' not in manifest:
+            Utils.error("[%s] Not a valid links manifest: %s" % (self.bank_name, manifest_file))
+        return manifest
+
+    def publish(self, name):
+        """
+        Publish a links tree built with :py:func:`stage`
+
+        The bank trees 'current' symlink is switched to the tree with an atomic rename, the previously published tree
+        is kept as 'previous' for :py:func:`rollback`. Then the links of 'production.dir' are updated to go through
+        'current': only the links new in the tree are created, links no more part of the tree are removed.
+        These changes are computed by :py:func:`stage`, so publishing does not read the trees nor 'production.dir'.
+
+        :param name: Tree name, as returned by :py:func:`stage`
+        :type name: str
+        :return: Number of links created into 'production.dir', removed links are counted into 'removed_links'
+        :rtype: int
+        :raises SystemExit: If user noth allowed to create link, see :py:data:`global.properties:admin`
+        :raises SystemExit: If tree has not been staged
+        :raises SystemExit: If a link cannot be created or removed
+        """
+        self._check_user()
+        if not os.path.isdir(self.get_tree_dir(name)):
+            Utils.error("[%s] No links tree staged for %s" % (self.bank_name, name))
+        current = self._get_tree(Links.CURRENT_TREE)
+        if current == name:
+            Utils.warn("[%s] Links tree %s already published" % (self.bank_name, name))
+            return self.created_links
+        previous = self._get_tree(Links.PREVIOUS_TREE)
+        if Manager.get_simulate():
+            if Manager.get_verbose():
+                Utils.verbose("[%s] Publishing links tree %s" % (self.bank_name, name))
+            return self.created_links
+        changes = self.publication
+        # Tree staged by another Links or published tree changed since stage
+        if changes is None or changes['tree'] != name or changes['previous'] != current:
+            changes = self._get_public_links(name, current)
+        self.publication = None
+        self._switch_tree(Links.CURRENT_TREE, name)
+        if current is not None:
+            self._switch_tree(Links.PREVIOUS_TREE, current)
+        self._update_public_links(changes)
+        # Only 'current' and 'previous' trees are kept
+        if previous is not None and previous not in [name, current]:
+            shutil.rmtree(self.get_tree_dir(previous), ignore_errors=True)
         return self.created_links
 
+    def reconcile(self, dirs=None, files=None, clone_dirs=None):
+        """
+        Update the links of the bank from the links manifest, see :py:func:`do_links` for parameters
+
+        The links of the release are compared with the links recorded in the manifest. Only new or changed links
+        are created, and links of the manifest no more part of the release are removed. Without a manifest, all
+        the links are created as with :py:func:`do_links`.
+
+        :return: Number of created links, removed links are counted into 'removed_links'
+        :rtype: int
+        :raises SystemExit: If user noth allowed to create link, see :py:data:`global.properties:admin`
+        :raises SystemExit: If a link cannot be created or removed
+        """
+        self._check_user()
+        release = self.build_plan(dirs=dirs, files=files, clone_dirs=clone_dirs, existing=False)
+        manifest = self.load_manifest()
+        previous = manifest['links'] if manifest is not None else {}
+        links = self._get_manifest_links(release)
+
+        stale = sorted([link for link in previous if links.get(link) != previous[link]])
+        changed = set([link for link in links if previous.get(link) != links[link]])
+        needed_dirs = set([os.path.dirname(os.path.join(self.prod_dir, link)) for link in changed])
+        plan = LinkPlan(bank=release.bank, release=release.release)
+        for operation in release.get_dirs():
+            if operation['target'].rstrip(os.sep) in needed_dirs:
+                plan.add_dir(operation['target'])
+        for operation in release.get_links():
+            if os.path.relpath(operation['target'], self.prod_dir) in changed:
+                plan.add_link(operation['source'], operation['target'], hard=operation['op'] == LinkPlan.HARDLINK)
+
+        if Manager.get_simulate():
+            for link in stale:
+                if Manager.get_verbose():
+                    Utils.verbose("[%s] Removing link %s" % (self.bank_name, os.path.join(self.prod_dir, link)))
+            self.removed_links += len(stale)
+            self._show_plan(plan)
+            return self.add_link(inc=len(plan.get_links()))
+
+        for link in stale:
+            path = os.path.join(self.prod_dir, link)
+            try:
+                if os.path.islink(path) or previous[link]['op'] == LinkPlan.HARDLINK:
+                    os.remove(path)
+                    self.removed_links += 1
+                    self.snapshots.pop(os.path.dirname(path), None)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    Utils.error("[%s] Can't remove link %s: %s" % (self.bank_name, path, str(err)))
+        self.inventory.remove(stale)
+        self.apply_plan(plan)
+        self.save_manifest(links, release=release.release)
+        return self.created_links
+
+    def rollback(self):
+        """
+        Publish back the previously published links tree, see :py:func:`publish`
+
+        :return: Number of links created into 'production.dir', removed links are counted into 'removed_links'
+        :rtype: int
+        :raises SystemExit: If user noth allowed to create link, see :py:data:`global.properties:admin`
+        :raises SystemExit: If there is no previous tree
+        :raises SystemExit: If a link cannot be created or removed
+        """
+        self._check_user()
+        previous = self._get_tree(Links.PREVIOUS_TREE)
+        if previous is None or not os.path.isdir(self.get_tree_dir(previous)):
+            Utils.error("[%s] No previous links tree to roll back to" % self.bank_name)
+        current = self._get_tree(Links.CURRENT_TREE)
+        if Manager.get_simulate():
+            if Manager.get_verbose():
+                Utils.verbose("[%s] Rolling back links tree %s to %s" % (self.bank_name, current, previous))
+            return self.created_links
+        changes = self._get_public_links(previous, current)
+        self._switch_tree(Links.CURRENT_TREE, previous)
+        self._switch_tree(Links.PREVIOUS_TREE, current)
+        self._update_public_links(changes)
+        return self.created_links
+
+    def save_manifest(self, links, release=None):
+        """
+        Save the bank links manifest
+
+        :param links: Links, path relative to 'production.dir' as key and {'op': op, 'source': source} as value
+        :type links: dict
+        :param release: Bank release the links are created for
+        :type release: str
+        :return: Path to the manifest file
+        :rtype: str
+        :raises SystemExit: If manifest file cannot be written
+        """
+        manifest_file = self.get_manifest_file()
+        try:
+            if not os.path.isdir(os.path.dirname(manifest_file)):
+                os.makedirs(os.path.dirname(manifest_file))
+            # Write a temporary file renamed afterwards, a manifest is never partially written
+            with open(manifest_file + '.tmp', 'w') as fout:
+                json.dump({'bank': self.bank_name, 'release': release, 'links': links}, fout)
+            os.rename(manifest_file + '.tmp', manifest_file)
+        except (IOError, OSError) as err:
+            Utils.error("[%s] Can't write links manifest %s: %s" % (self.bank_name, manifest_file, str(err)))
+        return manifest_file
+
+    def stage(self, production, dirs=None, files=None, clone_dirs=None, workers=None):
+        """
+        Build the links tree of a release into the bank trees directory, nothing published is changed
+
+        The tree has the layout of 'production.dir' and its links point to the release directory, not to the bank
+        'current' link, so it can be built before the release is published. The changes of the links of
+        'production.dir' are computed too, :py:func:`publish` only applies them. See :py:func:`do_links` for
+        parameters.
+
+        :param production: Production document of the release, from the database
+        :type production: dict
+        :return: Tree name, to give to :py:func:`publish`
+        :rtype: str
+        :raises SystemExit: If user noth allowed to create link, see :py:data:`global.properties:admin`
+        :raises SystemExit: If 'data_dir' or 'prod_dir' missing in production document
+        :raises SystemExit: If tree is the published or the previously published one
+        """
+        self._check_user()
+        if 'data_dir' not in production or 'prod_dir' not in production:
+            Utils.error("[%s] Can't stage links, 'prod_dir' or 'data_dir' missing in production document field"
+                        % self.bank_name)
+        name = production['prod_dir']
+        if name in [Links.CURRENT_TREE, Links.PREVIOUS_TREE, self._get_tree(Links.CURRENT_TREE),
+                    self._get_tree(Links.PREVIOUS_TREE)]:
+            Utils.error("[%s] Can't stage links tree %s, it is in use" % (self.bank_name, name))
+        tree = self.get_tree_dir(name)
+
+        bank_data_dir = self.bank_data_dir
+        self.bank_data_dir = os.path.join(production['data_dir'], production.get('dir_version', self.bank_name), name)
+        try:
+            release = self.build_plan(dirs=dirs, files=files, clone_dirs=clone_dirs, existing=False)
+        finally:
+            self.bank_data_dir = bank_data_dir
+        plan = LinkPlan(bank=self.bank_name, release=production.get('release', release.release))
+        for operation in release:
+            target = os.path.join(tree, os.path.relpath(operation['target'], self.prod_dir))
+            if operation['op'] == LinkPlan.MKDIR:
+                plan.add_dir(target)
+            elif operation['op'] == LinkPlan.HARDLINK:
+                plan.add_link(operation['source'], target, hard=True)
+            else:
+                source = os.path.join(os.path.dirname(operation['target']), operation['source'])
+                plan.add_link(self.writer.relative(source, os.path.dirname(target)), target)
+
+        if Manager.get_simulate():
+            self._show_plan(plan)
+            self.add_link(inc=len(plan.get_links()))
+            return name
+        # Tree staged again
+        if os.path.isdir(tree):
+            shutil.rmtree(tree)
+        self._makedirs(tree)
+        self.apply_plan(plan, workers=workers)
+        self.publication = self._get_public_links(name, self._get_tree(Links.CURRENT_TREE))
+        return name
+
+    def _add_entry(self, path, symlink=False):
+        """
+        Add an entry created by Links to the snapshot of its directory, if this directory has been read
+
+        :param path: Path of the created entry
+        :type path: str
+        :param symlink: Entry is a symbolic link
+        :type symlink: bool
+        :return: True
+        :rtype: bool
+        """
+        dir_path, name = Links._split(path)
+        with self.lock:
+            if dir_path in self.snapshots:
+                self.snapshots[dir_path][name] = symlink
+        return True
+
+    def _add_planned(self, path, symlink=False):
+        """
+        Record an entry planned by :py:func:`build_plan`, it is considered as existing while building the plan
+
+        :param path: Path of the planned entry
+        :type path: str
+        :param symlink: Entry is a symbolic link
+        :type symlink: bool
+        :return: True
+        :rtype: bool
+        """
+        dir_path, name = Links._split(path)
+        self.planned.setdefault(dir_path, {})[name] = symlink
+        return True
+
+    def _apply_group(self, group):
+        """
+        Create the directories and links of a group of operations, stops at first error
+
+        :param group: Tuple (group name, list of operations)
+        :type group: tuple
+        :return: Tuple (group name, error message or None)
+        :rtype: tuple
+        """
+        name, operations = group
+        # Each group has its own writer, target directories are opened once per worker
+        with LinkWriter() as writer:
+            for operation in operations:
+                target = operation['target']
+                if operation['op'] == LinkPlan.MKDIR:
+                    try:
+                        self._makedirs(target)
+                    except OSError as err:
+                        if err.errno != errno.EEXIST:
+                            return name, "Can't create %s dir: %s" % (target, str(err))
+                    continue
+                hard = operation['op'] == LinkPlan.HARDLINK
+                try:
+                    writer.link(operation['source'], target, hard=hard)
+                except OSError as err:
+                    if err.errno == errno.EEXIST:
+                        continue
+                    return name, "Can't create %slink %s: %s" % ('hard ' if hard else 'sym', target, str(err))
+                self._add_entry(target, symlink=not hard)
+                with self.lock:
+                    self.records.append((target, operation['op'], operation['source']))
+                self.add_link()
+        return name, None
+
     def _check_source_target_parameters(self, source=None, target=None):
         """
         Check all parameters are set and ok to prepare link building
@@ -171,9 +613,25 @@ class Links(object):
             Utils.error("target required")
         return True
 
+    def _check_user(self):
+        """
+        Check the current user is the owner of the bank
+
+        :return: True
+        :rtype: bool
+        :raises SystemExit: If user noth allowed to create link, see :py:data:`global.properties:admin`
+        """
+        props = self.manager.bank.get_properties()
+        admin = None
+        if 'owner' in props and props['owner']:
+            admin = props['owner']
+        if Utils.user() != admin:
+            Utils.error("%s is not allowed to create link(s)" % Utils.user())
+        return True
+
     def _clone_structure(self, source=None, target=None, remove_ext=False, limit=0):
         """
-        Create a directory structure from a source to a target point and link all files from source inside target
+        Plan a directory structure from a source to a target point and the links of all files from source inside target
 
         :param source: Source directory to clone
         :type source: str
@@ -181,7 +639,7 @@ class Links(object):
         :type target: str
         :param remove_ext: Create another link of the file without the file name extension
         :type remove_ext: bool
-        :param limit: Limit subtree seach to value, default 0, no limit
+        :param limit: Limit subtree search to `limit` depth, default 0, no limit
         :tpye limit: int
         :return: True if structure cloning build OK, throws otherwise
         :rtype: bool
@@ -189,21 +647,16 @@ class Links(object):
         """
         self._check_source_target_parameters(source=source, target=target)
         # Check do_links.clone_dirs. As we want to recreate the same architecture as for the source,
-        # we need to recreate the target because Utils.get_subtree removes the source path which contains
-        # the target name
+        # we need to recreate the target because Utils.iter_dirs gives paths relative to the source path which
+        # contains the target name
         target = os.path.join(target, source)
         source = os.path.join(self.bank_data_dir, source)
-        subtrees = Utils.get_subtree(path=source, limit=limit)
 
         try:
-            for subtree in subtrees:
+            for subtree in Utils.iter_dirs(source, max_depth=limit):
                 end_target = os.path.join(self.prod_dir, target, subtree)
-                if not os.path.exists(end_target) and not os.path.isdir(end_target):
-                    if Manager.get_simulate() and Manager.get_verbose():
-                        Utils.verbose("[_clone_structure] [%s] Creating directory %s" % (self.bank_name, end_target))
-                    else:
-                        if not Manager.get_simulate():
-                            os.makedirs(end_target)
+                if not self._exists(end_target):
+                    self._makedirs(end_target)
 
                 sub_files = Utils.get_files(path=os.path.join(source, subtree))
                 if len(sub_files) == 0:
@@ -237,9 +690,31 @@ class Links(object):
 
         return True
 
+    def _exists(self, path):
+        """
+        Check a path exists, same as :py:func:`os.path.exists` using the snapshot of its parent directory
+
+        :param path: Path to check
+        :type path: str
+        :return: Boolean
+        :rtype: bool
+        """
+        dir_path, name = Links._split(path)
+        if name in self.planned.get(dir_path, {}):
+            return True
+        if not self.check_existing:
+            return False
+        entries = self._get_snapshot(dir_path)
+        if name not in entries:
+            return False
+        # A symlink exists only if what it points to exists
+        if entries[name]:
+            return os.path.exists(path)
+        return True
+
     def _generate_dir_link(self, source=None, target=None, hard=False, fallback=None, requires=None, limit=0):
         """
-        Create a symbolic link between 'source' and 'target' for a directory
+        Plan a symbolic link between 'source' and 'target' for a directory
 
         :param source: Source directory to link
         :type source: str
@@ -253,7 +728,7 @@ class Links(object):
         :type requires: str
         :param limit: Limit deepest search to `limit` depth, default 0, no limit
         :type limit: int
-        :return: Number of created link(s)
+        :return: Number of links in the plan
         :rtype: int
         """
         if not self._prepare_links(source=source, target=target, fallback=fallback,
@@ -263,15 +738,11 @@ class Links(object):
         slink = os.path.join(self.source)
         tlink = os.path.join(self.target, self.manager.bank.name)
 
-        self._make_links(links=[(slink, tlink)], hard=hard)
-
-        if Manager.get_simulate() and Manager.get_verbose():
-            Utils.verbose("%s -> %s directory link done" % (self.target, self.source))
-        return self.created_links
+        return self._make_links(links=[(slink, tlink)], hard=hard)
 
     def _generate_files_link(self, source=None, target=None, remove_ext=False):
         """
-        Links list of file from 'source' to 'target' directory.
+        Plan the links of the files from 'source' to 'target' directory.
 
         If remove_ext is set to True, then another link is created. This link is the same as the
         target link, without the file extension
@@ -282,7 +753,7 @@ class Links(object):
         :type target: str
         :param remove_ext: Create another link of the file without the file name extension
         :type remove_ext: bool (default False)
-        :return: Number of created link(s)
+        :return: Number of links in the plan
         :rtype: int
         """
         if not self._prepare_links(source=source, target=target, get_deepest=True):
@@ -310,44 +781,208 @@ class Links(object):
                     Utils.verbose("[_generate_files_link] [rm_ext=%s] append slink %s" % (str(remove_ext), slink))
                     Utils.verbose("[_generate_files_link] [rm_ext=%s] append tlink %s" % (str(remove_ext), tlink))
 
-        self._make_links(links=links)
+        return self._make_links(links=links)
 
-        if Manager.get_simulate() and Manager.get_verbose():
-            Utils.verbose("%s -> %s file link done" % (self.target, self.source))
-        return self.created_links
+    def _get_tree(self, link):
+        """
+        Get the name of the tree a bank trees symlink points to
+
+        :param link: Symlink name, :py:const:`Links.CURRENT_TREE` or :py:const:`Links.PREVIOUS_TREE`
+        :type link: str
+        :return: Tree name or None
+        :rtype: str
+        """
+        path = self.get_tree_dir(link)
+        if not os.path.islink(path):
+            return None
+        return os.readlink(path)
+
+    def _get_tree_links(self, name):
+        """
+        Get the links of a staged tree
+
+        :param name: Tree name
+        :type name: str
+        :return: Link path relative to the tree as key, True for a symlink and False for a hard link as value
+        :rtype: dict
+        """
+        links = {}
+        tree = self.get_tree_dir(name)
+        for root, dirs, files in os.walk(tree):
+            for entry in dirs + files:
+                path = os.path.join(root, entry)
+                symlink = os.path.islink(path)
+                if symlink or entry in files:
+                    links[os.path.relpath(path, tree)] = symlink
+        return links
+
+    def _get_groups(self, plan):
+        """
+        Split the operations of a plan by target directory, two levels below 'production.dir' at most
+
+        :param plan: Link plan
+        :type plan: :class:`biomajmanager.links.LinkPlan`
+        :return: List of tuples (group name, list of operations), operations order is kept
+        :rtype: list
+        """
+        groups = []
+        operations = {}
+        for operation in plan:
+            path = operation['target'].rstrip(os.sep)
+            if operation['op'] != LinkPlan.MKDIR:
+                path = os.path.dirname(path)
+            name = os.sep.join(os.path.relpath(path, self.prod_dir).split(os.sep)[:2])
+            if name not in operations:
+                operations[name] = []
+                groups.append((name, operations[name]))
+            operations[name].append(operation)
+        return groups
+
+    def _get_manifest_links(self, plan):
+        """
+        Get the links of a plan, as recorded into the links manifest
+
+        :param plan: Link plan
+        :type plan: :class:`biomajmanager.links.LinkPlan`
+        :return: Link path relative to 'production.dir' as key, {'op': op, 'source': source} as value
+        :rtype: dict
+        """
+        links = {}
+        for operation in plan.get_links():
+            links[os.path.relpath(operation['target'], self.prod_dir)] = {'op': operation['op'],
+                                                                          'source': operation['source']}
+        return links
+
+    def _get_public_links(self, name, previous=None):
+        """
+        Get the changes of the links of 'production.dir' needed to publish a tree
+
+        Symlinks of the tree are published as symlinks through the bank trees 'current' symlink, they only need
+        to be created once. Hard links of the tree are hard linked again. Links of the previous tree no more part
+        of the published one are removed.
+
+        :param name: Tree name to publish
+        :type name: str
+        :param previous: Tree name published before
+        :type previous: str
+        :return: {'tree': name, 'previous': previous, 'create': list of (link, symlink, source),
+                 'records': inventory records, 'remove': list of links}, links relative to 'production.dir'
+        :rtype: dict
+        """
+        current = self.get_tree_dir(Links.CURRENT_TREE)
+        links = self._get_tree_links(name)
+        changes = {'tree': name, 'previous': previous, 'create': [], 'records': [], 'remove': []}
+        # All the links of the tree now point into its release directory
+        for link in sorted(links):
+            path = os.path.join(self.prod_dir, link)
+            source = os.path.relpath(os.path.join(current, link), os.path.dirname(path))
+            if links[link]:
+                changes['records'].append((link, name, LinkPlan.SYMLINK, source))
+            else:
+                changes['records'].append((link, name, LinkPlan.HARDLINK, os.path.join(self.get_tree_dir(name), link)))
+            if links[link] and os.path.islink(path) and os.readlink(path) == source:
+                continue
+            changes['create'].append((link, links[link], source))
+
+        if previous is None or not os.path.isdir(self.get_tree_dir(previous)):
+            return changes
+        for link, symlink in self._get_tree_links(previous).items():
+            if link in links:
+                continue
+            path = os.path.join(self.prod_dir, link)
+            if symlink:
+                published = os.path.islink(path) and \
+                    os.readlink(path) == os.path.relpath(os.path.join(current, link), os.path.dirname(path))
+            else:
+                published = os.path.isfile(path) and \
+                    os.path.samefile(path, os.path.join(self.get_tree_dir(previous), link))
+            if published:
+                changes['remove'].append(link)
+        return changes
+
+    def _get_snapshot(self, path):
+        """
+        Get the entries of a directory, read once with scandir
+
+        :param path: Directory path
+        :type path: str
+        :return: Entry name as key, True if entry is a symlink as value. Empty if directory does not exist
+        :rtype: dict
+        """
+        if path not in self.snapshots:
+            entries = {}
+            try:
+                for entry in scandir(path):
+                    entries[entry.name] = entry.is_symlink()
+            except OSError:
+                pass
+            self.snapshots[path] = entries
+        return self.snapshots[path]
+
+    def _lexists(self, path):
+        """
+        Check a path exists, even as a broken symlink, using the snapshot of its parent directory
+
+        :param path: Path to check
+        :type path: str
+        :return: Boolean
+        :rtype: bool
+        """
+        dir_path, name = Links._split(path)
+        if name in self.planned.get(dir_path, {}):
+            return True
+        return self.check_existing and name in self._get_snapshot(dir_path)
 
     def _make_links(self, links=None, hard=False):
         """
-        Try to create the links (symbolic or hard)
+        Add the links (symbolic or hard) to the plan being built, links are created by :py:func:`apply_plan`
 
         :param links: List of links to create
         :type links: list
         :param hard: Create hard link
         :type hard: boole
-        :return: Number of created link(s)
+        :return: Number of links in the plan
         :rtype: int
-        :raises SystemExit: If link(s) cannot be created
         """
         if not links or not len(links):
             return 0
 
         for slink, tlink in links:
-            if not os.path.exists(tlink) and not os.path.islink(tlink):
-                if Manager.get_simulate() and Manager.get_verbose():
-                    Utils.verbose("Linking %s -> %s" % (tlink, os.path.relpath(slink, start=self.target)))
-                else:
-                    try:
-                        if not Manager.get_simulate():
-                            source_link = os.path.relpath(slink, start=self.target)
-                            if hard:
-                                os.link(source_link, tlink)
-                            else:
-                                os.symlink(source_link, tlink)
-                    except OSError as err:
-                        Utils.error("[%s] Can't create %slink %s: %s" %
-                                    (self.manager.bank.name, 'hard ' if hard else 'sym', tlink, str(err)))
-                    self.add_link()
-        return self.created_links
+            dir_path, name = Links._split(tlink)
+            if name in self.planned.get(dir_path, {}):
+                # Link requested twice, planned once but counted twice by check_links
+                self.duplicates += 1
+            elif not self._lexists(tlink):
+                # Symlinks are relative to the link directory, hard links need the real file path
+                self.plan.add_link(slink if hard else self.writer.relative(slink, self.target), tlink, hard=hard)
+                self._add_planned(tlink, symlink=not hard)
+        return len(self.plan.get_links())
+
+    def _makedirs(self, path):
+        """
+        Create a directory and its parents, updating the snapshots. While building a plan, the directory is
+        only added to the plan
+
+        :param path: Directory path
+        :type path: str
+        :return: True
+        :rtype: bool
+        :raises OSError: If directory cannot be created
+        """
+        if self.plan is not None:
+            self.plan.add_dir(path)
+            self._add_planned(path)
+            return True
+        os.makedirs(path)
+        path = path.rstrip(os.sep)
+        with self.lock:
+            self.snapshots[path] = {}
+            # Parents snapshots are read again on next access
+            parent = os.path.dirname(path)
+            while parent and parent != path:
+                self.snapshots.pop(parent, None)
+                path, parent = parent, os.path.dirname(parent)
+        return True
 
     def _prepare_links(self, source=None, target=None, get_deepest=False, fallback=None, requires=None, limit=0):
         """
@@ -370,7 +1005,6 @@ class Links(object):
         :raises SystemExit: If 'source' or 'target' are None
         :raises SystemExit: If 'data.dir' not set in :py:data:`global.properties`
         :raises SystemExit: If 'production.dir' not set in :py:data:`manager.properties`
-        :raises SystemExit: If 'target' directory cannot be created
         """
         self._check_source_target_parameters(source=source, target=target)
         data_dir = self.bank_data_dir
@@ -402,15 +1036,8 @@ class Links(object):
         target = os.path.join(target_dir, target)
 
         # Check destination directory where to create link(s)
-        if not os.path.exists(target) and not os.path.isdir(target):
-            if Manager.get_simulate() and Manager.get_verbose():
-                Utils.verbose("[_prepare_links] [%s] Creating directory %s" % (bank_name, target))
-            else:
-                try:
-                    if not Manager.get_simulate():
-                        os.makedirs(target)
-                except OSError as err:
-                    Utils.error("[%s] Can't create %s dir: %s" % (bank_name, target, str(err)))
+        if not self._exists(target):
+            self._makedirs(target)
 
         self.source = source
         self.target = target
@@ -418,3 +1045,387 @@ class Links(object):
             Utils.verbose("[prepare_links] source %s" % self.source)
             Utils.verbose("[prepare_links] target %s" % self.target)
         return True
+
+    def _save_records(self):
+        """
+        Record the links created by :py:func:`apply_plan` into the links inventory
+
+        Links are recorded with the bank version directory they point into, 'current' unless the links of a release
+        directory are staged. Links of the staged trees are not recorded.
+
+        :return: Number of recorded links
+        :rtype: int
+        """
+        with self.lock:
+            records = self.records
+            self.records = []
+        version = os.path.basename(self.bank_data_dir.rstrip(os.sep))
+        links = []
+        for path, op, source in records:
+            link = os.path.relpath(path, self.prod_dir)
+            if link.split(os.sep)[0] not in [os.pardir] + Utils.MANAGED_DIRS:
+                links.append((link, version, op, source))
+        return self.inventory.add(self.bank_name, links)
+
+    def _show_plan(self, plan):
+        """
+        Print the operations of a plan, in verbose mode
+
+        :param plan: Link plan
+        :type plan: :class:`biomajmanager.links.LinkPlan`
+        :return: True
+        :rtype: bool
+        """
+        if Manager.get_verbose():
+            for operation in plan:
+                if operation['op'] == LinkPlan.MKDIR:
+                    Utils.verbose("[%s] Creating directory %s" % (self.bank_name, operation['target']))
+                else:
+                    Utils.verbose("Linking %s -> %s" % (operation['target'], operation['source']))
+        return True
+
+    def _switch_tree(self, link, name):
+        """
+        Atomically point a bank trees symlink to a tree, using a temporary symlink renamed over the old one
+
+        :param link: Symlink name, :py:const:`Links.CURRENT_TREE` or :py:const:`Links.PREVIOUS_TREE`
+        :type link: str
+        :param name: Tree name
+        :type name: str
+        :return: True
+        :rtype: bool
+        :raises SystemExit: If symlink cannot be switched
+        """
+        path = self.get_tree_dir(link)
+        try:
+            if os.path.lexists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            os.symlink(name, path + '.tmp')
+            os.rename(path + '.tmp', path)
+        except OSError as err:
+            Utils.error("[%s] Can't switch links tree %s to %s: %s" % (self.bank_name, link, name, str(err)))
+        return True
+
+    def _update_public_links(self, changes):
+        """
+        Update the links of 'production.dir' once a tree has been published
+
+        :param changes: Links changes, see :py:func:`_get_public_links`
+        :type changes: dict
+        :return: Number of created links
+        :rtype: int
+        :raises SystemExit: If a link cannot be created or removed
+        """
+        tree = self.get_tree_dir(changes['tree'])
+        for link, symlink, source in changes['create']:
+            path = os.path.join(self.prod_dir, link)
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                if os.path.lexists(path + '.tmp'):
+                    os.remove(path + '.tmp')
+                if symlink:
+                    os.symlink(source, path + '.tmp')
+                else:
+                    os.link(os.path.join(tree, link), path + '.tmp')
+                # Replaces the link previously created in place, if any
+                os.rename(path + '.tmp', path)
+            except OSError as err:
+                Utils.error("[%s] Can't create link %s: %s" % (self.bank_name, path, str(err)))
+            self.add_link()
+        self.inventory.add(self.bank_name, changes['records'])
+
+        for link in changes['remove']:
+            path = os.path.join(self.prod_dir, link)
+            try:
+                os.remove(path)
+            except OSError as err:
+                Utils.error("[%s] Can't remove link %s: %s" % (self.bank_name, path, str(err)))
+            self.removed_links += 1
+        self.inventory.remove(changes['remove'])
+        return self.created_links
+
+    def _walk(self, dirs=None, files=None, clone_dirs=None):
+        """
+        Go through the directories and files to link, see :py:func:`do_links` for parameters
+
+        :return: True
+        :rtype: bool
+        """
+        # Our default internal use
+        if dirs is None:
+            dirs = Links.DIRS
+        # EXPERIMENTAL AS OF 12 May 2016, New Structure for BioMAJ Links
+        if clone_dirs is None:
+            clone_dirs = Links.CLONE_DIRS
+        if files is None:
+            files = {
+                'golden': [{'target': 'index/golden'}],
+                'blast2': [{'target': 'fasta'}, {'target': 'index/blast2'}],
+                'hmmer': [{'target': 'index/hmmer'}],
+                'fasta': [{'target': 'fasta', 'remove_ext': True}],
+                'bdb': [{'target': 'index/bdb', 'remove_ext': True}]
+            }
+
+        for target, sources in list(clone_dirs.items()):
+            for source in sources:
+                self._clone_structure(target=target, **source)
+
+        for source, targets in list(dirs.items()):
+            for target in targets:
+                self._generate_dir_link(source=source, **target)
+
+        for source, targets in list(files.items()):
+            for target in targets:
+                self._generate_files_link(source=source, **target)
+        return True
+
+    @staticmethod
+    def _split(path):
+        """
+        Split a path into its directory and its entry name, ignoring trailing separator
+
+        :param path: Path to split
+        :type path: str
+        :return: (directory, name)
+        :rtype: tuple
+        """
+        return os.path.split(path.rstrip(os.sep) or os.sep)
+
+
+class LinkPlan(object):
+
+    """Ordered list of the operations (mkdir, symlink, hardlink) needed to create the links of a bank"""
+
+    MKDIR = 'mkdir'
+    SYMLINK = 'symlink'
+    HARDLINK = 'hardlink'
+
+    def __init__(self, bank=None, release=None, operations=None):
+        """
+        Create the plan
+
+        :param bank: Bank name the plan is built for
+        :type bank: str
+        :param release: Bank release the plan is built for
+        :type release: str
+        :param operations: List of operations, {'op': 'mkdir', 'target': path} or
+                           {'op': 'symlink'|'hardlink', 'source': link source, 'target': path}
+        :type operations: list
+        """
+        self.bank = bank
+        self.release = release
+        self.operations = operations if operations is not None else []
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add_dir(self, target):
+        """
+        Add a directory creation
+
+        :param target: Directory path
+        :type target: str
+        :return: Number of operations
+        :rtype: int
+        """
+        self.operations.append({'op': LinkPlan.MKDIR, 'target': target})
+        return len(self.operations)
+
+    def add_link(self, source, target, hard=False):
+        """
+        Add a link creation
+
+        :param source: Link source, relative to the link directory for a symlink, absolute for a hard link
+        :type source: str
+        :param target: Link path
+        :type target: str
+        :param hard: Create hard link
+        :type hard: bool
+        :return: Number of operations
+        :rtype: int
+        """
+        self.operations.append({'op': LinkPlan.HARDLINK if hard else LinkPlan.SYMLINK,
+                                'source': source, 'target': target})
+        return len(self.operations)
+
+    def get_dirs(self):
+        """
+        Get the directories creations
+
+        :return: List of operations
+        :rtype: list
+        """
+        return [operation for operation in self.operations if operation['op'] == LinkPlan.MKDIR]
+
+    def get_links(self):
+        """
+        Get the links creations
+
+        :return: List of operations
+        :rtype: list
+        """
+        return [operation for operation in self.operations if operation['op'] != LinkPlan.MKDIR]
+
+    @staticmethod
+    def from_json(data):
+        """
+        Create a plan from its json serialization
+
+        :param data: Json string, see :py:func:`to_json`
+        :type data: str
+        :return: Link plan
+        :rtype: :class:`biomajmanager.links.LinkPlan`
+        :raises SystemExit: If data is not a valid link plan
+        """
+        try:
+            plan = json.loads(data)
+            return LinkPlan(bank=plan.get('bank'), release=plan.get('release'), operations=plan['operations'])
+        except (ValueError, KeyError, AttributeError) as err:
+            Utils.error("Not a valid link plan: %s" % str(err))
+
+    @staticmethod
+    def load(path):
+        """
+        Load a plan from a file
+
+        :param path: File path
+        :type path: str
+        :return: Link plan
+        :rtype: :class:`biomajmanager.links.LinkPlan`
+        :raises SystemExit: If file cannot be read or is not a valid link plan
+        """
+        try:
+            with open(path) as fin:
+                return LinkPlan.from_json(fin.read())
+        except IOError as err:
+            Utils.error("Can't read link plan %s: %s" % (path, str(err)))
+
+    def save(self, path):
+        """
+        Save the plan into a file, as json
+
+        :param path: File path
+        :type path: str
+        :return: True
+        :rtype: bool
+        :raises SystemExit: If file cannot be written
+        """
+        try:
+            with open(path, 'w') as fout:
+                fout.write(self.to_json())
+        except IOError as err:
+            Utils.error("Can't write link plan %s: %s" % (path, str(err)))
+        return True
+
+    def to_json(self):
+        """
+        Serialize the plan as json
+
+        :return: Json string
+        :rtype: str
+        """
+        return json.dumps({'bank': self.bank, 'release': self.release, 'operations': self.operations})
+
+
+class LinkWriter(object):
+
+    """
+    Create links with calls relative to their open target directory (dir_fd), each target directory is opened once
+    for all the links created into it, instead of resolving the complete link path for each link.
+
+    Falls back to path based calls if 'dir_fd' is not supported (Python 2).
+    """
+
+    # Links can be created relative to an open directory
+    DIR_FD = hasattr(os, 'supports_dir_fd') and os.symlink in os.supports_dir_fd and os.link in os.supports_dir_fd
+
+    def __init__(self, dir_fd=None):
+        """
+        Create the writer
+
+        :param dir_fd: Use 'dir_fd' calls, default :py:const:`LinkWriter.DIR_FD`
+        :type dir_fd: bool
+        """
+        self.dir_fd = LinkWriter.DIR_FD if dir_fd is None else dir_fd and LinkWriter.DIR_FD
+        # Relative paths of source directories, (source directory, start) as key
+        self.prefixes = {}
+        # Open target directory
+        self.path = None
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the open target directory
+
+        :return: True
+        :rtype: bool
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.path = None
+        return True
+
+    def link(self, source, target, hard=False):
+        """
+        Create a link, opening its directory if it is not the one already open
+
+        :param source: Link source, relative to the link directory for a symlink
+        :type source: str
+        :param target: Link path
+        :type target: str
+        :param hard: Create a hard link
+        :type hard: bool
+        :return: True
+        :rtype: bool
+        :raises OSError: If link cannot be created
+        """
+        if not self.dir_fd:
+            if hard:
+                os.link(source, target)
+            else:
+                os.symlink(source, target)
+            return True
+        path, name = os.path.split(target)
+        if path != self.path:
+            self.close()
+            self.fd = os.open(path or os.curdir, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+            self.path = path
+        if hard:
+            os.link(source, name, dst_dir_fd=self.fd, follow_symlinks=False)
+        else:
+            os.symlink(source, name, dir_fd=self.fd)
+        return True
+
+    def relative(self, path, start):
+        """
+        Same as :py:func:`os.path.relpath`, the relative path of the directory of 'path' is computed once
+
+        :param path: Path
+        :type path: str
+        :param start: Directory the path is made relative to
+        :type start: str
+        :return: Relative path
+        :rtype: str
+        """
+        path_dir, name = os.path.split(path)
+        if not name:
+            return os.path.relpath(path, start)
+        key = (path_dir, start)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            prefix = os.path.relpath(path_dir, start)
+            self.prefixes[key] = prefix
+        if prefix == os.curdir:
+            return name
+        return os.path.join(prefix, name)
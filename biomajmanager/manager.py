@@ -1,4 +1,5 @@
 """Main class of BioMAJ Manager"""
+import copy
 import datetime
 import re
 import os
@@ -7,14 +8,20 @@ import subprocess
 import time
 import humanfriendly
 import shutil
+from multiprocessing.pool import ThreadPool
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
 
 from biomaj.bank import Bank
 from biomaj.workflow import UpdateWorkflow
 from biomaj_core.config import BiomajConfig
-from biomaj.mongo_connector import MongoConnector
+from biomajmanager.bankview import BankView
+from biomajmanager.catalog import FormatCatalog
+from biomajmanager.config import ConfigCache, PropertiesStore
+from biomajmanager.fleet import FleetSnapshot
 from biomajmanager.utils import Utils
 from biomajmanager.plugins import Plugins
-from biomajmanager.decorators import bank_required, user_granted, deprecated
+from biomajmanager.decorators import bank_fields, bank_required, user_granted, deprecated
 try:
     from ConfigParser import Error
 except ImportError:
@@ -29,6 +36,14 @@ class Manager(object):
     simulate = False
     # Verbose mode
     verbose = False
+    # Default number of workers used to process banks in parallel
+    WORKERS = 4
+    # Indexes needed on the 'banks' collection by the manager queries
+    # ('name' alone is covered by the unique index BioMAJ creates)
+    INDEXES = [[('properties.visibility', 1), ('name', 1)],
+               [('name', 1), ('production.release', 1)],
+               [('name', 1), ('production.files_info.name', 1)],
+               [('name', 1), ('sessions.id', 1)]]
     # Default date format string
     SAVE_BANK_LINE_PATTERN = "%-20s\t%-30s\t%-20s\t%-20s\t%-20s\n"
 
@@ -61,6 +76,12 @@ class Manager(object):
         self._next_release = None
         # Previous release of the bank
         self._previous_release = None
+        # Sessions lookup index, keyed by session id
+        self._sessions_index = None
+        # Productions lookup index, keyed by session id and by release
+        self._productions_index = None
+        # Banks formats catalog, shared by formats_available and has_formats
+        self._format_catalog = None
         # Some messages to buffer
         self.messages = []
 
@@ -89,6 +110,9 @@ class Manager(object):
         where the config.dir is. manager.properties must be located at the same place as
         global.properties or file parameter must point to manager.properties
 
+        Configuration is loaded once per process and loaded again only if files changed,
+        see :class:`biomajmanager.config.ConfigCache`.
+
         :param cfg: Path to config file to load
         :type cfg: str
         :param global_cfg:
@@ -97,6 +121,9 @@ class Manager(object):
         :rtype: :class:`configparser.SafeParser`
         :raises SystemExit: If can load configuaration file
         """
+        config = ConfigCache.get_manager_config(cfg=cfg, global_cfg=global_cfg)
+        if config is not None:
+            return config
         # Load global.properties (or user defined global_cfg)
         Utils.verbose("[manager] Loading Biomaj global configuration file")
         try:
@@ -105,14 +132,15 @@ class Manager(object):
             Utils.error("Error while loading biomaj config: %s" % str(err))
 
         conf_dir = os.path.dirname(BiomajConfig.config_file)
-        if not cfg:
-            cfg = os.path.join(conf_dir, 'manager.properties')
-        if not os.path.isfile(cfg):
-            Utils.error("Can't find config file %s" % cfg)
+        manager_cfg = cfg
+        if not manager_cfg:
+            manager_cfg = os.path.join(conf_dir, 'manager.properties')
+        if not os.path.isfile(manager_cfg):
+            Utils.error("Can't find config file %s" % manager_cfg)
 
         Utils.verbose("[manager] Reading manager configuration file")
-        BiomajConfig.global_config.read(cfg)
-        return BiomajConfig.global_config
+        BiomajConfig.global_config.read(manager_cfg)
+        return ConfigCache.set_manager_config(BiomajConfig.global_config, cfg=cfg, global_cfg=global_cfg)
 
     @bank_required
     def bank_info(self):
@@ -125,6 +153,7 @@ class Manager(object):
         return self.bank.get_bank_release_info(full=True)
 
     @bank_required
+    @bank_fields('current')
     def bank_is_published(self):
         """
         Check if a bank is already published or not.
@@ -168,6 +197,7 @@ class Manager(object):
         return True
 
     @bank_required
+    @bank_fields('current', 'production')
     def check_production_size(self, max_release=None):
         """
         Check the number of production(s) release stored in the database.
@@ -190,11 +220,9 @@ class Manager(object):
         # We do not consider the published release 'current'
         if 'current' in self.bank.bank:
             current = self.bank.bank['current']
-        productions = self.bank.bank['production']
-        plen = len(productions)
-        for production in productions:
-            if current and current == production['session']:
-                plen -= 1
+        plen = len(self.bank.bank['production'])
+        if current and current in self._get_productions_index()['session']:
+            plen -= 1
 
         if plen > limit:
             if Manager.get_verbose():
@@ -204,6 +232,69 @@ class Manager(object):
             Utils.ok("[%s] Production release number OK. Entries %d, limit %d" % (self.bank.name, plen, limit))
         return []
 
+    def check_production_sizes(self, max_release=None, banks=None, visibility='public'):
+        """
+        Check the number of production(s) release stored in the database, for a list of banks.
+
+        Same as :py:func:`check_production_size`, done for all the banks with a single aggregation pipeline.
+        Banks limit is taken from their own 'keep.old.version', see :py:func:`get_keep_old_version`.
+
+        :param max_release: Maximum number of release in production. Default to 'keep.old.version'
+        :type max_release: int
+        :param banks: List of bank names to check. Default all banks matching 'visibility'
+        :type banks: list
+        :param visibility: Type of bank visibility, default to 'public'. Supported ['all', 'public', 'private']
+        :type visibility: str
+        :return: List of [bank, production elements, limit] for banks exceeding the limit, sorted by bank name
+        :rtype: list
+        :raises SystemExit: If visibility argument is not one of ('all', 'public', 'private')
+        :raises SystemExit: If aggregation failed
+        """
+        if visibility not in ['all', 'public', 'private']:
+            Utils.error("Bank visibility '%s' not supported. Only one of ['all', 'public', 'private']" % visibility)
+        if banks is not None:
+            query = {'name': {'$in': list(banks)}}
+        elif visibility == 'all':
+            query = {}
+        else:
+            query = {'properties.visibility': visibility}
+        collection = FleetSnapshot.get_collection()
+
+        if max_release is not None:
+            limit = int(max_release)
+        else:
+            default = Manager.get_keep_old_version()
+            branches = []
+            for name in sorted(banks if banks is not None else collection.distinct('name', query)):
+                keep = Manager.get_keep_old_version(name)
+                if keep != default:
+                    branches.append({'case': {'$eq': ['$name', name]}, 'then': keep})
+            limit = default
+            if branches:
+                limit = {'$switch': {'branches': branches, 'default': default}}
+
+        productions = {'$ifNull': ['$production', []]}
+        pipeline = [{'$match': query},
+                    # We do not consider the published release 'current'
+                    {'$project': {'_id': 0, 'name': 1, 'limit': limit,
+                                  'size': {'$subtract': [{'$size': productions},
+                                                         {'$size': {'$filter': {'input': productions, 'as': 'prod',
+                                                                                'cond': {'$eq': ['$$prod.session',
+                                                                                                 '$current']}}}}]}}},
+                    {'$project': {'name': 1, 'limit': 1, 'size': 1, 'exceeds': {'$gt': ['$size', '$limit']}}},
+                    {'$match': {'exceeds': True}},
+                    {'$sort': {'name': 1}}]
+        exceeds = []
+        try:
+            for bank in collection.aggregate(pipeline):
+                if Manager.get_verbose():
+                    Utils.warn("[%s] Production release exceeds limit (%d/%d)" %
+                               (bank['name'], bank['size'], bank['limit']))
+                exceeds.append([bank['name'], bank['size'], bank['limit']])
+        except PyMongoError as err:
+            Utils.error("Can't check production sizes: %s" % str(err))
+        return exceeds
+
     @bank_required
     def clean_sessions(self):
         """
@@ -233,7 +324,7 @@ class Manager(object):
             current = self.bank.bank['current']
         if 'pending' in self.bank.bank:
             pendings = {x['id']: 1 for x in self.bank.bank['pending']}
-        productions = {x['session']: 1 for x in self.bank.bank['production']}
+        productions = self._get_productions_index()['session']
 
         bank_data_dir = self.get_bank_data_dir()
         if bank_data_dir is None:
@@ -270,22 +361,23 @@ class Manager(object):
                                 'type': field_name, 'key': id_key})
 
         if len(tasks_to_do):
-            cleaned = 0
+            # All the sessions/production entries are removed with a single update
+            pulls = {}
             for task in tasks_to_do:
-                if auto_clean is True:
-                    self.bank.banks.update({'name': self.bank.name},
-                                           {'$pull': {task['type']:
-                                                          {task['key']: task['sid'], 'release': str(task['release'])}
-                                                      }
-                                           })
-                    cleaned += 1
-                else:
+                if auto_clean is False:
                     Utils.ok("Clean needed for release %s, session %f" % (str(task['release']), task['sid']))
+                pulls.setdefault(task['type'], []).append({task['key']: task['sid'],
+                                                           'release': str(task['release'])})
+            update = {'$pull': {}}
+            for field, conditions in pulls.items():
+                update['$pull'][field] = Manager._merge_conditions(conditions)
+            self._bulk_write([UpdateOne({'name': self.bank.name}, update)], simulate=not auto_clean)
             if auto_clean is True:
-                Utils.ok("[%s] %d session(s) cleaned" % (self.bank.name, cleaned))
+                Utils.ok("[%s] %d session(s) cleaned" % (self.bank.name, len(tasks_to_do)))
         return True
 
     @bank_required
+    @bank_fields('current')
     def current_release(self):
         """
         Search for the current available release ('online')
@@ -312,6 +404,56 @@ class Manager(object):
         else:
             return current
 
+    def ensure_indexes(self):
+        """
+        Create the indexes needed by the manager on the 'banks' collection and check queries use them
+
+        Each query shape issued by the manager is explained, a warning is printed if one of them
+        needs a collection scan (COLLSCAN). In simulate mode, indexes are not created.
+
+        :return: True if all queries use an index
+        :rtype: bool
+        :raises SystemExit: If index creation failed
+        """
+        collection = FleetSnapshot.get_collection()
+        try:
+            # Directions may be returned as floats (1.0), they are compared as integers
+            existing = [[(field, int(order) if isinstance(order, float) else order) for field, order in index['key']]
+                        for index in collection.index_information().values()]
+            for keys in Manager.INDEXES:
+                name = '_'.join(["%s_%s" % (field, str(order)) for field, order in keys])
+                if keys in existing:
+                    Utils.ok("[manager] Index %s found" % name)
+                elif Manager.get_simulate():
+                    Utils.ok("[manager] Index %s would be created" % name)
+                else:
+                    collection.create_index(keys, background=True)
+                    Utils.ok("[manager] Index %s created" % name)
+        except PyMongoError as err:
+            Utils.error("Can't create indexes: %s" % str(err))
+
+        # Query shapes issued by the manager, with a sample bank
+        sample = collection.find_one({}, {'_id': 0, 'name': 1}) or {'name': ''}
+        name = sample['name']
+        queries = [{'properties.visibility': 'public'},
+                   {'name': {'$in': [name]}},
+                   {'name': name},
+                   {'name': name, 'production.release': ''},
+                   {'name': name, 'production.release': '', 'production.files_info.name': ''},
+                   {'name': name, 'sessions': {'$elemMatch': {'id': 0, 'deleted': {'$exists': False}}}}]
+        indexed = True
+        for query in queries:
+            try:
+                plan = collection.find(query).explain()
+            except PyMongoError as err:
+                Utils.error("Can't explain query %s: %s" % (str(query), str(err)))
+            if 'COLLSCAN' in Manager._get_plan_stages(plan.get('queryPlanner', {}).get('winningPlan', plan)):
+                Utils.warn("[manager] Query %s does a collection scan (COLLSCAN)" % str(query))
+                indexed = False
+            elif Manager.get_verbose():
+                Utils.ok("[manager] Query %s uses an index" % str(query))
+        return indexed
+
     @bank_required
     def formats(self, flat=False):
         """
@@ -355,21 +497,19 @@ class Manager(object):
         """
         return self.formats(flat=True)
 
-    def formats_available(self):
+    def formats_available(self, banks=None):
         """
-        Build list of all supported formats by reading bank properties
+        Build list of all supported formats from the banks formats catalog
 
+        :param banks: Banks to read formats from, default all public banks
+        :type banks: :class:`biomajmanager.fleet.FleetSnapshot`
         :return: List of supported formats
         :rtype: list
         """
-        banks = Manager.get_bank_list()
-        formats = {}
-        for bank in banks:
-            self.set_bank_from_name(name=bank)
-            fmts = self.formats(flat=True)
-            formats.update(fmts)
-        formats = sorted(formats, key=str.lower)
-        return formats
+        if banks is None:
+            banks = FleetSnapshot(fields=['name'])
+        names = [bank.name for bank in banks]
+        return self.get_format_catalog(banks=names).get_tools(banks=names)
 
     @bank_required
     def get_bank_data_dir(self):
@@ -384,7 +524,7 @@ class Manager(object):
         """
         release = self.current_release()
         if release:
-            prod = self.bank.get_production(release)
+            prod = self.get_production_from_release(release)
             if not prod:
                 Utils.error("Can't find production for release %s" % str(release))
             elif 'data_dir' in prod:
@@ -412,21 +552,14 @@ class Manager(object):
         if visibility not in ['all', 'public', 'private']:
             Utils.error("Bank visibility '%s' not supported. Only one of ['all', 'public', 'private']" % visibility)
         # Don't read config again
-        if BiomajConfig.global_config is None:
-            try:
-                BiomajConfig.load_config()
-            except Exception as err:
-                Utils.error("Problem loading biomaj configuration: %s" % str(err))
         from pymongo.errors import PyMongoError
         try:
             bank_list = []
-            if MongoConnector.db is None:
-                # We  surrounded this block of code with a try/except because there's a behavior
-                # difference between pymongo 2.7 and 3.2. 2.7 immediately raised exception if it
-                # cannot connect, 3.2 waits for a database access to connect to the server
-                MongoConnector(BiomajConfig.global_config.get('GENERAL', 'db.url'),
-                               BiomajConfig.global_config.get('GENERAL', 'db.name'))
-            banks = MongoConnector.banks.find({'properties.visibility': visibility}, {'name': 1, '_id': 0})
+            # We  surrounded this block of code with a try/except because there's a behavior
+            # difference between pymongo 2.7 and 3.2. 2.7 immediately raised exception if it
+            # cannot connect, 3.2 waits for a database access to connect to the server
+            banks = FleetSnapshot.get_collection().find({'properties.visibility': visibility},
+                                                        {'name': 1, '_id': 0})
             for bank in banks:
                 # Avoid document without bank name
                 if 'name' in bank:
@@ -480,15 +613,30 @@ class Manager(object):
         """
         # Check db.packages is set for the current bank
         packages = []
-        if not self.bank.config.get('db.packages'):
+        config = self.get_bank_properties()
+        if not config.get('db.packages'):
             if Manager.get_verbose():
                 Utils.warn("[%s] db.packages not set!" % self.bank.name)
         else:
-            packs = self.bank.config.get('db.packages').replace('\\', '').replace('\n', '').strip().split(',')
-            for pack in packs:
+            for pack in FormatCatalog.parse_packages(config.get('db.packages')):
                 packages.append('pack@' + pack)
         return packages
 
+    @bank_required
+    def get_bank_properties(self):
+        """
+        Get the bank properties from the persistent properties cache, see :class:`biomajmanager.config.PropertiesStore`
+
+        The bank properties file is only parsed if it changed since it was last cached.
+
+        :return: Bank properties, or bank configuration if bank properties file cannot be found
+        :rtype: :class:`biomajmanager.config.BankProperties` or :class:`biomaj_core.config.BiomajConfig`
+        """
+        properties = PropertiesStore.get_bank_properties(self.bank.name)
+        if properties is None:
+            return self.bank.config
+        return properties
+
     @bank_required
     def get_bank_sections(self, tool=None):
         """
@@ -507,16 +655,17 @@ class Manager(object):
             Utils.error("A tool name is required to retrieve section(s) info")
 
         sections = {}
+        config = self.get_bank_properties()
         for key in ['nuc', 'pro']:
             dbname = 'db.%s.%s' % (tool, key)
             secname = dbname + '.sections'
             sections[key] = {'dbs': [], 'sections': []}
-            if self.bank.config.get(dbname):
-                for db in self.bank.config.get(dbname).replace('\\', '').replace('\n', '').split(','):
+            if config.get(dbname):
+                for db in config.get(dbname).replace('\\', '').replace('\n', '').split(','):
                     if db and db != '':
                         sections[key]['dbs'].append(db)
-            if self.bank.config.get(secname):
-                for db in self.bank.config.get(secname).replace('\\', '').replace('\n', '').split(','):
+            if config.get(secname):
+                for db in config.get(secname).replace('\\', '').replace('\n', '').split(','):
                     if db and db != '':
                         sections[key]['sections'].append(db)
         return sections
@@ -546,7 +695,7 @@ class Manager(object):
         """
         release = self.current_release()
         if release:
-            prod = self.bank.get_production(release)
+            prod = self.get_production_from_release(release)
             if not prod:
                 Utils.error("Can't find production for release %s" % str(release))
             elif 'data_dir' in prod and 'prod_dir' in prod:
@@ -710,6 +859,20 @@ class Manager(object):
         formats.sort()
         return formats
 
+    def get_format_catalog(self, banks=None):
+        """
+        Get the banks formats catalog, adding banks to it or rebuilding their entries if their properties changed
+
+        :param banks: List of bank names to add to the catalog
+        :type banks: list
+        :return: Formats catalog
+        :rtype: :class:`biomajmanager.catalog.FormatCatalog`
+        """
+        if self._format_catalog is None:
+            self._format_catalog = FormatCatalog()
+        if banks:
+            self._format_catalog.update(banks)
+        return self._format_catalog
 
     @bank_required
     def get_future_link(self):
@@ -724,6 +887,7 @@ class Manager(object):
                             'future_release')
 
     @bank_required
+    @bank_fields('current', ('production', {'$slice': -1}))
     def get_last_production_ok(self):
         """
         Search for the last release in production which ran ok and which is not 'online' (current)
@@ -758,6 +922,7 @@ class Manager(object):
         return last_release
 
     @bank_required
+    @bank_fields('pending')
     def get_pending_sessions(self):
         """
         Request the database to check if some session(s) is/are pending to complete
@@ -770,6 +935,56 @@ class Manager(object):
             pending = self.bank.bank['pending']
         return pending
 
+    @bank_required
+    @bank_fields('pending', 'sessions.id', 'sessions.last_update_time')
+    def get_pending_sessions_last_run(self):
+        """
+        Get the pending sessions with the last update time of their session
+
+        Sessions are searched into the bank document, a bank view only needs the fields declared here.
+
+        :return: List of dict {'release': release, 'id': id, 'last_update_time': time}, 'last_update_time' is None
+                 if the session is not found
+        :rtype: list
+        """
+        pending = []
+        for pend in self.get_pending_sessions() or []:
+            session = self.get_session_from_id(pend['id'])
+            pending.append({'release': pend['release'], 'id': pend['id'],
+                            'last_update_time': session.get('last_update_time') if session is not None else None})
+        return pending
+
+    @staticmethod
+    def get_keep_old_version(name=None):
+        """
+        Get the 'keep.old.version' value of a bank, without loading the whole bank configuration
+
+        Properties files are parsed once, see :py:func:`biomajmanager.config.ConfigCache.get_parser`.
+
+        :param name: Bank name. If None, get the global value
+        :type name: str
+        :return: Number of old release to keep
+        :rtype: int
+        :raises SystemExit: If value is not an integer
+        """
+        if BiomajConfig.global_config is None:
+            Manager.load_config()
+        files = [BiomajConfig.config_file]
+        if name is not None:
+            files.append(os.path.join(BiomajConfig.global_config.get('GENERAL', 'conf.dir'), name + '.properties'))
+        # Environment variable overrides configuration, as done by BiomajConfig
+        value = os.environ.get('BIOMAJ_KEEP_OLD_VERSION')
+        if value is None:
+            config = ConfigCache.get_parser(files)
+            if config.has_option('GENERAL', 'keep.old.version'):
+                value = config.get('GENERAL', 'keep.old.version')
+            else:
+                value = BiomajConfig.DEFAULTS['keep.old.version']
+        try:
+            return int(value)
+        except ValueError:
+            Utils.error("[%s] 'keep.old.version' must be an integer, got '%s'" % (str(name), str(value)))
+
     def get_production_dir(self):
         """
         Get the production.dir setting
@@ -783,6 +998,7 @@ class Manager(object):
         return self.config.get('MANAGER', 'production.dir')
 
     @bank_required
+    @bank_fields('current')
     def get_published_release(self):
         """
         Check a bank has a published release
@@ -799,6 +1015,34 @@ class Manager(object):
                 Utils.error("[%s] Can't find a 'remoterelease' for session %s" % (self.bank.name, session['id']))
         return None
 
+    @bank_required
+    @bank_fields('production')
+    def get_production_from_release(self, release):
+        """
+        Retrieve a bank production from its release or production directory name
+
+        Same as :py:func:`biomaj.bank.Bank.get_production`, using the productions index
+
+        :param release: Release or production directory name
+        :type release: str
+        :return: Production or None
+        :rtype: dict or None
+        """
+        return self._get_productions_index()['release'].get(str(release))
+
+    @bank_required
+    @bank_fields('production')
+    def get_production_from_session(self, session_id):
+        """
+        Retrieve a bank production from its session id
+
+        :param session_id: Session id
+        :type session_id: float
+        :return: Production or None
+        :rtype: dict or None
+        """
+        return self._get_productions_index()['session'].get(session_id)
+
     @bank_required
     def get_session_from_id(self, session_id):
         """
@@ -809,15 +1053,12 @@ class Manager(object):
         :return: Session or None
         :rtype: dict or None
         """
-        sess = None
         if not session_id:
             Utils.error("A session id is required")
-        if 'sessions' in self.bank.bank and self.bank.bank['sessions']:
-            for session in self.bank.bank['sessions']:
-                if session_id == session['id']:
-                    sess = session
-                    break
-        return sess
+        # Bank view without complete sessions, only fetch the one we are looking for
+        if isinstance(self.bank, BankView) and not self.bank.is_fetched('sessions', complete=True):
+            return self.bank.get_session(session_id)
+        return self._get_sessions_index().get(session_id)
 
     @staticmethod
     def get_simulate():
@@ -839,6 +1080,25 @@ class Manager(object):
         """
         return Manager.verbose
 
+    def get_workers(self):
+        """
+        Get the number of workers used to process banks in parallel ('fleet.workers', section MANAGER)
+
+        :return: Number of workers, default :py:const:`Manager.WORKERS`
+        :rtype: int
+        :raises SystemExit: If 'fleet.workers' is not a positive integer
+        """
+        workers = Manager.WORKERS
+        if self.config.has_option('MANAGER', 'fleet.workers'):
+            try:
+                workers = int(self.config.get('MANAGER', 'fleet.workers'))
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                Utils.error("'fleet.workers' must be a positive integer, got '%s'" %
+                            self.config.get('MANAGER', 'fleet.workers'))
+        return workers
+
     @bank_required
     def has_current_link(self, link=None):
         """
@@ -872,7 +1132,7 @@ class Manager(object):
         """
         Checks either the bank supports 'format' or not
 
-        :param fmt: Format to check
+        :param fmt: Format to check, tool name or 'tool@version'
         :type fmt: str
         :return: If a format is present for a bank
         :rtype: bool
@@ -880,12 +1140,11 @@ class Manager(object):
         """
         if not fmt:
             Utils.error("Format is required")
-        fmts = self.formats(flat=True)
-        if fmt in fmts:
-            return True
-        return False
+        return self.get_format_catalog(banks=[self.bank.name]).has_format(self.bank.name, fmt)
 
     @bank_required
+    @bank_fields('current', 'production', 'sessions.id', 'sessions.remoterelease', 'sessions.deleted',
+                 'sessions.last_update_time')
     def history(self):
         """
         Get the releases history of a bank from the database and build a Mongo like document in json
@@ -963,6 +1222,7 @@ class Manager(object):
         return history
 
     @bank_required
+    @bank_fields('last_update_session', 'pending', 'sessions.id', 'sessions.workflow_status')
     def last_session_failed(self):
         """
         Check if the last building bank session failed, base on 'last_update_session' field.
@@ -1032,12 +1292,51 @@ class Manager(object):
         """
         Load all the plugins and activate them from manager.properties (plugins.list property)
 
+        Plugins are loaded once per Manager, the same instance is returned by later calls. A copy of the Manager
+        (see :py:func:`map_banks`) gets its own plugins, set with the copy. Plugins discovery is shared by all
+        the Managers of the process, see :class:`biomajmanager.plugins.PluginRegistry`.
+
         :returns: Instance of biomajmanager.plugins.Plugins
         :rtype: :class:`biomajmanager.plugins.Plugins`
         """
-        self.plugins = Plugins(manager=self)
+        if self.plugins is None or self.plugins.manager is not self:
+            self.plugins = Plugins(manager=self)
         return self.plugins
 
+    def map_banks(self, func, banks, workers=None):
+        """
+        Call a function for each bank, using a pool of threads
+
+        Each call gets its own copy of the Manager, set with the bank. Most of the time spent per bank is
+        waiting for MongoDB or reading bank properties file, so banks are processed concurrently.
+
+        :param func: Function to call for each bank, takes the bank :class:`Manager` as only argument
+        :type func: function
+        :param banks: Banks to process, :class:`biomaj.bank.Bank` or :class:`biomajmanager.bankview.BankView`
+        :type banks: list or :class:`biomajmanager.fleet.FleetSnapshot`
+        :param workers: Number of workers, default :py:func:`get_workers`
+        :type workers: int
+        :return: Results of the calls, in the same order as banks
+        :rtype: list
+        :raises SystemExit: If a call raised an error, the first one in banks order is raised again
+        """
+        banks = list(banks)
+        if workers is None:
+            workers = self.get_workers()
+        if workers < 2 or len(banks) < 2:
+            return [func(self._get_bank_manager(bank)) for bank in banks]
+
+        pool = ThreadPool(min(workers, len(banks)))
+        try:
+            results = pool.map(lambda bank: self._map_bank(func, bank), banks)
+        finally:
+            pool.close()
+            pool.join()
+        for status, result in results:
+            if not status:
+                raise result
+        return [result for _, result in results]
+
     def next_switch_date(self, week=None):
         """
         Returns the date of the next bank switch
@@ -1113,10 +1412,17 @@ class Manager(object):
         self._next_release = next_release
         return self._next_release
 
+    def reset_indexes(self):
+        """Reset sessions and productions lookup indexes, rebuilt on next lookup"""
+        self._sessions_index = None
+        self._productions_index = None
+        return
+
     def reset_releases(self):
-        """Reset current and next release variables to None"""
+        """Reset current and next release variables to None, as well as lookup indexes"""
         self._current_release = None
         self._next_release = None
+        self.reset_indexes()
         return
 
     @user_granted
@@ -1160,11 +1466,10 @@ class Manager(object):
                 Utils.error("Can't create destination directory %s: %s" % (directory, str(err)))
 
         try:
-            banks = Manager.get_bank_list()
+            banks = FleetSnapshot(fields=['name', 'current', 'production'])
             FILE_PATTERN = Manager.SAVE_BANK_LINE_PATTERN
             with open(bank_file, mode='w') as fv:
                 for bank in banks:
-                    bank = Bank(name=bank, no_log=True)
                     if 'current' in bank.bank and bank.bank['current'] and 'production' in bank.bank:
                         for prod in bank.bank['production']:
                             if bank.bank['current'] == prod['session']:
@@ -1188,25 +1493,27 @@ class Manager(object):
         """
         Set a bank for the current Manager
 
-        :param bank: Bank instance
-        :type bank: :class:`biomaj.bank.Bank`
+        :param bank: Bank instance or read only bank view
+        :type bank: :class:`biomaj.bank.Bank` or :class:`biomajmanager.bankview.BankView`
         :return: True if correctly set with expected instance
         :rtype: bool
         """
         if not bank or bank is None:
             return False
-        if isinstance(bank, Bank):
+        if isinstance(bank, (Bank, BankView)):
             self.bank = bank
             self.reset_releases()
             return True
         return False
 
-    def set_bank_from_name(self, name=None):
+    def set_bank_from_name(self, name=None, view=False):
         """
         Set a bank from a bank name
 
         :param name: Name of the bank to set
         :type name: str
+        :param view: Set a read only :class:`biomajmanager.bankview.BankView` instead of a :class:`biomaj.bank.Bank`
+        :type view: bool
         :return: True if bank set ok
         :rtype: bool
         :raises SystemExit: If bank object creation failed
@@ -1214,7 +1521,10 @@ class Manager(object):
         if not name or name is None:
             return False
         try:
-            bank = Bank(name=name, no_log=True)
+            if view:
+                bank = BankView(name)
+            else:
+                bank = Bank(name=name, no_log=True)
         except Exception as err:
             Utils.error("Problem with bank %s: %s" % (name, str(err)))
         return self.set_bank(bank=bank)
@@ -1314,6 +1624,7 @@ class Manager(object):
         return Manager.verbose
 
     @bank_required
+    @bank_fields('pending')
     def show_pending_sessions(self):
         """
         Check if some session are pending
@@ -1332,22 +1643,11 @@ class Manager(object):
         :return: List of banks requiring update
         :rtype: list
         """
-        banks = []
         if self.bank:
-            if self.can_switch():
-                banks.append({'name': self.bank.name,
-                              'current_release': self.current_release(),
-                              'next_release': self.next_release()})
-            return banks
-
-        banks_list = Manager.get_bank_list(visibility=visibility)
-        for bank in banks_list:
-            self.set_bank_from_name(name=bank)
-            if self.can_switch():
-                banks.append({'name': bank,
-                              'current_release': self.current_release(),
-                              'next_release': self.next_release()})
-        return banks
+            banks = [self._need_update()]
+        else:
+            banks = self.map_banks(Manager._need_update, FleetSnapshot(visibility=visibility))
+        return [bank for bank in banks if bank is not None]
 
     @user_granted
     def stop_running_jobs(self, args=None):
@@ -1470,24 +1770,23 @@ class Manager(object):
                                     'release': prod['release'],
                                     'sid': prod['session']})
 
+        # Database updates, applied with a single bulk write
+        operations = []
         if len(tasks_to_do):
             seen = False
+            operations.append(UpdateOne({'name': self.bank.name},
+                                        {'$pull': {'production': Manager._merge_conditions(
+                                            [{'release': task['release'], 'session': task['sid']}
+                                             for task in tasks_to_do])}}))
             for task in tasks_to_do:
+                if task['time']:
+                    # In case 'sessions.deleted' already set don't change it
+                    operations.append(UpdateOne({'name': self.bank.name,
+                                                 'sessions': {'$elemMatch': {'id': task['sid'],
+                                                                             'deleted': {'$exists': False}}}},
+                                                {'$set': {'sessions.$.deleted': deleted_time}}))
                 if auto_delete:
-                    Utils.verbose("Updating production (session id %f) ... " % task['sid'])
-                    self.bank.banks.update({'name': self.bank.name},
-                                           {'$pull': {'production': {'release': task['release'],
-                                                                     'session': task['sid']}
-                                                      }})
-                    if task['time']:
-                        Utils.verbose("Updating sessions (id %f) ... " % task['sid'])
-                        # In case 'sessions.deleted' already set don't change it
-                        session = self.bank.banks.find({'name': self.bank.name, 'sessions.id': task['sid'],
-                                                        'sessions.deleted': {'$exists': False}},
-                                                       {'sessions.$': 1, '_id': 0})
-                        if not session.count():
-                            self.bank.banks.update({'name': self.bank.name, 'sessions.id': task['sid']},
-                                                   {'$set': {'sessions.$.deleted': deleted_time}})
+                    Utils.verbose("Updating production and sessions (session id %f) ... " % task['sid'])
                 else:
                     if not seen:
                         Utils.ok("You need to:")
@@ -1496,10 +1795,12 @@ class Manager(object):
                     if 'time' in task:
                         Utils.ok("- set sessions[id=%f].deleted to %s" % (task['sid'], str(task['time'])))
 
+        error = None
         if len(releases_dir):
             # Ctrl-C during bank update
             seen = False
             pendings = []
+            pendings_removed = []
             if 'pending' in self.bank.bank:
                 pendings = {x['release']: x['id'] for x in self.bank.bank['pending']}
             for release in releases_dir:
@@ -1520,17 +1821,26 @@ class Manager(object):
                         shutil.rmtree(path)
                         if pr in pendings:
                             Utils.verbose("Removing pending release %s from database ... " % str(pr))
-                            self.bank.banks.update({'name': self.bank.name},
-                                                   {'$pull': {'pending': {'release': pr}}})
                     except OSError as err:
-                        Utils.error("Can't delete '%s': %s" % (path, str(err)))
+                        # Reported once the database is updated for the directories already removed
+                        error = "Can't delete '%s': %s" % (path, str(err))
+                        break
                 else:
                     Utils.warn("- %s" % str(release))
                     if pr in pendings:
                         Utils.warn("- Remove pending release %s from database" % str(pr))
+                if pr in pendings:
+                    pendings_removed.append(pr)
+            if pendings_removed:
+                operations.append(UpdateOne({'name': self.bank.name},
+                                            {'$pull': {'pending': {'release': {'$in': pendings_removed}}}}))
+        self._bulk_write(operations, simulate=not auto_delete)
+        if error is not None:
+            Utils.error(error)
         return True
 
     @bank_required
+    @bank_fields('last_update_session', 'current')
     def update_ready(self):
         """
         Check the bank release is ready to be published.
@@ -1625,6 +1935,135 @@ class Manager(object):
         return script, args
 
     @bank_required
+    @bank_fields('production')
+    def _get_productions_index(self):
+        """
+        Get the productions lookup index, building it if needed
+
+        The index is rebuilt when the 'production' list of the bank document changed (replaced or resized).
+        As for :py:func:`biomaj.bank.Bank.get_production`, the last production matching a release wins.
+
+        :return: Dict with 'session' and 'release' keys, each one mapping to production document
+        :rtype: dict
+        """
+        productions = self.bank.bank.get('production') or []
+        if not Manager._index_is_valid(self._productions_index, productions):
+            by_session = {}
+            by_release = {}
+            for production in productions:
+                if 'session' in production:
+                    by_session[production['session']] = production
+                for key in ['release', 'prod_dir']:
+                    if key in production:
+                        by_release[production[key]] = production
+            self._productions_index = {'source': productions, 'size': len(productions),
+                                       'index': {'session': by_session, 'release': by_release}}
+        return self._productions_index['index']
+
+    @bank_required
+    @bank_fields('sessions')
+    def _get_sessions_index(self):
+        """
+        Get the sessions lookup index, building it if needed
+
+        The index is rebuilt when the 'sessions' list of the bank document changed (replaced or resized).
+        As for a linear search, the first session matching an id wins.
+
+        :return: Dict mapping session id to session document
+        :rtype: dict
+        """
+        sessions = self.bank.bank.get('sessions') or []
+        if not Manager._index_is_valid(self._sessions_index, sessions):
+            index = {}
+            for session in sessions:
+                if 'id' in session and session['id'] not in index:
+                    index[session['id']] = session
+            self._sessions_index = {'source': sessions, 'size': len(sessions), 'index': index}
+        return self._sessions_index['index']
+
+    @staticmethod
+    def _index_is_valid(index, source):
+        """
+        Check a lookup index has been built from source list
+
+        :param index: Lookup index
+        :type index: dict
+        :param source: List the index is built from
+        :type source: list
+        :return: True if index is up to date
+        :rtype: bool
+        """
+        if index is None:
+            return False
+        return index['source'] is source and index['size'] == len(source)
+
+    def _bulk_write(self, operations, simulate=False):
+        """
+        Apply write operations to the database with a single bulk write, and report matched/modified counts
+
+        In simulate mode, operations are only printed.
+
+        :param operations: List of write operations (:class:`pymongo.UpdateOne`, ...)
+        :type operations: list
+        :param simulate: Only print the operations
+        :type simulate: bool
+        :return: Tuple (matched, modified) documents counts
+        :rtype: tuple
+        :raises SystemExit: If bulk write failed
+        """
+        if not operations:
+            return 0, 0
+        if simulate:
+            for operation in operations:
+                Utils.ok("[%s] Planned database update: %s" % (self.bank.name, str(operation)))
+            return 0, 0
+        try:
+            result = self.bank.banks.bulk_write(operations)
+        except PyMongoError as err:
+            Utils.error("[%s] Can't update database: %s" % (self.bank.name, str(err)))
+        Utils.ok("[%s] Documents matched: %d, documents modified: %d" %
+                 (self.bank.name, result.matched_count, result.modified_count))
+        return result.matched_count, result.modified_count
+
+    @staticmethod
+    def _get_plan_stages(plan):
+        """
+        Get all the stages of a query plan, as returned by 'explain'
+
+        :param plan: Query plan
+        :type plan: dict or list
+        :return: List of stages names
+        :rtype: list
+        """
+        stages = []
+        if isinstance(plan, dict):
+            for key, value in plan.items():
+                if key == 'stage':
+                    stages.append(value)
+                else:
+                    stages.extend(Manager._get_plan_stages(value))
+        elif isinstance(plan, list):
+            for value in plan:
+                stages.extend(Manager._get_plan_stages(value))
+        return stages
+
+    def _get_bank_manager(self, bank):
+        """
+        Get a copy of the Manager set with a bank
+
+        :param bank: Bank to set
+        :type bank: :class:`biomaj.bank.Bank` or :class:`biomajmanager.bankview.BankView`
+        :return: Manager copy
+        :rtype: :class:`Manager`
+        """
+        manager = copy.copy(self)
+        # Plugins of the copy are set with the copy and its bank, see load_plugins
+        manager.plugins = None
+        manager.set_bank(bank=bank)
+        return manager
+
+    @bank_required
+    @bank_fields('sessions')
     def _get_last_session(self):
         """
         Get the session(s) from a bank.
@@ -1640,6 +2079,50 @@ class Manager(object):
         else:
             Utils.error("No session found in bank %s" % str(self.bank.name))
 
+    def _map_bank(self, func, bank):
+        """
+        Call a function for a bank, catching errors to report them to :py:func:`map_banks`
+
+        :param func: Function to call, takes the bank :class:`Manager` as only argument
+        :type func: function
+        :param bank: Bank to set
+        :type bank: :class:`biomaj.bank.Bank` or :class:`biomajmanager.bankview.BankView`
+        :return: Tuple (True, result) or (False, error)
+        :rtype: tuple
+        """
+        try:
+            return True, func(self._get_bank_manager(bank))
+        except (Exception, SystemExit) as err:
+            return False, err
+
+    @staticmethod
+    def _merge_conditions(conditions):
+        """
+        Merge a list of conditions into a single one, using '$or'
+
+        :param conditions: List of conditions
+        :type conditions: list
+        :return: Condition
+        :rtype: dict
+        """
+        if len(conditions) == 1:
+            return conditions[0]
+        return {'$or': conditions}
+
+    @bank_required
+    def _need_update(self):
+        """
+        Check the bank can be switched
+
+        :return: Dict with bank name, current and next release or None
+        :rtype: dict or None
+        """
+        if self.can_switch():
+            return {'name': self.bank.name,
+                    'current_release': self.current_release(),
+                    'next_release': self.next_release()}
+        return None
+
     def _run_command(self, exe=None, args=None, quiet=False):
         """
         Just run a system command using subprocess. STDOUT and STDERR are redirected to /dev/null (os.devnull)
@@ -3,6 +3,8 @@ from biomajmanager.utils import Utils
 from yapsy.PluginManager import PluginManager
 from yapsy.IPlugin import IPlugin
 import os
+import threading
+import time
 
 
 class Plugins(object):
@@ -10,6 +12,8 @@ class Plugins(object):
     """Plugin class for BioMAJ Manager"""
 
     CATEGORY = 'MANAGER'
+    # Default time, in seconds, a plugin hook is given to complete, see :py:func:`get_timeout`
+    TIMEOUT = 60
 
     def __init__(self, manager=None, name=None):
         """
@@ -25,7 +29,8 @@ class Plugins(object):
         :raises SystemExit: If 'plugins.list' not set in :py:data:`manager.properties`
         :raises SystemExit: If 'plugins.dir' does not exist
         """
-        self.pm = None
+        self.registry = None
+        self._pm = None
         self.name = None
         self.config = None
         self.manager = None
@@ -43,10 +48,7 @@ class Plugins(object):
 
         if not os.path.isdir(self.config.get('MANAGER', 'plugins.dir')):
             Utils.error("Can't find plugins.dir")
-        plugin_manager = PluginManager(directories_list=[self.config.get('MANAGER', 'plugins.dir')],
-                                       categories_filter={Plugins.CATEGORY: BMPlugin})
-        plugin_manager.collectPlugins()
-        self.pm = plugin_manager
+        self.registry = PluginRegistry.get(self.config.get('MANAGER', 'plugins.dir'))
         self.name = name
         user_plugins = []
 
@@ -56,16 +58,221 @@ class Plugins(object):
             # We need to lower the plugin name
             user_plugins.append(plugin)
 
-        # This means that all plugins must inherits from BMPlugin
-        for pluginInfo in plugin_manager.getPluginsOfCategory(Plugins.CATEGORY):
-            Utils.verbose("[manager] plugin name => %s" % pluginInfo.name)
-            if pluginInfo.name in user_plugins:
-                if not pluginInfo.is_activated:
-                    Utils.verbose("[manager] plugin %s activated" % pluginInfo.name)
-                    plugin_manager.activatePluginByName(pluginInfo.name)
-                setattr(self, pluginInfo.name, pluginInfo.plugin_object)
-                pluginInfo.plugin_object.set_config(self.config)
-                pluginInfo.plugin_object.set_manager(self.manager)
+        # This means that all plugins must inherits from BMPlugin. Plugins are imported and activated the first time
+        # they are used, see __getattr__
+        self.plugins = [name for name in self.registry.get_names() if name in user_plugins]
+        for name in self.plugins:
+            Utils.verbose("[manager] plugin name => %s" % name)
+
+    @property
+    def pm(self):
+        """
+        Yapsy plugin manager of the plugins directory, kept for backward compatibility
+
+        It is built from :py:attr:`registry` the first time it is used, all the plugins modules are then imported.
+        The plugins of 'plugins.list' are the activated plugins objects of this instance.
+
+        :return: Plugin manager
+        :rtype: :class:`yapsy.PluginManager.PluginManager`
+        """
+        if self._pm is None:
+            plugin_manager = PluginManager(directories_list=[], categories_filter={Plugins.CATEGORY: BMPlugin})
+            plugin_manager.locatePlugins()
+            for name in self.registry.get_names():
+                plugin_manager.appendPluginCandidate(self.registry.candidates[name])
+            plugin_manager.loadPlugins()
+            for plugin_info in plugin_manager.getPluginsOfCategory(Plugins.CATEGORY):
+                if plugin_info.name in self.plugins:
+                    plugin_info.plugin_object = getattr(self, plugin_info.name)
+            self._pm = plugin_manager
+        return self._pm
+
+    def dispatch(self, hook, timeout=None, **kwargs):
+        """
+        Call a hook on all the plugins of 'plugins.list' implementing it, concurrently
+
+        Each plugin is called from its own thread and given its own timeout. An error or a timeout of a plugin does not
+        stop the others; a plugin still running after its timeout is left running in the background.
+
+        :param hook: Name of the plugin method to call
+        :type hook: str
+        :param timeout: Time in seconds given to each plugin, default :py:func:`get_timeout`
+        :type timeout: float
+        :param kwargs: Arguments given to the hook
+        :type kwargs: dict
+        :return: Report, plugin name as key and {'status': 'ok'|'error'|'timeout', 'result', 'error', 'time'} as value.
+                 Plugins not implementing the hook are not in the report
+        :rtype: dict
+        :raises SystemExit: If hook name is not valid
+        """
+        if not hook or hook.startswith('_'):
+            Utils.error("Hook name '%s' not valid" % str(hook))
+        report = {}
+        calls = []
+        for name in self.plugins:
+            try:
+                method = getattr(getattr(self, name), hook, None)
+            except AttributeError as err:
+                report[name] = {'status': 'error', 'result': None, 'error': str(err), 'time': 0.0}
+                continue
+            if not callable(method):
+                continue
+            report[name] = {'status': 'timeout', 'result': None, 'error': None, 'time': None}
+            # Each thread sets its own status, only copied to the report if the thread completes in time
+            status = {}
+            thread = threading.Thread(target=Plugins._call_hook, args=(method, kwargs, status))
+            thread.daemon = True
+            calls.append((name, thread, status,
+                          time.time() + (timeout if timeout is not None else self.get_timeout(name))))
+            thread.start()
+        for name, thread, status, deadline in calls:
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                Utils.warn("[%s] %s did not complete in time" % (name, hook))
+                continue
+            report[name].update(status)
+            if report[name]['status'] == 'error':
+                Utils.warn("[%s] %s failed: %s" % (name, hook, report[name]['error']))
+        return report
+
+    def get_timeout(self, name):
+        """
+        Get the time a plugin hook is given to complete ('<name>.timeout' in plugin section, or 'plugins.timeout' in
+        section PLUGINS)
+
+        :param name: Plugin name
+        :type name: str
+        :return: Timeout in seconds, default :py:const:`Plugins.TIMEOUT`
+        :rtype: float
+        :raises SystemExit: If timeout is not a positive number
+        """
+        for section, option in [(name, '%s.timeout' % name), ('PLUGINS', 'plugins.timeout')]:
+            if self.config.has_section(section) and self.config.has_option(section, option):
+                try:
+                    timeout = float(self.config.get(section, option))
+                except ValueError:
+                    timeout = 0
+                if timeout <= 0:
+                    Utils.error("'%s' must be a positive number, got '%s'" % (option, self.config.get(section, option)))
+                return timeout
+        return Plugins.TIMEOUT
+
+    @staticmethod
+    def _call_hook(method, kwargs, status):
+        """
+        Call a plugin hook and set its status, run by the plugin thread
+
+        :param method: Plugin hook
+        :type method: function
+        :param kwargs: Hook arguments
+        :type kwargs: dict
+        :param status: Plugin status, owned by the plugin thread and updated
+        :type status: dict
+        """
+        start = time.time()
+        try:
+            result = method(**kwargs)
+            status.update({'status': 'ok', 'result': result, 'time': time.time() - start})
+        except (Exception, SystemExit) as err:
+            status.update({'status': 'error', 'error': str(err) or err.__class__.__name__, 'time': time.time() - start})
+
+    def __getattr__(self, name):
+        """Activate a plugin of 'plugins.list' the first time it is used"""
+        if name.startswith('_') or name not in self.__dict__.get('plugins', []):
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+        plugin = self.registry.get_plugin(name)
+        if plugin is None:
+            raise AttributeError("Plugin '%s' can't be loaded" % name)
+        Utils.verbose("[manager] plugin %s activated" % name)
+        plugin.activate()
+        plugin.set_config(self.config)
+        plugin.set_manager(self.manager)
+        setattr(self, name, plugin)
+        return plugin
+
+
+class PluginRegistry(object):
+
+    """
+    Plugins found in a plugins directory, shared by all the :class:`Plugins` of the process
+
+    The '.yapsy-plugin' description files are parsed once, and parsed again only when the directory modification time
+    changes. A plugin module is only imported the first time the plugin is asked for.
+    """
+
+    # Registries, plugins directory as key
+    registries = {}
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Find the plugins of a directory, without importing them
+
+        :param path: Plugins directory
+        :type path: str
+        """
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.lock = threading.Lock()
+        plugin_manager = PluginManager(directories_list=[path], categories_filter={Plugins.CATEGORY: BMPlugin})
+        plugin_manager.locatePlugins()
+        # Plugins candidates (yapsy), plugin name as key
+        self.candidates = dict([(candidate[2].name, candidate) for candidate in plugin_manager.getPluginCandidates()])
+        # Plugins classes, imported on demand, plugin name as key
+        self.classes = {}
+
+    @staticmethod
+    def get(path):
+        """
+        Get the registry of a plugins directory, found again if the directory changed
+
+        :param path: Plugins directory
+        :type path: str
+        :return: Registry
+        :rtype: :class:`biomajmanager.plugins.PluginRegistry`
+        """
+        with PluginRegistry.lock:
+            registry = PluginRegistry.registries.get(path)
+            if registry is None or registry.mtime != os.stat(path).st_mtime:
+                registry = PluginRegistry(path)
+                PluginRegistry.registries[path] = registry
+        return registry
+
+    def get_names(self):
+        """
+        Get the names of the plugins found
+
+        :return: Sorted list of plugins names
+        :rtype: list
+        """
+        return sorted(self.candidates)
+
+    def get_plugin(self, name):
+        """
+        Create a plugin object, its module is imported the first time
+
+        :param name: Plugin name
+        :type name: str
+        :return: Plugin object or None if plugin not found or can't be loaded
+        :rtype: :class:`biomajmanager.plugins.BMPlugin`
+        """
+        with self.lock:
+            if name not in self.classes:
+                self.classes[name] = None
+                if name in self.candidates:
+                    plugin_manager = PluginManager(directories_list=[],
+                                                   categories_filter={Plugins.CATEGORY: BMPlugin})
+                    plugin_manager.locatePlugins()
+                    plugin_manager.appendPluginCandidate(self.candidates[name])
+                    plugin_manager.loadPlugins()
+                    for plugin_info in plugin_manager.getPluginsOfCategory(Plugins.CATEGORY):
+                        self.classes[name] = plugin_info.plugin_object.__class__
+                    if self.classes[name] is None:
+                        Utils.warn("Can't load plugin %s" % name)
+            plugin_class = self.classes[name]
+        if plugin_class is None:
+            return None
+        return plugin_class()
 
 
 class BMPlugin(IPlugin):
@@ -0,0 +1,315 @@
+"""Parallel scanner and cleaner of the broken symbolic links of directory trees"""
+from biomajmanager.inventory import LinkInventory
+from biomajmanager.utils import Utils
+from multiprocessing.pool import ThreadPool
+import errno
+import os
+import threading
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+__author__ = 'tuco'
+
+
+class LinkCleaner(object):
+
+    """
+    Remove the broken symlinks of the production directories links are created into
+
+    All the directories are scanned by the workers of a single :class:`LinkScanner`, each directory being cleaned by
+    the worker which read it. A dry run does the same scan and only reports the symlinks it would remove.
+    """
+
+    def __init__(self, prod_dir, workers=None, dry_run=False):
+        """
+        Create the cleaner
+
+        :param prod_dir: Production directory
+        :type prod_dir: str
+        :param workers: Number of workers, default :py:const:`LinkScanner.WORKERS`
+        :type workers: int
+        :param dry_run: Only search the broken symlinks, do not remove them
+        :type dry_run: bool
+        """
+        self.prod_dir = prod_dir
+        self.dry_run = dry_run
+        self.scanner = LinkScanner(workers=workers, remove=not dry_run)
+        self.inventory = LinkInventory()
+        # Broken symlinks found, tool name as key and list of symlinks paths as value
+        self.links = {}
+
+    def clean(self, targets):
+        """
+        Search and remove the broken symlinks of target directories and their sub directories
+
+        :param targets: List of directories, relative to the production directory. Missing ones are skipped
+        :type targets: list
+        :return: Number of removed symlinks (to remove if dry run) per tool, tool name as key
+        :rtype: dict
+        :raises SystemExit: If production directory does not exist
+        """
+        if not os.path.isdir(self.prod_dir):
+            Utils.error("Production directory %s does not exist" % str(self.prod_dir))
+        roots = []
+        # Sorted, a directory comes before its sub directories which are already scanned with it
+        for target in sorted(set([os.path.normpath(target) for target in targets])):
+            if [root for root in roots if target.startswith(root + os.sep)]:
+                continue
+            if not os.path.isdir(os.path.join(self.prod_dir, target)):
+                Utils.verbose("[clean] %s does not exist, skipped" % target)
+                continue
+            roots.append(target)
+        self.links = {}
+        if not roots:
+            return {}
+        removed = []
+        for _, broken in self.scanner.scan([os.path.join(self.prod_dir, root) for root in roots]):
+            for link in broken:
+                link = os.path.relpath(link, self.prod_dir)
+                self.links.setdefault(LinkInventory.get_tool(link), []).append(link)
+                removed.append(link)
+        if not self.dry_run:
+            self.inventory.remove(removed)
+        return dict([(tool, len(links)) for tool, links in self.links.items()])
+
+
+class LinkScanner(object):
+
+    """
+    Search the broken symlinks of a tree, each directory of the tree being read by a worker
+
+    Entries types come from the directory listing (d_type), only symlinks are checked. A symlink is checked from its
+    value (readlink): the directory it points into is listed once and cached, so all the links pointing into the
+    same directory cost a single read of this directory instead of a stat per link.
+    """
+
+    # Default number of workers reading directories
+    WORKERS = 4
+
+    # Links can be removed relative to their open directory
+    DIR_FD = hasattr(os, 'supports_dir_fd') and os.unlink in os.supports_dir_fd
+
+    def __init__(self, workers=None, remove=False):
+        """
+        Create the scanner
+
+        :param workers: Number of workers, default :py:const:`LinkScanner.WORKERS`
+        :type workers: int
+        :param remove: Remove the broken symlinks found, each directory is cleaned by the worker which read it
+        :type remove: bool
+        """
+        self.workers = workers if workers else LinkScanner.WORKERS
+        self.remove = remove
+        # Entries of the directories links point into, directory path as key and {entry name: is symlink} as value,
+        # False if directory does not exist, None if it cannot be read
+        self.targets = {}
+        # Links targets checked with a stat, path as key and existence as value
+        self.resolved = {}
+        self.lock = threading.Lock()
+        self.dirs = 0
+        self.links = 0
+        self.broken = 0
+        # Number of targets directories read and targets checked with a stat
+        self.stats = 0
+
+    def is_broken(self, link):
+        """
+        Check a symlink is broken
+
+        :param link: Symlink path, its directory path must not contain symlinks (see :py:func:`os.path.realpath`)
+        :type link: str
+        :return: Boolean, False if 'link' is not a symlink anymore
+        :rtype: bool
+        """
+        try:
+            value = os.readlink(link)
+        except OSError:
+            return False
+        target = self._resolve(os.path.dirname(link), value)
+        if target is None:
+            return not self._exists(link)
+        target_dir, name = os.path.split(target)
+        entries = self._get_entries(target_dir)
+        if entries is None:
+            return not self._exists(link)
+        if entries is False or name not in entries:
+            return True
+        # Chained symlink
+        if entries[name]:
+            return not self._exists(target)
+        return False
+
+    def scan(self, path):
+        """
+        Search the broken symlinks of trees, results are given directory by directory as soon as they are found
+
+        Symlinks to directories are checked, not followed. Directories of all the trees are read by the same workers.
+
+        :param path: Root of the tree, or list of roots
+        :type path: str or list
+        :return: Generator of (directory path, list of broken symlinks of the directory). If 'remove' is set, the
+                 symlinks have been removed
+        :rtype: generator
+        :raises SystemExit: If path does not exist
+        """
+        paths = path if isinstance(path, list) else [path]
+        for path in paths:
+            if not os.path.isdir(path):
+                Utils.error("Path '%s' does not exist" % str(path))
+        results = queue.Queue()
+        pool = ThreadPool(self.workers)
+        try:
+            # Relative links values are resolved from physical directories, trees are read from their real path
+            for path in paths:
+                pool.apply_async(self._scan_dir, (os.path.realpath(path), path), callback=results.put)
+            pending = len(paths)
+            while pending:
+                dir_path, sub_dirs, broken, error = results.get()
+                pending -= 1
+                for sub_dir in sub_dirs:
+                    pool.apply_async(self._scan_dir, sub_dir, callback=results.put)
+                    pending += 1
+                if error is not None:
+                    Utils.warn("Can't read %s: %s" % (dir_path, error))
+                yield dir_path, broken
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _exists(self, path):
+        """
+        Check a path exists following symlinks, the result is cached
+
+        :param path: Path to check
+        :type path: str
+        :return: Boolean
+        :rtype: bool
+        """
+        exists = self.resolved.get(path)
+        if exists is None:
+            exists = os.path.exists(path)
+            with self.lock:
+                self.resolved[path] = exists
+                self.stats += 1
+        return exists
+
+    def _get_entries(self, path):
+        """
+        Get the entries of a directory links point into, the directory is read once
+
+        :param path: Directory path
+        :type path: str
+        :return: {entry name: is symlink}, False if directory does not exist, None if it cannot be read
+        :rtype: dict
+        """
+        if path in self.targets:
+            return self.targets[path]
+        try:
+            entries = dict([(entry.name, entry.is_symlink()) for entry in scandir(path)])
+        except OSError as err:
+            entries = False if err.errno in [errno.ENOENT, errno.ENOTDIR, errno.ELOOP] else None
+        with self.lock:
+            self.targets[path] = entries
+            self.stats += 1
+        return entries
+
+    @staticmethod
+    def _resolve(path, value):
+        """
+        Get the path a symlink points to without asking the file system
+
+        :param path: Directory of the symlink, without symlink in it
+        :type path: str
+        :param value: Symlink value
+        :type value: str
+        :return: Normalized target path, None if it can only be resolved by the file system ('..' after a component
+                 which may be a symlink)
+        :rtype: str
+        """
+        leading = True
+        for part in value.split(os.sep):
+            if part == os.pardir:
+                if not leading:
+                    return None
+            elif part not in ['', os.curdir]:
+                leading = False
+        target = os.path.normpath(os.path.join(path, value))
+        if os.path.basename(target) in ['', os.curdir, os.pardir]:
+            return None
+        return target
+
+    def _remove(self, path, names):
+        """
+        Remove entries of a directory, the directory is opened once for all of them
+
+        :param path: Directory path
+        :type path: str
+        :param names: Names of the entries to remove
+        :type names: list
+        :return: (list of removed names, error message or None)
+        :rtype: tuple
+        """
+        removed = []
+        errors = []
+        dir_fd = None
+        try:
+            if LinkScanner.DIR_FD:
+                dir_fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+            for name in names:
+                try:
+                    if dir_fd is not None:
+                        os.unlink(name, dir_fd=dir_fd)
+                    else:
+                        os.remove(os.path.join(path, name))
+                    removed.append(name)
+                except OSError as err:
+                    errors.append("%s: %s" % (name, str(err)))
+        except OSError as err:
+            errors.append(str(err))
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        if errors:
+            return removed, "Can't remove %d link(s) (%s)" % (len(errors), ', '.join(errors))
+        return removed, None
+
+    def _scan_dir(self, path, display):
+        """
+        Read a directory, and remove its broken symlinks if asked to. Run by workers
+
+        :param path: Real directory path
+        :type path: str
+        :param display: Directory path to report, under the root path given to :py:func:`scan`
+        :type display: str
+        :return: (reported directory path, list of (sub directory real path, reported path), list of broken symlinks
+                 reported paths, error message or None)
+        :rtype: tuple
+        """
+        sub_dirs = []
+        broken = []
+        error = None
+        try:
+            links = 0
+            for entry in scandir(path):
+                if entry.is_symlink():
+                    links += 1
+                    if self.is_broken(entry.path):
+                        broken.append(entry.name)
+                elif entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.name)
+            if self.remove and broken:
+                broken, error = self._remove(path, broken)
+            with self.lock:
+                self.dirs += 1
+                self.links += links
+                self.broken += len(broken)
+        except Exception as err:
+            error = str(err)
+        return display, [(os.path.join(path, name), os.path.join(display, name)) for name in sorted(sub_dirs)], \
+            [os.path.join(display, name) for name in sorted(broken)], error
@@ -5,6 +5,10 @@ import sys
 import getpass
 from time import time
 from datetime import datetime
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 
 class Utils(object):
@@ -17,6 +21,11 @@ class Utils(object):
     show_verbose = True
     # Default date format string
     DATE_FMT = "%Y-%m-%d %H:%M:%S"
+    # Directories, relative to 'production.dir', managed by biomaj-manager: banks links manifests and banks links
+    # trees, see :class:`biomajmanager.links.Links`
+    MANIFEST_DIR = '.links'
+    TREES_DIR = '.trees'
+    MANAGED_DIRS = [MANIFEST_DIR, TREES_DIR]
 
     @staticmethod
     def clean_symlinks(path=None, delete=False):
@@ -101,26 +110,37 @@ class Utils(object):
         sys.exit(1)
 
     @staticmethod
-    def get_broken_links(path=None):
+    def get_broken_links(path=None, workers=None):
         """
         Search for broken symlinks from a particular path.
 
-        If path is not given or None, then it search from the production directory.
+        All the directories of the tree are searched in parallel, see :class:`biomajmanager.scanner.LinkScanner`.
+        Broken links are reported directory by directory, as soon as they are found.
 
         :param path: Path to search broken links from
         :type path: str
-        :return: Number of found broekn links
+        :param workers: Number of workers, default :py:const:`biomajmanager.scanner.LinkScanner.WORKERS`
+        :type workers: int
+        :return: Number of found broken links
         :rtype: int
         :raise SystemExit: If path does not exist
         """
+        from .manager import Manager
+        from .scanner import LinkScanner
         if path is None:
             Utils.error("Path not given")
         if not os.path.exists(path):
             Utils.error("Path '%s' does not exist" % str(path))
         brkln = 0
-        for dir_path, dir_names, _ in os.walk(path):
-            if len(dir_names) == 0 or dir_path == path:
-                brkln += Utils.clean_symlinks(path=dir_path, delete=False)
+        for dir_path, broken in LinkScanner(workers=workers).scan(path):
+            if not len(broken):
+                if Manager.verbose:
+                    Utils.ok("No dead link found (%s)" % str(dir_path))
+                continue
+            brkln += len(broken)
+            Utils.uprint("* %d link(s) need to be cleaned (%s):" % (int(len(broken)), str(dir_path)))
+            if Manager.verbose:
+                Utils.uprint("\n".join(broken))
         return brkln
 
     @staticmethod
@@ -159,22 +179,9 @@ class Utils(object):
         if not os.path.exists(path) and not os.path.isdir(path):
             Utils.error("%s does not exists" % str(path))
 
-        dirs = []
-        loop = 0
-        for dir_path, dir_names, _ in os.walk(path):
-            loop += 1
-            if limit and limit == loop:
-                if full:
-                    dirs.append(dir_path)
-                else:
-                    dirs.append(os.path.basename(dir_path))
-                break
-            if len(dir_names) == 0:
-                if full:
-                    dirs.append(dir_path)
-                else:
-                    dirs.append(os.path.basename(dir_path))
-        return dirs
+        if full:
+            return list(Utils.iter_dirs(path, max_depth=limit, full=True))
+        return [os.path.basename(dir_path) for dir_path in Utils.iter_dirs(path, max_depth=limit, full=True)]
 
     @staticmethod
     def get_deepest_dir(path=None, full=False, limit=0):
@@ -185,15 +192,27 @@ class Utils(object):
         :type path: str
         :param full: Returns complete path or not
         :type full: bool
-        :param limit: Limit deepest search to `limit` depth, default 0, no limit
+        :param limit: Limit deepest search to `limit` depth, default 0, no limit. With a limit, the first
+                      directory found is returned without warning
         :type limit: int
         :return: Directory name
         :rtype: str
+        :raises SystemExit: If 'path' not given or does not exist
         """
-        dirs = Utils.get_deepest_dirs(path, full=full, limit=limit)
-        if len(dirs) > 1:
+        if path is None:
+            Utils.error("Path is required")
+        if not os.path.isdir(path):
+            Utils.error("%s does not exists" % str(path))
+        # Only the first two deepest dirs are searched
+        dirs = Utils.iter_dirs(path, max_depth=limit, full=True)
+        deepest = next(dirs, None)
+        if deepest is None:
+            Utils.error("Can't read %s" % str(path))
+        if not limit and next(dirs, None) is not None:
             Utils.warn("More than one deepest dir found at %s: Only first returned" % str(path))
-        return dirs[0]
+        if full:
+            return deepest
+        return os.path.basename(deepest)
 
     @staticmethod
     def get_now():
@@ -218,23 +237,50 @@ class Utils(object):
         :return: List of found subtree
         :rtype: list
         """
-        subtrees = []
         if path is None:
             Utils.warn("No root path directory given")
-            return subtrees
-        loop = 0
-        for dir_path, dir_name, _ in os.walk(path):
-            loop += 1
-            if limit and limit == loop:
-                subtree = dir_path.split(path)[-1]
-                subtree = subtree.lstrip('/')
-                subtrees.append(subtree)
-                break
-            if len(dir_name) == 0:
-                subtree = dir_path.split(path)[-1]
-                subtree = subtree.lstrip('/')
-                subtrees.append(subtree)
-        return subtrees
+            return []
+        return list(Utils.iter_dirs(path, max_depth=limit))
+
+    @staticmethod
+    def iter_dirs(path, max_depth=0, leaves=True, full=False):
+        """
+        Iterate over the directories of a tree, depth first and sorted by name, reading each directory once with
+        scandir. Directories at 'max_depth' are not read and are considered as leaves.
+
+        E.g.: File system is /t/a1/a2/a3 and /t/b1, iter_dirs('/t') -> a1/a2/a3, b1 and
+        iter_dirs('/t', max_depth=2) -> a1, b1
+
+        :param path: Root path of the tree
+        :type path: str
+        :param max_depth: Number of levels to read, root directory is level 1. Default 0, no limit
+        :type max_depth: int
+        :param leaves: Only iterate over leaf directories, otherwise over all directories, root included
+        :type leaves: bool
+        :param full: Complete paths, otherwise paths relative to 'path' (root is '')
+        :type full: bool
+        :return: Generator of directories paths
+        :rtype: generator
+        """
+        # Each directory is stacked with its full and relative paths, none of them is split again
+        stack = [(path, '', 1)]
+        while stack:
+            dir_path, rel_path, depth = stack.pop()
+            sub_dirs = []
+            if not max_depth or depth < max_depth:
+                try:
+                    for entry in scandir(dir_path):
+                        if entry.is_dir():
+                            sub_dirs.append((entry.name, entry.is_symlink()))
+                except OSError:
+                    # Same as os.walk, unreadable directories are skipped
+                    continue
+            if not leaves or not sub_dirs:
+                yield dir_path if full else rel_path
+            # Symlinked directories make their parent a non leaf directory but are not followed, as with os.walk
+            for name, symlink in sorted(sub_dirs, reverse=True):
+                if not symlink:
+                    stack.append((os.path.join(dir_path, name), os.path.join(rel_path, name), depth + 1))
 
     @staticmethod
     def ok(msg):
@@ -1,7 +1,13 @@
 # from __future__ import print_function
 
+import hashlib
+import json
 import ssl
+import time
 import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.results import BulkWriteResult
 from biomajmanager.plugins import BMPlugin
 from biomajmanager.utils import Utils
 from biomajmanager.decorators import deprecated
@@ -14,8 +20,69 @@ class Bioweb(BMPlugin):
     bioinformatics resources (`Bioweb <http://bioweb.pasteur.fr>`)
     """
 
-    CONNECTED = False
     COLLECTION_TYPE = 'bank'
+    # Default number of documents sent with a single bulk write, see 'bioweb.mongo.bulk.size'
+    BULK_SIZE = 1000
+    # Field of the catalog documents storing the hash of their content, see :py:func:`get_document_hash`
+    HASH_FIELD = 'content_hash'
+
+    def __init__(self):
+        """Create the plugin, the database connection is opened by the first update"""
+        super(Bioweb, self).__init__()
+        # MongoDB client, created once by :py:func:`_init_db` and used by all the updates done by the plugin
+        self.mongo_client = None
+        self.dbname = None
+        self.collections = {}
+        # Keep trace of updated documents
+        self.doc_matched = self.doc_modified = self.doc_upserted = 0
+
+    def export_fleet(self, histories, incremental=False, prune=False):
+        """
+        Update the Bioweb.catalog MongoDB collection with the history of many banks
+
+        Documents of all the banks are queued and sent with the same bulk writes, as soon as 'bioweb.mongo.bulk.size'
+        documents are queued, over a single MongoDB connection. Documents not updated and the time spent by a bulk
+        write are given to the banks of the documents it sends. A progress line is printed for each bank once all
+        its documents are sent.
+
+        :param histories: Iterable of (bank name, history), see :py:func:`biomajmanager.manager.Manager.history`.
+                          When a generator is given, a bank history is only built once the previous bank is queued
+        :type histories: iterable
+        :param incremental: Only send new or changed documents, see :py:func:`update_bioweb`
+        :type incremental: bool
+        :param prune: Remove the banks documents not found in their history anymore
+        :type prune: bool
+        :return: List of {'bank', 'documents', 'sent', 'removed', 'errors', 'time'} per bank, 'errors' is the number
+                 of documents not updated, 'time' is the time spent building, checking and sending the bank documents
+        :rtype: list
+        """
+        self._connect()
+        size = self.get_bulk_size()
+        # Queued operations, as (bank index in report, operation)
+        queue = []
+        report = []
+        # Number of operations of each bank not sent yet
+        unsent = []
+        printed = 0
+        for name, history in histories:
+            start = time.time()
+            documents = len(history)
+            history, removed = self._get_changed_documents(name, history, incremental=incremental, prune=prune)
+            queue.extend([(len(report), UpdateOne(Bioweb._get_document_filter(name, item), {'$set': item},
+                                                  upsert=True))
+                          for item in history])
+            report.append({'bank': name, 'documents': documents, 'sent': len(history), 'removed': removed,
+                           'errors': 0, 'time': time.time() - start})
+            unsent.append(len(history))
+            while len(queue) >= size:
+                self._bulk_write_fleet(queue[:size], report, unsent)
+                queue = queue[size:]
+            printed = Bioweb._print_fleet_progress(report, unsent, printed)
+        if queue:
+            self._bulk_write_fleet(queue, report, unsent)
+        Bioweb._print_fleet_progress(report, unsent, printed)
+        self._print_updated_documents(name='fleet')
+        return report
 
     def getCollection(self, name):
         """
@@ -35,6 +102,38 @@ class Bioweb(BMPlugin):
 
         return self.collections[name]
 
+    def get_bulk_size(self):
+        """
+        Get the number of documents sent with a single bulk write ('bioweb.mongo.bulk.size')
+
+        :return: Number of documents, default :py:const:`Bioweb.BULK_SIZE`
+        :rtype: int
+        :raises SystemExit: If 'bioweb.mongo.bulk.size' is not a positive integer
+        """
+        size = Bioweb.BULK_SIZE
+        if self.config.has_option(self.get_name(), 'bioweb.mongo.bulk.size'):
+            try:
+                size = int(self.config.get(self.get_name(), 'bioweb.mongo.bulk.size'))
+            except ValueError:
+                size = 0
+            if size < 1:
+                Utils.error("'bioweb.mongo.bulk.size' must be a positive integer, got '%s'" %
+                            self.config.get(self.get_name(), 'bioweb.mongo.bulk.size'))
+        return size
+
+    @staticmethod
+    def get_document_hash(document):
+        """
+        Get the hash of a catalog document content, used to send only changed documents
+
+        :param document: Catalog document, :py:const:`Bioweb.HASH_FIELD` is not part of the content
+        :type document: dict
+        :return: SHA1 hex digest
+        :rtype: str
+        """
+        content = dict([(key, value) for key, value in document.items() if key != Bioweb.HASH_FIELD])
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
     def get_info_for_bank(self, name):
         """
         Test method to retrieve information from MongoDB (Bioweb) database
@@ -45,8 +144,7 @@ class Bioweb(BMPlugin):
         :rtype: :class:`pymongo.cursor`
         """
 
-        if not Bioweb.CONNECTED:
-            self._init_db()
+        self._connect()
 
         query = {}
         if name:
@@ -77,15 +175,25 @@ class Bioweb(BMPlugin):
         Utils.warn("Can't set new %s bank version, not published yet" % self.manager.bank.name)
         return False
 
-    def update_bioweb(self):
+    def update_bioweb(self, incremental=False, prune=False):
         """
         Update the Bioweb.catalog MongoDB collection
 
+        Documents are stored with the hash of their content (:py:const:`Bioweb.HASH_FIELD`). In incremental mode, the
+        hashes of the bank documents are fetched with a single query and only new or changed documents are sent.
+
+        :param incremental: Only send new or changed documents
+        :type incremental: bool
+        :param prune: Remove the bank documents not found in the history anymore
+        :type prune: bool
         :return: Boolean
         :rtype: boole
         """
 
-        history = self.manager.history()
+        history, _ = self._get_changed_documents(self.manager.bank.name, self.manager.history(),
+                                                 incremental=incremental, prune=prune)
+        if incremental and not history:
+            return True
         if not self._update_mongodb(data=history):
             Utils.error("Can't update bioweb.catalog")
 
@@ -180,8 +288,7 @@ class Bioweb(BMPlugin):
 
         if not collection:
             Utils.error("A collection name is required")
-        if not Bioweb.CONNECTED:
-            self._init_db()
+        self._connect()
 
         if (pymongo.version_tuple)[0] > 2:
             res = self.getCollection(collection).update_one(filter, {'$set': data}, upsert=True)
@@ -194,6 +301,87 @@ class Bioweb(BMPlugin):
     Private methods
     """
 
+    def _connect(self):
+        """Connect to the Mongodb database, once for all the updates"""
+        if self.mongo_client is None:
+            self._init_db()
+
+    def _get_changed_documents(self, name, history, incremental=False, prune=False):
+        """
+        Get the bank history documents to send, copied with the hash of their content
+
+        :param name: Bank name
+        :type name: str
+        :param history: Bank history documents
+        :type history: list
+        :param incremental: Only keep new or changed documents
+        :type incremental: bool
+        :param prune: Remove the bank documents not found in the history from the catalog
+        :type prune: bool
+        :return: (list of documents to send, number of removed documents)
+        :rtype: tuple
+        """
+        documents = []
+        for item in history:
+            # Hash the content only, a hash already set in the history item is not part of it
+            document = dict([(key, value) for key, value in item.items() if key != Bioweb.HASH_FIELD])
+            document[Bioweb.HASH_FIELD] = Bioweb.get_document_hash(document)
+            documents.append(document)
+        history = documents
+        removed = 0
+        if incremental or prune:
+            hashes = self._get_documents_hashes(bank=name)
+            if prune:
+                ids = set([item['_id'] for item in history if '_id' in item])
+                removed = self._remove_documents([_id for _id in hashes if _id not in ids], bank=name)
+            if incremental:
+                changed = [item for item in history
+                           if '_id' not in item or hashes.get(item['_id']) != item[Bioweb.HASH_FIELD]]
+                Utils.verbose("[%s] %d/%d document(s) to update" % (name, len(changed), len(history)))
+                history = changed
+        return history, removed
+
+    @staticmethod
+    def _get_document_filter(name, item, params=None):
+        """
+        Get the filter matching the catalog document of a bank history item
+
+        :param name: Bank name
+        :type name: str
+        :param item: History item
+        :type item: dict
+        :param params: Extra parameters to filter documents
+        :type params: dict
+        :return: Filter
+        :rtype: dict
+        """
+        search_params = {'type': Bioweb.COLLECTION_TYPE, 'name': name}
+        if params is not None:
+            search_params.update(params)
+        if '_id' in item:
+            search_params['_id'] = item['_id']
+        return search_params
+
+    def _get_documents_hashes(self, collection='catalog', bank=None):
+        """
+        Get the content hashes of the bank documents, with a single query returning only ids and hashes
+
+        :param collection: Collection name (Default 'catalog')
+        :type collection: str
+        :param bank: Bank name, default manager bank
+        :type bank: str
+        :return: Document '_id' as key and content hash as value, None for documents stored without hash
+        :rtype: dict
+        """
+        if bank is None:
+            bank = self.manager.bank.name
+        if not bank:
+            Utils.error("Can't get documents, bank name required")
+        self._connect()
+        cursor = self.getCollection(collection).find({'type': Bioweb.COLLECTION_TYPE, 'name': bank},
+                                                      {Bioweb.HASH_FIELD: 1})
+        return dict([(doc['_id'], doc.get(Bioweb.HASH_FIELD)) for doc in cursor])
+
     def _init_db(self):
         """Load and connect to Mongodb database"""
         if not self.config:
@@ -236,13 +424,88 @@ class Bioweb(BMPlugin):
         except Exception as err:
             raise Exception("Error while setting Mongo configuration: %s" % str(err))
 
-        Bioweb.CONNECTED = True
+    def _bulk_write(self, collection, operations, bank=None):
+        """
+        Send write operations to a collection with unordered bulk writes of 'bioweb.mongo.bulk.size' operations
+
+        Documents counts of each bulk write, even a failed one, are added to the matched/modified/upserted counters
+
+        :param collection: Collection name
+        :type collection: str
+        :param operations: List of write operations (:class:`pymongo.UpdateOne`, ...)
+        :type operations: list
+        :param bank: Bank name used in messages, default manager bank
+        :type bank: str
+        :return: Boolean, False if a document was not updated
+        :rtype: bool
+        """
+        if bank is None:
+            bank = self.manager.bank.name
+        size = self.get_bulk_size()
+        updated = True
+        for start in range(0, len(operations), size):
+            try:
+                res = self.getCollection(collection).bulk_write(operations[start:start + size], ordered=False)
+            except BulkWriteError as err:
+                # Unordered, all the operations but the failed ones have been applied
+                self._update_documents_counts(err.details)
+                errors = err.details.get('writeErrors', [])
+                Utils.warn("[%s] %d document(s) not updated in %s: %s" %
+                           (bank, len(errors), collection,
+                            errors[0].get('errmsg') if errors else str(err)))
+                updated = False
+                continue
+            except PyMongoError as err:
+                Utils.warn("[%s] Can't update %s: %s" % (bank, collection, str(err)))
+                return False
+            self._update_documents_counts(res)
+        return updated
+
+    def _bulk_write_fleet(self, queue, report, unsent, collection='catalog'):
+        """
+        Send the operations queued by :py:func:`export_fleet` with a single unordered bulk write
+
+        The documents not updated and the time spent are added to the banks of the documents, the time in proportion
+        of their number of documents.
+
+        :param queue: Operations, as (bank index in report, operation)
+        :type queue: list
+        :param report: Banks report, see :py:func:`export_fleet`
+        :type report: list
+        :param unsent: Number of operations of each bank not sent yet, updated
+        :type unsent: list
+        :param collection: Collection name (Default 'catalog')
+        :type collection: str
+        :return: Boolean, False if a document was not updated
+        :rtype: bool
+        """
+        start = time.time()
+        failed = []
+        try:
+            res = self.getCollection(collection).bulk_write([operation for _, operation in queue], ordered=False)
+            self._update_documents_counts(res)
+        except BulkWriteError as err:
+            # Unordered, all the operations but the failed ones have been applied
+            self._update_documents_counts(err.details)
+            failed = [(queue[error['index']][0], error.get('errmsg')) for error in err.details.get('writeErrors', [])]
+        except PyMongoError as err:
+            failed = [(index, str(err)) for index, _ in queue]
+        spent = (time.time() - start) / len(queue)
+        for index, _ in queue:
+            report[index]['time'] += spent
+            unsent[index] -= 1
+        for index in sorted(set([index for index, _ in failed])):
+            errors = [message for bank, message in failed if bank == index]
+            report[index]['errors'] += len(errors)
+            Utils.warn("[%s] %d document(s) not updated in %s: %s" %
+                       (report[index]['bank'], len(errors), collection, errors[0]))
+        return not failed
 
     def _update_mongodb(self, data=None, collection='catalog', params=None, upsert=True):
         """
         Function that really update the Mongodb collection ('catalog')
 
-        It does an upsert to update the collection
+        It does an upsert to update the collection, documents are sent with bulk writes (see :py:func:`_bulk_write`)
 
         :param data: Data to be updated
         :type data: dict
@@ -261,42 +524,74 @@ class Bioweb(BMPlugin):
             Utils.warn("[%s] No data to update bioweb catalog" % self.manager.bank.name)
             return True
 
-        if not Bioweb.CONNECTED:
-            self._init_db()
+        self._connect()
 
-        # Find arguments
-        search_params = {'type': Bioweb.COLLECTION_TYPE, 'name': self.manager.bank.name}
+        # Each document has its own filter, an item without '_id' must not match the previous item '_id'
+        filters = [Bioweb._get_document_filter(self.manager.bank.name, item, params=params) for item in data]
 
-        # Extra serach parameters?
-        if params is not None:
-            search_params.update(params)
+        if (pymongo.version_tuple)[0] > 2:
+            updated = self._bulk_write(collection, [UpdateOne(item_params, {'$set': item}, upsert=upsert)
+                                                    for item_params, item in zip(filters, data)])
+        else:
+            updated = True
+            for item_params, item in zip(filters, data):
+                res = self.getCollection(collection).update(item_params, {'$set': item}, upsert=upsert)
+                self._update_documents_counts(res)
+        self._print_updated_documents()
+        return updated
+
+    def _remove_documents(self, ids, collection='catalog', bank=None):
+        """
+        Remove documents of the bank from a collection
 
-        for item in data:
-            if '_id' in item:
-                search_params['_id'] = item['_id']
+        :param ids: List of documents '_id'
+        :type ids: list
+        :param collection: Collection name (Default 'catalog')
+        :type collection: str
+        :param bank: Bank name, default manager bank
+        :type bank: str
+        :return: Number of removed documents
+        :rtype: int
+        :raises SystemExit: If documents can't be removed
+        """
+        if not ids:
+            return 0
+        if bank is None:
+            bank = self.manager.bank.name
+        self._connect()
+        query = {'type': Bioweb.COLLECTION_TYPE, 'name': bank, '_id': {'$in': ids}}
+        try:
             if (pymongo.version_tuple)[0] > 2:
-                res = self.getCollection(collection).update_one(search_params, {'$set': item},
-                                                                upsert=upsert)
+                removed = self.getCollection(collection).delete_many(query).deleted_count
             else:
-                res = self.getCollection(collection).update(search_params, {'$set': item},
-                                                            upsert=upsert)
-            self._update_documents_counts(res)
-        self._print_updated_documents()
-        return True
+                removed = self.getCollection(collection).remove(query)['n']
+        except PyMongoError as err:
+            Utils.error("[%s] Can't remove documents from %s: %s" % (bank, collection, str(err)))
+        Utils.ok("[%s] %d document(s) removed from %s" % (bank, removed, collection))
+        return removed
 
     def _update_documents_counts(self, res):
         """
         Update internal counter about matched/modified/upserted documents during an update
 
         :param res: Result return by an update
-        :type res: Depending on pymongo version (3.2=UpdateResult, 2.x=Dict)
+        :type res: Depending on pymongo version (3.2=UpdateResult, 2.x=Dict), :class:`pymongo.results.BulkWriteResult`
+                   for a bulk write or :class:`pymongo.errors.BulkWriteError` details (Dict) for a failed one
         :return: Boolean
         :rtype: bool
         """
         if not res:
             return False
 
-        if (pymongo.version_tuple)[0] > 2:
+        if isinstance(res, BulkWriteResult):
+            self.doc_matched += res.matched_count
+            self.doc_modified += res.modified_count
+            self.doc_upserted += res.upserted_count
+        elif isinstance(res, dict) and 'nUpserted' in res:
+            self.doc_matched += res.get('nMatched', 0)
+            self.doc_modified += res.get('nModified', 0)
+            self.doc_upserted += res.get('nUpserted', 0)
+        elif (pymongo.version_tuple)[0] > 2:
             self.doc_matched += res.matched_count
             self.doc_modified += res.modified_count
             if res.upserted_id:
@@ -310,17 +605,43 @@ class Bioweb(BMPlugin):
 
         return True
 
-    def _print_updated_documents(self):
+    @staticmethod
+    def _print_fleet_progress(report, unsent, start=0):
+        """
+        Print the progress line of the banks of :py:func:`export_fleet` whose documents are all sent, in banks order
+
+        :param report: Banks report, see :py:func:`export_fleet`
+        :type report: list
+        :param unsent: Number of operations of each bank not sent yet
+        :type unsent: list
+        :param start: Index of the first bank not printed yet
+        :type start: int
+        :return: Index of the first bank not printed yet
+        :rtype: int
+        """
+        index = start
+        while index < len(report) and not unsent[index]:
+            bank = report[index]
+            index += 1
+            Utils.ok("[%d] [%s] %d document(s), %d sent, %d removed (%f sec)" %
+                     (index, bank['bank'], bank['documents'], bank['sent'], bank['removed'], bank['time']))
+        return index
+
+    def _print_updated_documents(self, name=None):
         """
         Print a small report of action(s) done duinrg the update
 
+        :param name: Name printed with the report, default manager bank name
+        :type name: str
         :return: Boolean
         :rtype: bool
         """
         if not self.get_manager().get_verbose():
             return True
         bank = ""
-        if self.manager.bank:
+        if name is not None:
+            bank = "[%s] " % name
+        elif self.manager.bank:
             bank = "[%s] " % self.manager.bank.name
         Utils.ok("%sDocument(s) modification(s):\n\tMatched %d\n\tUpdated %d\n\tInserted %d"
                  % (bank, self.doc_matched, self.doc_modified, self.doc_upserted))
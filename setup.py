@@ -42,7 +42,8 @@ config = {
                          'Jinja2',
                          'Yapsy',
                          'rfeed',
-                         'humanfriendly'],
+                         'humanfriendly',
+                         'scandir; python_version < "3.5"'],
     'include_package_data': True,
     'author': 'Emmanuel Quevillon',
     'author_email': 'tuco@pasteur.fr,horkko@gmail.com',
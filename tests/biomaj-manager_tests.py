@@ -1,19 +1,33 @@
 """Small testing script to test biomajmanager functionality"""
 from __future__ import print_function
+import copy
 import shutil
 import os
+import sys
 import tempfile
 import time
 import unittest
 from nose.plugins.attrib import attr
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.results import BulkWriteResult, DeleteResult
 from datetime import datetime
-from biomajmanager.links import Links
+from multiprocessing.pool import ThreadPool
+from biomajmanager.bankview import BankView
+from biomajmanager.catalog import FormatCatalog
+from biomajmanager.config import BankProperties, ConfigCache, ConfigParser, PropertiesStore
+from biomajmanager.decorators import bank_fields
+from biomajmanager.fleet import FleetSnapshot, BankSnapshot
+from biomajmanager.inventory import LinkInventory
+from biomajmanager.links import Links, LinkPlan, LinkWriter
 from biomajmanager.manager import Manager
 from biomajmanager.news import News, RSS
-from biomajmanager.plugins import Plugins
+from biomajmanager.plugins import PluginRegistry, Plugins
+from biomajmanager.scanner import LinkCleaner, LinkScanner
 from biomajmanager.writer import Writer
 from biomajmanager.utils import Utils
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'plugins'))
+from bioweb import Bioweb
 
 __author__ = 'tuco'
 
@@ -204,6 +218,57 @@ class UtilsForTests(object):
             fout.close()
 
 
+class CollectionForTests(object):
+    """In memory collection, keeping the documents by '_id' and recording the bulk writes it receives"""
+
+    def __init__(self, documents=None, errors=None):
+        """
+        Create the collection
+
+        :param documents: Documents stored in the collection
+        :type documents: list
+        :param errors: Exceptions raised by the next bulk writes, None to apply the bulk write
+        :type errors: list
+        """
+        self.documents = dict([(doc['_id'], doc) for doc in documents or []])
+        self.errors = errors or []
+        self.bulks = []
+        self.finds = 0
+
+    def bulk_write(self, operations, ordered=True):
+        """Apply UpdateOne operations matching on '_id', after raising the next error if any"""
+        self.bulks.append({'size': len(operations), 'ordered': ordered})
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        result = {'nMatched': 0, 'nModified': 0, 'nUpserted': 0, 'upserted': []}
+        for index, operation in enumerate(operations):
+            _id = operation._filter['_id']
+            if _id in self.documents:
+                result['nMatched'] += 1
+                result['nModified'] += 1
+                self.documents[_id].update(operation._doc['$set'])
+            else:
+                result['nUpserted'] += 1
+                result['upserted'].append({'index': index, '_id': _id})
+                self.documents[_id] = dict(operation._doc['$set'])
+        return BulkWriteResult(result, True)
+
+    def delete_many(self, query):
+        """Remove the documents of a bank matching '_id' $in query"""
+        ids = [_id for _id in query['_id']['$in']
+               if _id in self.documents and self.documents[_id]['name'] == query['name']]
+        for _id in ids:
+            del self.documents[_id]
+        return DeleteResult({'n': len(ids)}, True)
+
+    def find(self, query, projection=None):
+        """Find the documents of a bank, 'projection' is not applied"""
+        self.finds += 1
+        return [doc for doc in self.documents.values() if doc['name'] == query['name']]
+
+
 class TestBiomajManagerUtils(unittest.TestCase):
     """Class for testing manager.utils class"""
 
@@ -355,6 +420,42 @@ class TestBiomajManagerUtils(unittest.TestCase):
         self.assertEqual(utils.get_broken_links(path=root), 1)
         os.remove(link)
 
+    @attr('utils')
+    @attr('utils.getbrokenlinks')
+    def test_LinkScannerOK(self):
+        """Check broken links are found in all directories, links into the same directory cost one read"""
+        release = os.path.join(self.utils.data_dir, 'release')
+        os.makedirs(release)
+        os.symlink(release, os.path.join(self.utils.data_dir, 'current'))
+        for index in range(20):
+            open(os.path.join(release, 'file%d' % index), 'w').close()
+        tree = os.path.join(self.utils.tmp_dir, 'index', 'tool')
+        os.makedirs(tree)
+        for index in range(20):
+            os.symlink(os.path.relpath(os.path.join(self.utils.data_dir, 'current', 'file%d' % index), tree),
+                       os.path.join(tree, 'file%d' % index))
+        os.symlink(os.path.join(self.utils.data_dir, 'current', 'not_found'), os.path.join(tree, 'not_found'))
+        os.symlink('/not_found/file', os.path.join(self.utils.tmp_dir, 'index', 'broken'))
+        scanner = LinkScanner(workers=2)
+        results = dict(scanner.scan(self.utils.tmp_dir))
+        self.assertListEqual(results[os.path.join(self.utils.tmp_dir, 'index')],
+                             [os.path.join(self.utils.tmp_dir, 'index', 'broken')])
+        self.assertListEqual(results[tree], [os.path.join(tree, 'not_found')])
+        self.assertEqual(scanner.links, 22)
+        self.assertEqual(scanner.broken, 2)
+        # 'current' and '/not_found' directories
+        self.assertEqual(scanner.stats, 2)
+
+    @attr('utils')
+    @attr('utils.getbrokenlinks')
+    def test_LinkScannerResolveOK(self):
+        """Check links values are resolved without the file system only when possible"""
+        self.assertEqual(LinkScanner._resolve('/prod/index', '../../data/alu/current/file'), '/data/alu/current/file')
+        self.assertEqual(LinkScanner._resolve('/prod/index', '/data/alu/file'), '/data/alu/file')
+        self.assertIsNone(LinkScanner._resolve('/prod/index', '../data/current/../alu_54/file'))
+        self.assertEqual(LinkScanner._resolve('/prod/index', '..'), '/prod')
+        self.assertIsNone(LinkScanner._resolve('/', '..'))
+
     @attr('utils')
     @attr('utils.deepestdirs')
     def test_DeepestDirsFull(self):
@@ -389,6 +490,26 @@ class TestBiomajManagerUtils(unittest.TestCase):
         self.assertEqual(d1, dir2)
         shutil.rmtree(self.utils.tmp_dir)
 
+    @attr('utils')
+    @attr('utils.iterdirs')
+    def test_IterDirsOK(self):
+        """Check we get leaf directories, bounded by depth"""
+        root = os.path.join(self.utils.tmp_dir, 'tree')
+        for tdir in [os.path.join('a1', 'a2', 'a3'), os.path.join('a1', 'b2'), 'b1']:
+            os.makedirs(os.path.join(root, tdir))
+        self.assertListEqual(list(Utils.iter_dirs(root)), [os.path.join('a1', 'a2', 'a3'), os.path.join('a1', 'b2'),
+                                                           'b1'])
+        # Same as os.walk, a symlinked directory is not followed but its parent is no more a leaf
+        os.symlink(os.path.join(root, 'a1'), os.path.join(root, 'b1', 'link'))
+        self.assertListEqual(list(Utils.iter_dirs(root)), [os.path.join('a1', 'a2', 'a3'), os.path.join('a1', 'b2')])
+        self.assertListEqual(list(Utils.iter_dirs(root, max_depth=2)), ['a1', 'b1'])
+        self.assertListEqual(list(Utils.iter_dirs(root, max_depth=1, full=True)), [root])
+        self.assertListEqual(list(Utils.iter_dirs(root, max_depth=3, leaves=False)),
+                             ['', 'a1', os.path.join('a1', 'a2'), os.path.join('a1', 'b2'), 'b1'])
+        self.assertListEqual(Utils.get_subtree(root, limit=3), [os.path.join('a1', 'a2'), os.path.join('a1', 'b2')])
+        self.assertEqual(Utils.get_deepest_dir(root, limit=2), 'a1')
+        shutil.rmtree(self.utils.tmp_dir)
+
     @attr('utils')
     @attr('utils.getfiles')
     def test_GetFiles(self):
@@ -802,31 +923,41 @@ class TestBiomajManagerLinks(unittest.TestCase):
         # As we created an entry in the database ('alu'), we clean the database
         self.utils.drop_db()
 
+    @staticmethod
+    def take_plan(links):
+        """Get the plan built by the Links private methods, as build_plan does before it is applied"""
+        plan, links.plan = links.plan, None
+        return plan
+
     @attr('links')
     @attr('links.clonestructure')
     def test_clonsestructre(self):
         """Checks method build subtree structure correctly"""
         links = Links(manager=self.utils.manager)
         links.manager.set_verbose(True)
+        links.plan = LinkPlan(bank='alu')
         links._clone_structure(source='blast2', target='index')
+        links.apply_plan(self.take_plan(links))
         self.assertTrue(os.path.isfile(os.path.join(self.utils.prod_dir, 'index', 'blast2', 'news1.txt')))
 
     @attr('links')
     @attr('links.clonestructure')
-    def test_cloneStructureWtihSimulateAndVerbose(self):
-        """Check no target are created"""
+    def test_cloneStructureNothingCreated(self):
+        """Check no target are created, directories and links are only planned"""
         links = Links(manager=self.utils.manager)
-        links.manager.set_simulate(True)
-        links.manager.set_verbose(True)
+        links.plan = LinkPlan(bank='alu')
         self.assertTrue(links._clone_structure(source='blast2', target='index'))
+        self.assertEqual(len(links.plan.get_dirs()), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.utils.prod_dir, 'index')))
 
     @attr('links')
     @attr('links.clonestructure')
     def test_cloneStructureWithRemoveExt(self):
         """Check the method add some more created links due to remove_ext option"""
         links = Links(manager=self.utils.manager)
+        links.plan = LinkPlan(bank='alu')
         links._clone_structure(source='blast2', target='index', remove_ext=True)
-        self.assertEqual(links.created_links, 2)
+        self.assertEqual(len(links.plan.get_links()), 2)
 
     @attr('links')
     @attr('links.clonestructure')
@@ -834,8 +965,9 @@ class TestBiomajManagerLinks(unittest.TestCase):
         """Check the method add some more created links due to remove_ext option"""
         links = Links(manager=self.utils.manager)
         links.manager.set_verbose(True)
+        links.plan = LinkPlan(bank='alu')
         links._clone_structure(source='golden', target='index', remove_ext=True)
-        self.assertEqual(links.created_links, 2)
+        self.assertEqual(links.apply_plan(self.take_plan(links)), 2)
 
     @attr('links')
     @attr('links.clonestructure')
@@ -844,8 +976,10 @@ class TestBiomajManagerLinks(unittest.TestCase):
         links = Links(manager=self.utils.manager)
         links.manager.set_verbose(False)
         os.chmod(self.utils.prod_dir, self.utils.no_dir_rights)
+        links.plan = LinkPlan(bank='alu')
+        links._clone_structure(source='golden', target='index', remove_ext=True)
         with self.assertRaises(SystemExit):
-            links._clone_structure(source='golden', target='index', remove_ext=True)
+            links.apply_plan(self.take_plan(links))
         os.chmod(self.utils.prod_dir, self.utils.full_dir_rights)
 
     @attr('links')
@@ -916,6 +1050,28 @@ class TestBiomajManagerLinks(unittest.TestCase):
         self.assertEqual(links.check_links(clone_dirs=self.utils.clones,
                                            dirs=self.utils.dirs,
                                            files=self.utils.files), 10)
+        # Simulate and verbose modes are left untouched
+        self.assertTrue(Manager.get_simulate())
+        self.assertTrue(Manager.get_verbose())
+        self.assertFalse(os.path.exists(os.path.join(self.utils.prod_dir, 'index')))
+
+    @attr('links')
+    @attr('links.checklinks')
+    def test_LinksCheckLinksSavePlanOK(self):
+        """Check the plan is saved and can be applied"""
+        links = Links(manager=self.utils.manager)
+        plan_file = os.path.join(self.utils.test_dir, 'alu.plan')
+        self.assertEqual(links.check_links(save=plan_file, clone_dirs=self.utils.clones, dirs=self.utils.dirs,
+                                           files=self.utils.files), 10)
+        # Files linked by both clone_dirs and files are planned once
+        plan = LinkPlan.load(plan_file)
+        self.assertEqual(plan.bank, 'alu')
+        self.assertEqual(len(plan.get_links()), 8)
+        self.assertEqual(Links(manager=self.utils.manager).do_links(plan=plan), 8)
+        self.assertTrue(os.path.islink(os.path.join(self.utils.prod_dir, 'index', 'blast2', 'news1.txt')))
+        self.assertTrue(os.path.isfile(os.path.join(self.utils.prod_dir, 'index', 'blast2', 'news1.txt')))
+        # Applying the plan again creates nothing
+        self.assertEqual(Links(manager=self.utils.manager).do_links(plan=plan), 0)
 
     @attr('links')
     @attr('links.dolinks')
@@ -1028,8 +1184,10 @@ class TestBiomajManagerLinks(unittest.TestCase):
         link = Links(manager=self.utils.manager)
         link.manager.set_verbose(True)
         os.chmod(self.utils.prod_dir, self.utils.no_dir_rights)
+        link.plan = LinkPlan(bank='alu')
+        link._prepare_links(source='uncompressed', target='link_test')
         with self.assertRaises(SystemExit):
-            link._prepare_links(source='uncompressed', target='link_test')
+            link.apply_plan(self.take_plan(link))
         os.chmod(self.utils.prod_dir, self.utils.full_dir_rights)
 
     @attr('links')
@@ -1037,6 +1195,7 @@ class TestBiomajManagerLinks(unittest.TestCase):
     def test_LinksPrepareLinksWithFallbackOK(self):
         """Check method passes OK if fallback given"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         # Remove uncompressed directory, and fallback to flat
         os.removedirs(os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'uncompressed'))
         link.manager.set_verbose(True)
@@ -1058,18 +1217,20 @@ class TestBiomajManagerLinks(unittest.TestCase):
     def test_LinksPrepareLinksWithFallbackUseDeepestOK(self):
         """Check method passes OK if fallback given"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         # Remove uncompressed directory, and fallback to flat
         self.assertTrue(link._prepare_links(source='uncompressed', target='flat_test', get_deepest=True))
 
     @attr('links')
     @attr('links.preparelinks')
-    def test_LinksPrepareLinksWithSimulateModeOK(self):
-        """Check method prints in simulate mode"""
+    def test_LinksPrepareLinksPlansTargetDir(self):
+        """Check target directory is planned, not created"""
         link = Links(manager=self.utils.manager)
-        link.manager.set_simulate(True)
-        link.manager.set_verbose(True)
-        # Remove uncompressed directory, and fallback to flat
+        link.plan = LinkPlan(bank='alu')
         self.assertTrue(link._prepare_links(source='uncompressed', target='flat_test'))
+        self.assertListEqual(link.plan.get_dirs(), [{'op': LinkPlan.MKDIR,
+                                                     'target': os.path.join(self.utils.prod_dir, 'flat_test')}])
+        self.assertFalse(os.path.exists(os.path.join(self.utils.prod_dir, 'flat_test')))
 
     @attr('links')
     @attr('links.preparelinks')
@@ -1095,6 +1256,7 @@ class TestBiomajManagerLinks(unittest.TestCase):
     def test_LinksMakeLinksPathAlreadyExistsReturns0(self):
         """Check the method returns 0 because source and target already exist"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'uncompressed')
         target = os.path.join(self.utils.prod_dir, 'uncmp_link')
         os.symlink(os.path.relpath(source, start=target), target)
@@ -1103,53 +1265,59 @@ class TestBiomajManagerLinks(unittest.TestCase):
 
     @attr('links')
     @attr('links.makelinks')
-    def test_LinksMakeLinksPathNotExistsSimulateOnVerboseOnReturns0(self):
-        """Check the method returns 0 because simulate and verbose mode on"""
+    def test_LinksMakeLinksPathNotExistsPlannedOnce(self):
+        """Check a link is planned once, and only counted again for check_links"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'uncompressed')
         target = os.path.join(self.utils.prod_dir, 'uncmp_link')
-        link.manager.set_simulate(True)
-        link.manager.set_verbose(True)
         link._prepare_links(source=source, target=target)
-        self.assertEqual(0, link._make_links(links=[(source, target)]))
+        self.assertEqual(1, link._make_links(links=[(source, os.path.join(target, 'uncmp'))]))
+        self.assertEqual(1, link._make_links(links=[(source, os.path.join(target, 'uncmp'))]))
+        self.assertEqual(link.duplicates, 1)
+        self.assertFalse(os.path.exists(target))
 
     @attr('links')
     @attr('links.makelinks')
-    def test_LinksMakeLinksPathNotExistsSimulateOnVerboseOffReturns1(self):
-        """Check the method returns 1 because simulate on and verbose off, nothing created but link added as created"""
+    def test_LinksMakeLinksRelativeSymlinkHardLinkSource(self):
+        """Check symlinks sources are relative to the link directory, hard links sources are kept"""
         link = Links(manager=self.utils.manager)
-        source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'uncompressed')
-        target = os.path.join(self.utils.prod_dir, 'uncmp_link')
-        link.manager.set_simulate(True)
-        link.manager.set_verbose(False)
-        link._prepare_links(source=source, target=target)
-        self.assertEqual(1, link._make_links(links=[(source, target)]))
+        link.plan = LinkPlan(bank='alu')
+        source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'flat', 'file1.txt')
+        target = os.path.join(self.utils.prod_dir, 'flat_test')
+        link.target = target
+        link._make_links(links=[(source, os.path.join(target, 'file1.txt'))])
+        link._make_links(links=[(source, os.path.join(target, 'file1'))], hard=True)
+        self.assertListEqual([operation['source'] for operation in link.plan.get_links()],
+                             [os.path.relpath(source, start=target), source])
 
     @attr('links')
     @attr('links.makelinks')
     def test_LinksMakeLinksPathNotExistsHardTrueThrowsError(self):
-        """Check the method throws an exception (OSError=>SystemExit) with (hard=True)"""
+        """Check applying the plan throws an exception (OSError=>SystemExit) with (hard=True)"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'uncompressed')
         target = os.path.join(self.utils.prod_dir, 'uncmp_link')
         link._prepare_links(source=source, target=target)
-        # We delete the source directory to raise an OSError
-        os.removedirs(target)
+        # A directory can't be hard linked
+        link._make_links(links=[(source, os.path.join(target, 'uncmp'))], hard=True)
         with self.assertRaises(SystemExit):
-            link._make_links(links=[(source, target)], hard=True)
+            link.apply_plan(self.take_plan(link))
 
     @attr('links')
     @attr('links.makelinks')
     def test_LinksMakeLinksPathNotExistsHardFalseThrowsError(self):
-        """Check the method throws an exception (OSError=>SystemExit) with (hard=False)"""
+        """Check applying the plan throws an exception (OSError=>SystemExit) with (hard=False)"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'uncompressed')
         target = os.path.join(self.utils.prod_dir, 'uncmp_link')
-        link._prepare_links(source=source, target=target)
-        # We delete the source directory to raise an OSError
-        os.removedirs(target)
+        link.target = target
+        # Link directory is not planned
+        link._make_links(links=[(source, os.path.join(target, 'uncmp'))])
         with self.assertRaises(SystemExit):
-            link._make_links(links=[(source, target)])
+            link.apply_plan(self.take_plan(link))
 
     @attr('links')
     @attr('links.generatefileslink')
@@ -1165,6 +1333,7 @@ class TestBiomajManagerLinks(unittest.TestCase):
     def test_LinksGenerateFilesLinkNotNoExtCreatedLinksOKVerboseOn(self):
         """Check method returns correct number of created links (no_ext=False)"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         # Set our manager verbose mode to on
         link.manager.set_verbose(True)
         source_dir = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'flat')
@@ -1173,37 +1342,36 @@ class TestBiomajManagerLinks(unittest.TestCase):
         # Create files to link
         for ifile in files:
             open(os.path.join(source_dir, ifile), 'w').close()
-        # We check we've created 2 link, for file1 and file2
+        # We check we've planned 2 link, for file1 and file2
         self.assertEqual(2, link._generate_files_link(source='flat', target='flat_symlink'))
         # We can also check link.source and link.target are equal to our source_dir and target_dir
         self.assertEqual(os.path.join(self.utils.data_dir, 'alu', 'current', 'flat'), link.source)
         self.assertEqual(target_dir, link.target)
+        self.assertEqual(2, link.apply_plan(self.take_plan(link)))
+        self.assertTrue(os.path.isfile(os.path.join(target_dir, 'file1.txt')))
 
     @attr('links')
     @attr('links.generatefileslink')
-    def test_LinksGenerateFilesLinkNotNoExtCreatedLinksOKVerboseOnSmulateOn(self):
-        """Check method returns correct number of created links (no_ext=False)"""
+    def test_LinksGenerateFilesLinkNothingCreated(self):
+        """Check links are planned and not created"""
         link = Links(manager=self.utils.manager)
-        # Set our manager verbose mode to on
-        link.manager.set_verbose(True)
-        link.manager.set_simulate(True)
+        link.plan = LinkPlan(bank='alu')
         source_dir = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'flat')
         target_dir = os.path.join(self.utils.prod_dir, 'flat_symlink')
         files = ['file1.txt', 'file2.txt']
         # Create list of file to link
         for ifile in files:
             open(os.path.join(source_dir, ifile), 'w').close()
-        # We check we've created 2 link, for file1 and file2
-        self.assertEqual(0, link._generate_files_link(source='flat', target='flat_symlink'))
-        # We can also check link.source and link.target are equal to our source_dir and target_dir
-        self.assertEqual(os.path.join(self.utils.data_dir, 'alu', 'current', 'flat'), link.source)
-        self.assertEqual(target_dir, link.target)
+        self.assertEqual(2, link._generate_files_link(source='flat', target='flat_symlink'))
+        self.assertFalse(os.path.exists(target_dir))
+        self.assertEqual(link.created_links, 0)
 
     @attr('links')
     @attr('links.generatefileslink')
     def test_LinksGenerateFilesLinkNotNoExtCreatedLinksOKVerboseOnRemoveExtTrue(self):
         """Check method returns correct number of created links (remove_ext=True)"""
         link = Links(manager=self.utils.manager)
+        link.plan = LinkPlan(bank='alu')
         # Set our manager verbose mode to on
         link.manager.set_verbose(True)
         source_dir = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'flat')
@@ -1212,8 +1380,9 @@ class TestBiomajManagerLinks(unittest.TestCase):
         # Create list of file to link
         for i_file in files:
             open(os.path.join(source_dir, i_file), 'w').close()
-        # We check we've created 4 link, for file1 and file2 twice (with and without extension)
+        # We check we've planned 4 link, for file1 and file2 twice (with and without extension)
         self.assertEqual(4, link._generate_files_link(source='flat', target='flat_symlink', remove_ext=True))
+        link.apply_plan(self.take_plan(link))
         # We check the created links are OK without the extention (.txt)
         self.assertTrue(os.path.islink(os.path.join(target_dir, 'file1')))
         self.assertTrue(os.path.islink(os.path.join(target_dir, 'file2')))
@@ -1229,15 +1398,409 @@ class TestBiomajManagerLinks(unittest.TestCase):
 
     @attr('links')
     @attr('links.generatedirlink')
-    def test_LinksGenerateDirLink_PrepareLinksReturns0SimulateOnVerobseOn(self):
-        """Check _generate_files_link returns 0 because prepare_links returns > 0"""
+    def test_LinksGenerateDirLinkPlansLink(self):
+        """Check _generate_dir_link plans the bank directory link"""
         link = Links(manager=self.utils.manager)
-        # Set our manager verbose mode to on
+        link.plan = LinkPlan(bank='alu')
         link.manager.set_verbose(True)
-        link.manager.set_simulate(True)
         source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'blast2')
         target = os.path.join(self.utils.conf_dir, 'blast2_link')
-        self.assertEqual(0, link._generate_dir_link(source=source, target=target))
+        self.assertEqual(1, link._generate_dir_link(source=source, target=target))
+        self.assertEqual(link.plan.get_links()[0]['target'], os.path.join(target, 'alu'))
+        self.assertFalse(os.path.exists(target))
+
+    @attr('links')
+    @attr('links.inventory')
+    def test_LinksInventoryRecordsCreatedLinks(self):
+        """Check links created are recorded into the links inventory and can be queried"""
+        links = Links(manager=self.utils.manager)
+        links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        inventory = LinkInventory()
+        self.assertEqual(inventory.path, os.path.join(self.utils.cache_dir, LinkInventory.FILE))
+        self.assertEqual(len(inventory.get_links(bank='alu')), 8)
+        self.assertListEqual(inventory.get_banks(target_dir='index/blast2'), ['alu'])
+        self.assertListEqual([link['path'] for link in inventory.get_links(tool='golden')],
+                             ['index/golden/alu', 'index/golden/news2.txt'])
+        self.assertListEqual([link['path'] for link in inventory.get_links(target_dir='index')],
+                             ['index/blast2/alu', 'index/blast2/news1.txt', 'index/golden/alu',
+                              'index/golden/news2.txt'])
+        # Links through 'current' point into the current release directory
+        self.assertEqual(len(inventory.get_links(bank='alu', release='alu_54')), 8)
+        self.assertEqual(len(inventory.get_links(bank='alu', release='alu_53')), 0)
+        ftp = inventory.get_links(target_dir='ftp')[0]
+        self.assertEqual(ftp['version'], 'current')
+        self.assertEqual(ftp['op'], LinkPlan.SYMLINK)
+        self.assertEqual(ftp['source'], os.readlink(os.path.join(self.utils.prod_dir, 'ftp', 'alu')))
+
+    @attr('links')
+    @attr('links.inventory')
+    def test_LinksInventoryRebuildOK(self):
+        """Check the links inventory rebuilt from disk is the same as the one recorded by Links"""
+        links = Links(manager=self.utils.manager)
+        links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        inventory = LinkInventory()
+        recorded = inventory.get_links()
+        self.assertTrue(inventory.clear())
+        self.assertListEqual(inventory.get_links(), [])
+        self.assertEqual(inventory.rebuild(self.utils.prod_dir, self.utils.data_dir), 8)
+        self.assertListEqual(inventory.get_links(), recorded)
+
+    @attr('links')
+    @attr('links.inventory')
+    def test_LinksInventoryStagedRelease(self):
+        """Check published links are recorded with the release directory of their tree"""
+        links = Links(manager=self.utils.manager)
+        links.publish(links.stage({'data_dir': self.utils.data_dir, 'prod_dir': 'alu_54'}, dirs=self.utils.dirs,
+                                  files=self.utils.files, clone_dirs=self.utils.clones))
+        inventory = LinkInventory()
+        self.assertEqual(len(inventory.get_links(bank='alu', release='alu_54')), 8)
+        self.assertEqual(inventory.get_links(target_dir='ftp')[0]['version'], 'alu_54')
+        recorded = inventory.get_links()
+        self.assertEqual(inventory.rebuild(self.utils.prod_dir, self.utils.data_dir), 8)
+        self.assertListEqual([(link['path'], link['version']) for link in inventory.get_links()],
+                             [(link['path'], link['version']) for link in recorded])
+
+    @attr('links')
+    @attr('links.clean')
+    def test_LinkCleanerOK(self):
+        """Check broken links of all targets are counted per tool, and only removed if not a dry run"""
+        links = Links(manager=self.utils.manager)
+        links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        os.remove(os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'golden', 'news2.txt'))
+        os.symlink('/not_found', os.path.join(self.utils.prod_dir, 'ftp', 'old'))
+        os.symlink('/not_found', os.path.join(self.utils.prod_dir, 'not_a_target'))
+        targets = ['ftp', 'index/golden', 'index/missing']
+        cleaner = LinkCleaner(self.utils.prod_dir, workers=2, dry_run=True)
+        self.assertDictEqual(cleaner.clean(targets), {'ftp': 1, 'golden': 1})
+        self.assertListEqual(cleaner.links['golden'], [os.path.join('index', 'golden', 'news2.txt')])
+        self.assertTrue(os.path.islink(os.path.join(self.utils.prod_dir, 'ftp', 'old')))
+        self.assertEqual(len(LinkInventory().get_links(tool='golden')), 2)
+        cleaner = LinkCleaner(self.utils.prod_dir, workers=2)
+        self.assertDictEqual(cleaner.clean(targets), {'ftp': 1, 'golden': 1})
+        self.assertListEqual(os.listdir(os.path.join(self.utils.prod_dir, 'ftp')), ['alu'])
+        self.assertTrue(os.path.islink(os.path.join(self.utils.prod_dir, 'not_a_target')))
+        self.assertListEqual([link['path'] for link in LinkInventory().get_links(tool='golden')],
+                             [os.path.join('index', 'golden', 'alu')])
+        self.assertDictEqual(cleaner.clean(targets), {})
+
+    @attr('links')
+    @attr('links.clean')
+    def test_LinksGetTargetDirsOK(self):
+        """Check targets of DIRS and CLONE_DIRS are all returned once"""
+        targets = Links.get_target_dirs()
+        self.assertListEqual(targets, sorted(set(targets)))
+        for target in ['ftp', 'release', 'index/golden', 'index/hmmer', 'index/blast2']:
+            self.assertIn(target, targets)
+
+    @attr('links')
+    @attr('links.linkplan')
+    def test_LinksBuildPlanNothingCreated(self):
+        """Check building a plan does not create anything and lists directories and links"""
+        links = Links(manager=self.utils.manager)
+        plan = links.build_plan(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        self.assertFalse(os.path.exists(os.path.join(self.utils.prod_dir, 'index')))
+        self.assertIn({'op': LinkPlan.MKDIR, 'target': os.path.join(self.utils.prod_dir, 'index', 'blast2', '')},
+                      plan.get_dirs())
+        self.assertIn({'op': LinkPlan.SYMLINK, 'target': os.path.join(self.utils.prod_dir, 'ftp', 'alu'),
+                       'source': os.path.relpath(os.path.join(self.utils.data_dir, 'alu', 'current', 'flat'),
+                                                 start=os.path.join(self.utils.prod_dir, 'ftp'))},
+                      plan.get_links())
+        self.assertEqual(links.created_links, 0)
+        self.assertIsNone(links.plan)
+
+    @attr('links')
+    @attr('links.linkplan')
+    def test_LinksPlanJsonOK(self):
+        """Check a plan is serialized to json and back"""
+        plan = LinkPlan(bank='alu', release='54')
+        plan.add_dir('/prod/index')
+        self.assertEqual(plan.add_link('../data/file', '/prod/index/file', hard=False), 2)
+        other = LinkPlan.from_json(plan.to_json())
+        self.assertEqual(other.bank, 'alu')
+        self.assertEqual(other.release, '54')
+        self.assertListEqual(other.operations, plan.operations)
+        self.assertEqual(len(other), 2)
+
+    @attr('links')
+    @attr('links.linkplan')
+    def test_LinksPlanJsonThrows(self):
+        """Check a wrong json plan throws"""
+        with self.assertRaises(SystemExit):
+            LinkPlan.from_json('{"bank": "alu"}')
+        with self.assertRaises(SystemExit):
+            LinkPlan.load(os.path.join(self.utils.test_dir, 'not_found.plan'))
+
+    @attr('links')
+    @attr('links.linkplan')
+    def test_LinksApplyPlanOtherBankThrows(self):
+        """Check a plan built for another bank cannot be applied"""
+        links = Links(manager=self.utils.manager)
+        with self.assertRaises(SystemExit):
+            links.apply_plan(LinkPlan(bank='other'))
+
+    @attr('links')
+    @attr('links.parallel')
+    def test_LinksApplyPlanParallelOK(self):
+        """Check links created in parallel are the same as links created sequentially"""
+        links = Links(manager=self.utils.manager)
+        plan = links.build_plan(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        self.assertEqual(len(links._get_groups(plan)), 5)
+        self.assertEqual(links.apply_plan(plan, workers=4), 8)
+        links = Links(manager=self.utils.manager)
+        self.assertEqual(links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones,
+                                        workers=1), 0)
+
+    @attr('links')
+    @attr('links.parallel')
+    def test_LinksApplyPlanParallelGroupFailsOthersCompleted(self):
+        """Check a failing group of links is reported once the other groups are completed"""
+        links = Links(manager=self.utils.manager)
+        plan = links.build_plan(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        open(os.path.join(self.utils.prod_dir, 'ftp'), 'w').close()
+        with self.assertRaises(SystemExit):
+            links.apply_plan(plan, workers=4)
+        self.assertEqual(links.created_links, 7)
+        self.assertTrue(os.path.islink(os.path.join(self.utils.prod_dir, 'index', 'golden', 'alu')))
+
+    @attr('links')
+    @attr('links.parallel')
+    def test_LinksGetWorkersThrows(self):
+        """Check a wrong 'links.workers' value throws"""
+        links = Links(manager=self.utils.manager)
+        self.assertEqual(links.get_workers(), 4)
+        self.utils.manager.config.set('MANAGER', 'links.workers', '0')
+        with self.assertRaises(SystemExit):
+            links.get_workers()
+
+    @attr('links')
+    @attr('links.dolinks')
+    def test_LinksDoLinksSimulateNothingCreated(self):
+        """Check do_links in simulate mode counts links without creating them"""
+        links = Links(manager=self.utils.manager)
+        Manager.set_simulate(True)
+        self.assertEqual(links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones),
+                         8)
+        self.assertFalse(os.path.exists(os.path.join(self.utils.prod_dir, 'index')))
+
+    @attr('links')
+    @attr('links.dolinks')
+    def test_LinksDoLinksSimulateOnVerboseOnNothingCreated(self):
+        """Check do_links in simulate and verbose mode prints the plan, counts links and creates nothing"""
+        links = Links(manager=self.utils.manager)
+        Manager.set_simulate(True)
+        Manager.set_verbose(True)
+        self.assertEqual(links.do_links(dirs={'uncompressed': [{'target': 'uncmp_link'}]}, files={}, clone_dirs={}),
+                         1)
+        self.assertFalse(os.path.exists(os.path.join(self.utils.prod_dir, 'uncmp_link')))
+        self.assertIsNone(links.load_manifest())
+
+    @attr('links')
+    @attr('links.dolinks')
+    def test_LinksDoLinksSimulateOffLinksCreated(self):
+        """Check do_links with simulate mode off creates the directories, dirs and files links"""
+        links = Links(manager=self.utils.manager)
+        Manager.set_verbose(True)
+        self.assertEqual(links.do_links(dirs={'blast2': [{'target': 'blast2_link'}]},
+                                        files={'blast2': [{'target': 'fasta', 'remove_ext': True}]},
+                                        clone_dirs={}), 3)
+        self.assertTrue(os.path.islink(os.path.join(self.utils.prod_dir, 'blast2_link', 'alu')))
+        self.assertTrue(os.path.islink(os.path.join(self.utils.prod_dir, 'fasta', 'news1.txt')))
+        self.assertTrue(os.path.islink(os.path.join(self.utils.prod_dir, 'fasta', 'news1')))
+
+    @attr('links')
+    @attr('links.dolinks')
+    def test_LinksDoLinksApplyPlanOSErrorThrows(self):
+        """Check do_links throws (OSError=>SystemExit) when a link directory cannot be created"""
+        links = Links(manager=self.utils.manager)
+        open(os.path.join(self.utils.prod_dir, 'ftp'), 'w').close()
+        with self.assertRaises(SystemExit):
+            links.do_links(dirs={'flat': [{'target': 'ftp'}]}, files={}, clone_dirs={}, workers=1)
+        self.assertEqual(links.created_links, 0)
+        self.assertIsNone(links.load_manifest())
+
+    @attr('links')
+    @attr('links.manifest')
+    def test_LinksDoLinksWritesManifest(self):
+        """Check do_links records created links into the bank links manifest"""
+        links = Links(manager=self.utils.manager)
+        self.assertIsNone(links.load_manifest())
+        links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        manifest = links.load_manifest()
+        self.assertEqual(manifest['bank'], 'alu')
+        self.assertEqual(len(manifest['links']), 8)
+        self.assertEqual(manifest['links'][os.path.join('ftp', 'alu')]['op'], LinkPlan.SYMLINK)
+        self.assertTrue(os.path.isfile(os.path.join(self.utils.prod_dir, Links.MANIFEST_DIR, 'alu.json')))
+
+    @attr('links')
+    @attr('links.reconcile')
+    def test_LinksReconcileNoManifestCreatesAll(self):
+        """Check reconcile without manifest creates all links, then nothing"""
+        links = Links(manager=self.utils.manager)
+        self.assertEqual(links.reconcile(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones),
+                         8)
+        self.assertEqual(len(links.load_manifest()['links']), 8)
+        links = Links(manager=self.utils.manager)
+        self.assertEqual(links.reconcile(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones),
+                         0)
+        self.assertEqual(links.removed_links, 0)
+
+    @attr('links')
+    @attr('links.reconcile')
+    def test_LinksReconcileNewReleaseOK(self):
+        """Check reconcile creates links for new files and removes links of removed files"""
+        Links(manager=self.utils.manager).do_links(dirs=self.utils.dirs, files=self.utils.files,
+                                                   clone_dirs=self.utils.clones)
+        blast2 = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'blast2')
+        os.remove(os.path.join(blast2, 'news1.txt'))
+        self.utils.copy_file(ofile='news3.txt', todir=blast2)
+        links = Links(manager=self.utils.manager)
+        # news3.txt into index/blast2 (clone_dirs and files) and fasta (with and without extension)
+        self.assertEqual(links.reconcile(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones),
+                         3)
+        self.assertEqual(links.removed_links, 3)
+        self.assertFalse(os.path.lexists(os.path.join(self.utils.prod_dir, 'index', 'blast2', 'news1.txt')))
+        self.assertFalse(os.path.lexists(os.path.join(self.utils.prod_dir, 'fasta', 'news1')))
+        self.assertTrue(os.path.isfile(os.path.join(self.utils.prod_dir, 'index', 'blast2', 'news3.txt')))
+        self.assertNotIn(os.path.join('fasta', 'news1.txt'), links.load_manifest()['links'])
+
+    @attr('links')
+    @attr('links.reconcile')
+    def test_LinksReconcileSimulateNothingChanged(self):
+        """Check reconcile in simulate mode only counts links"""
+        Links(manager=self.utils.manager).do_links(dirs=self.utils.dirs, files=self.utils.files,
+                                                   clone_dirs=self.utils.clones)
+        os.remove(os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'blast2', 'news1.txt'))
+        links = Links(manager=self.utils.manager)
+        Manager.set_simulate(True)
+        self.assertEqual(links.reconcile(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones),
+                         0)
+        self.assertEqual(links.removed_links, 3)
+        self.assertTrue(os.path.lexists(os.path.join(self.utils.prod_dir, 'index', 'blast2', 'news1.txt')))
+
+    @attr('links')
+    @attr('links.stage')
+    def test_LinksStagePublishRollbackOK(self):
+        """Check a staged links tree is published through the bank trees 'current' symlink and rolled back"""
+        release_dir = os.path.join(self.utils.data_dir, 'alu', 'alu_55')
+        os.makedirs(os.path.join(release_dir, 'flat'))
+        os.makedirs(os.path.join(release_dir, 'golden'))
+        ftp_link = os.path.join(self.utils.prod_dir, 'ftp', 'alu')
+        blast_link = os.path.join(self.utils.prod_dir, 'index', 'blast2', 'alu')
+        links = Links(manager=self.utils.manager)
+        tree = links.stage({'data_dir': self.utils.data_dir, 'prod_dir': 'alu_54'}, dirs=self.utils.dirs,
+                           files=self.utils.files, clone_dirs=self.utils.clones)
+        self.assertEqual(tree, 'alu_54')
+        self.assertEqual(links.created_links, 8)
+        self.assertFalse(os.path.lexists(ftp_link))
+        links.publish(tree)
+        self.assertEqual(os.readlink(links.get_tree_dir(Links.CURRENT_TREE)), 'alu_54')
+        self.assertEqual(os.path.realpath(ftp_link), os.path.join(os.path.realpath(self.utils.data_dir),
+                                                                  'alu', 'alu_54', 'flat'))
+        self.assertTrue(os.path.islink(blast_link))
+        # New release without blast2
+        links = Links(manager=self.utils.manager)
+        tree = links.stage({'data_dir': self.utils.data_dir, 'prod_dir': 'alu_55'}, dirs=self.utils.dirs,
+                           files={}, clone_dirs={})
+        self.assertEqual(links.created_links, 3)
+        # Published links go through the trees 'current' symlink, they already exist
+        self.assertEqual(links.publish(tree), 3)
+        self.assertEqual(os.path.realpath(ftp_link), os.path.join(os.path.realpath(self.utils.data_dir),
+                                                                  'alu', 'alu_55', 'flat'))
+        self.assertFalse(os.path.lexists(blast_link))
+        self.assertEqual(links.removed_links, 5)
+        self.assertEqual(os.readlink(links.get_tree_dir(Links.PREVIOUS_TREE)), 'alu_54')
+        # Back to previous release
+        links = Links(manager=self.utils.manager)
+        links.rollback()
+        self.assertEqual(os.readlink(links.get_tree_dir(Links.CURRENT_TREE)), 'alu_54')
+        self.assertEqual(os.path.realpath(ftp_link), os.path.join(os.path.realpath(self.utils.data_dir),
+                                                                  'alu', 'alu_54', 'flat'))
+        self.assertTrue(os.path.islink(blast_link))
+
+    @attr('links')
+    @attr('links.stage')
+    def test_LinksPublishStagedChanges(self):
+        """Check publish applies the links changes computed by stage, without reading the trees again"""
+        ftp_link = os.path.join(self.utils.prod_dir, 'ftp', 'alu')
+        links = Links(manager=self.utils.manager)
+        tree = links.stage({'data_dir': self.utils.data_dir, 'prod_dir': 'alu_54'}, dirs=self.utils.dirs,
+                           files=self.utils.files, clone_dirs=self.utils.clones)
+        self.assertEqual(links.publication['tree'], 'alu_54')
+        self.assertIsNone(links.publication['previous'])
+        self.assertIn('ftp/alu', [link for link, _, _ in links.publication['create']])
+        self.assertFalse(os.path.lexists(ftp_link))
+        links._get_tree_links = lambda name: self.fail("Tree %s read by publish" % name)
+        links.publish(tree)
+        self.assertIsNone(links.publication)
+        self.assertEqual(os.path.realpath(ftp_link), os.path.join(os.path.realpath(self.utils.data_dir),
+                                                                  'alu', 'alu_54', 'flat'))
+
+    @attr('links')
+    @attr('links.stage')
+    def test_LinksStagePublishedTreeThrows(self):
+        """Check a published links tree cannot be staged again"""
+        links = Links(manager=self.utils.manager)
+        production = {'data_dir': self.utils.data_dir, 'prod_dir': 'alu_54'}
+        links.publish(links.stage(production, dirs=self.utils.dirs, files=self.utils.files,
+                                  clone_dirs=self.utils.clones))
+        with self.assertRaises(SystemExit):
+            links.stage(production, dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones)
+        with self.assertRaises(SystemExit):
+            links.rollback()
+
+    @attr('links')
+    @attr('links.writer')
+    def test_LinkWriterRelativeOK(self):
+        """Check relative sources computed per directory are the same as os.path.relpath ones"""
+        writer = LinkWriter()
+        for path, start in [('/data/alu/current/flat/file1', '/prod/ftp'),
+                            ('/data/alu/current/flat/file2', '/prod/ftp'),
+                            ('/prod/ftp/file', '/prod/ftp'), ('/prod/ftp/sub/file', '/prod/ftp'), ('/data', '/prod')]:
+            self.assertEqual(writer.relative(path, start), os.path.relpath(path, start))
+        self.assertEqual(len(writer.prefixes), 4)
+
+    @attr('links')
+    @attr('links.writer')
+    def test_LinkWriterLinkOK(self):
+        """Check links are created with and without dir_fd"""
+        source = os.path.join(self.utils.data_dir, 'alu', 'alu_54', 'blast2', 'news1.txt')
+        for dir_fd in [False, True]:
+            target_dir = os.path.join(self.utils.prod_dir, 'writer_%s' % str(dir_fd))
+            os.makedirs(target_dir)
+            with LinkWriter(dir_fd=dir_fd) as writer:
+                writer.link(writer.relative(source, target_dir), os.path.join(target_dir, 'sym'))
+                writer.link(source, os.path.join(target_dir, 'hard'), hard=True)
+                with self.assertRaises(OSError):
+                    writer.link(source, os.path.join(target_dir, 'hard'), hard=True)
+            self.assertIsNone(writer.fd)
+            self.assertEqual(os.path.realpath(os.path.join(target_dir, 'sym')), os.path.realpath(source))
+            self.assertTrue(os.path.samefile(os.path.join(target_dir, 'hard'), source))
+
+    @attr('links')
+    @attr('links.snapshot')
+    def test_LinksSnapshotLexistsBrokenLink(self):
+        """Check a broken symlink is seen as existing entry, but not as existing path"""
+        link = Links(manager=self.utils.manager)
+        target = os.path.join(self.utils.prod_dir, 'broken_link')
+        os.symlink(os.path.join(self.utils.data_dir, 'not_found'), target)
+        self.assertTrue(link._lexists(target))
+        self.assertFalse(link._exists(target))
+        self.assertFalse(link._lexists(os.path.join(self.utils.prod_dir, 'not_here')))
+        self.assertIn(self.utils.prod_dir, link.snapshots)
+
+    @attr('links')
+    @attr('links.snapshot')
+    def test_LinksSnapshotDoLinksTwiceCreatesNothing(self):
+        """Check links created are recorded in snapshots and not created twice"""
+        links = Links(manager=self.utils.manager)
+        # Files linked by both clone_dirs and files are only created once
+        self.assertEqual(links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones),
+                         8)
+        self.assertTrue(links.snapshots[os.path.join(self.utils.prod_dir, 'index', 'blast2')]['news1.txt'])
+        self.assertEqual(links.do_links(dirs=self.utils.dirs, files=self.utils.files, clone_dirs=self.utils.clones),
+                         8)
+        self.assertEqual(Links(manager=self.utils.manager).do_links(dirs=self.utils.dirs, files=self.utils.files,
+                                                                    clone_dirs=self.utils.clones), 0)
 
 
 class TestBiomajManagerNews(unittest.TestCase):
@@ -1536,6 +2099,33 @@ class TestBioMajManagerDecorators(unittest.TestCase):
             manager.get_bank_sections('blast2')
         self.utils.drop_db()
 
+    @attr('decorators')
+    @attr('decorators.bankfields')
+    def test_DecoratorBankFieldsSetsAttribute(self):
+        """Test the fields are stored within the decorated function"""
+        @bank_fields('current', ('production', {'$slice': -1}))
+        def func():
+            return True
+        self.assertTupleEqual(func.bank_fields, ('current', ('production', {'$slice': -1})))
+        self.assertTrue(func())
+
+    @attr('decorators')
+    @attr('decorators.bankfields')
+    def test_DecoratorBankRequiredFetchesDeclaredFieldsOnly(self):
+        """Test a bank view only fetches fields declared for the method"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager(bank='alu')
+        manager = Manager()
+        self.assertTrue(manager.set_bank_from_name('alu', view=True))
+        manager.get_pending_sessions()
+        self.assertTrue(manager.bank.is_fetched('pending'))
+        self.assertFalse(manager.bank.is_fetched('sessions'))
+        self.assertFalse(manager.bank.is_loaded())
+        # No field declared, the complete document is loaded
+        manager.get_failed_processes()
+        self.assertTrue(manager.bank.is_loaded())
+        self.utils.drop_db()
+
     @attr('decorators')
     @attr('decorators.usergranted')
     def test_DecoratorsUserGrantedOK(self):
@@ -1891,6 +2481,57 @@ class TestBioMajManagerManager(unittest.TestCase):
         self.assertTrue(manager.clean_sessions())
         self.utils.drop_db()
 
+    @attr('manager')
+    @attr('manager.cleansessions')
+    def test_cleanSessionsBulkWriteRemovesSessions(self):
+        """Check stale sessions are removed from the database with a single update"""
+        current = time.time()
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager(bank='alu')
+        Manager.set_simulate(False)
+        production = [{'session': current, 'release': "54", 'data_dir': self.utils.data_dir, 'prod_dir': "alu_54"}]
+        sessions = [{'id': current, 'release': "54", 'dir_version': 'alu'},
+                    {'id': current - 1, 'release': "53", 'dir_version': 'alu'},
+                    {'id': current - 2, 'release': "52", 'dir_version': 'alu'}]
+        manager.bank.banks.update({'name': 'alu'}, {'$set': {'current': current, 'production': production,
+                                                             'sessions': sessions}})
+        manager.bank.bank['current'] = current
+        manager.bank.bank['production'] = production
+        manager.bank.bank['sessions'] = sessions
+        self.assertTrue(manager.clean_sessions())
+        document = manager.bank.banks.find_one({'name': 'alu'})
+        self.assertListEqual([session['id'] for session in document['sessions']], [current])
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.cleansessions')
+    def test_cleanSessionsSimulateDoesNotWrite(self):
+        """Check simulate mode only prints the planned updates"""
+        current = time.time()
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager(bank='alu')
+        Manager.set_simulate(True)
+        production = [{'session': current, 'release': "54", 'data_dir': self.utils.data_dir, 'prod_dir': "alu_54"}]
+        sessions = [{'id': current, 'release': "54", 'dir_version': 'alu'},
+                    {'id': current - 1, 'release': "53", 'dir_version': 'alu'}]
+        manager.bank.banks.update({'name': 'alu'}, {'$set': {'current': current, 'production': production,
+                                                             'sessions': sessions}})
+        manager.bank.bank['current'] = current
+        manager.bank.bank['production'] = production
+        manager.bank.bank['sessions'] = sessions
+        self.assertTrue(manager.clean_sessions())
+        document = manager.bank.banks.find_one({'name': 'alu'})
+        self.assertEqual(len(document['sessions']), 2)
+        Manager.set_simulate(False)
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.mergeconditions')
+    def test_ManagerMergeConditionsOK(self):
+        """Check conditions are merged with $or"""
+        self.assertDictEqual(Manager._merge_conditions([{'id': 1}]), {'id': 1})
+        self.assertDictEqual(Manager._merge_conditions([{'id': 1}, {'id': 2}]), {'$or': [{'id': 1}, {'id': 2}]})
+
     @attr('manager')
     @attr('manager.currentrelease')
     def test_ManagerGetCurrentRelease_CurrentSet(self):
@@ -2199,6 +2840,47 @@ class TestBioMajManagerManager(unittest.TestCase):
         self.assertListEqual(expected, returned)
         self.utils.drop_db()
 
+    @attr('manager')
+    @attr('manager.ensureindexes')
+    def test_ManagerEnsureIndexesOK(self):
+        """Check indexes are created and queries use them"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager(bank='alu')
+        self.assertTrue(manager.ensure_indexes())
+        keys = [index['key'] for index in manager.bank.banks.index_information().values()]
+        for index in Manager.INDEXES:
+            self.assertTrue(index in keys)
+        # Indexes already there
+        self.assertTrue(manager.ensure_indexes())
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.ensureindexes')
+    def test_ManagerEnsureIndexesFloatDirectionFound(self):
+        """Check an index returned with float directions is found, not created again"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager(bank='alu')
+        collection = manager.bank.banks
+        collection.index_information = lambda: dict([(str(index), {'key': [(field, float(order))
+                                                                          for field, order in keys]})
+                                                      for index, keys in enumerate(Manager.INDEXES)])
+        collection.create_index = lambda *args, **kwargs: self.fail("Index created again")
+        try:
+            manager.ensure_indexes()
+        finally:
+            del collection.index_information
+            del collection.create_index
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.ensureindexes')
+    def test_ManagerGetPlanStagesOK(self):
+        """Check we get all the stages of a winning plan"""
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'},
+                                                                                {'stage': 'COLLSCAN'}]}}
+        self.assertListEqual(sorted(Manager._get_plan_stages(plan)), ['COLLSCAN', 'FETCH', 'IXSCAN', 'OR'])
+        self.assertListEqual(Manager._get_plan_stages({}), [])
+
     @attr('manager')
     @attr('manager.getcurrentuser')
     def test_ManagerGetCurrentUserTestUSEROK(self):
@@ -2329,6 +3011,103 @@ class TestBioMajManagerManager(unittest.TestCase):
         # db.name is added automatically if not found in field list
         self.assertEqual(len(manager.get_bank_remote_info()), 11)
 
+    @attr('manager')
+    @attr('manager.getworkers')
+    def test_ManagerGetWorkersOK(self):
+        """Check we get the number of workers from the configuration"""
+        manager = Manager()
+        self.assertEqual(manager.get_workers(), 4)
+        manager.config.remove_option('MANAGER', 'fleet.workers')
+        self.assertEqual(manager.get_workers(), Manager.WORKERS)
+
+    @attr('manager')
+    @attr('manager.getworkers')
+    def test_ManagerGetWorkersThrows(self):
+        """Check the method throws with a wrong number of workers"""
+        manager = Manager()
+        manager.config.set('MANAGER', 'fleet.workers', 'zero')
+        with self.assertRaises(SystemExit):
+            manager.get_workers()
+        manager.config.set('MANAGER', 'fleet.workers', '0')
+        with self.assertRaises(SystemExit):
+            manager.get_workers()
+
+    @attr('manager')
+    @attr('manager.mapbanks')
+    def test_ManagerMapBanksOrderOK(self):
+        """Check results are returned in banks order, each call having its own bank set"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        self.utils.copy_file(ofile='minium.properties', todir=self.utils.conf_dir)
+        banks = [Manager(bank=name).bank for name in ['minium', 'alu', 'minium', 'alu']]
+        manager = Manager()
+        self.assertListEqual(manager.map_banks(lambda m: m.bank.name, banks, workers=3),
+                             ['minium', 'alu', 'minium', 'alu'])
+        self.assertListEqual(manager.map_banks(lambda m: m.bank.name, banks, workers=1),
+                             ['minium', 'alu', 'minium', 'alu'])
+        self.assertIsNone(manager.bank)
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.mapbanks')
+    def test_ManagerMapBanksThrows(self):
+        """Check an error raised for a bank is raised again"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        self.utils.copy_file(ofile='minium.properties', todir=self.utils.conf_dir)
+        banks = [Manager(bank=name).bank for name in ['minium', 'alu']]
+        manager = Manager()
+        with self.assertRaises(SystemExit):
+            manager.map_banks(lambda m: m.get_session_from_id(None), banks, workers=2)
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.checkproductionsize')
+    def test_ManagerCheckProductionSizesOK(self):
+        """Check we get the banks exceeding the production limit"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        self.utils.copy_file(ofile='minium.properties', todir=self.utils.conf_dir)
+        alu = Manager(bank='alu')
+        Manager(bank='minium')
+        alu.bank.banks.update({'name': 'alu'}, {'$set': {'current': 3,
+                                                         'production': [{'session': 1}, {'session': 2},
+                                                                        {'session': 3}]}})
+        manager = Manager()
+        self.assertListEqual(manager.check_production_sizes(max_release=1), [['alu', 2, 1]])
+        self.assertListEqual(manager.check_production_sizes(max_release=2), [])
+        # Limit from banks 'keep.old.version'
+        self.assertListEqual(manager.check_production_sizes(), [['alu', 2, 1]])
+        self.assertListEqual(manager.check_production_sizes(banks=['minium']), [])
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.checkproductionsize')
+    def test_ManagerCheckProductionSizesWrongVisibilityThrows(self):
+        """Check the method throws with a wrong visibility"""
+        manager = Manager()
+        with self.assertRaises(SystemExit):
+            manager.check_production_sizes(visibility='fake')
+
+    @attr('manager')
+    @attr('manager.getkeepoldversion')
+    def test_ManagerGetKeepOldVersionOK(self):
+        """Check we get the global and the bank 'keep.old.version'"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        self.assertEqual(Manager.get_keep_old_version(), 0)
+        self.assertEqual(Manager.get_keep_old_version('alu'), 1)
+        # Bank without properties file gets the global value
+        self.assertEqual(Manager.get_keep_old_version('nobank'), 0)
+
+    @attr('manager')
+    @attr('manager.getkeepoldversion')
+    def test_ManagerGetKeepOldVersionEnvOverride(self):
+        """Check environment variable overrides configuration"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        os.environ['BIOMAJ_KEEP_OLD_VERSION'] = '5'
+        self.assertEqual(Manager.get_keep_old_version('alu'), 5)
+        del os.environ['BIOMAJ_KEEP_OLD_VERSION']
+        self.assertEqual(Manager.get_keep_old_version('alu'), 1)
+
     @attr('manager')
     @attr('manager.getsessionfromid')
     def test_ManagerGetSessionFromIDNotNoneNotNone(self):
@@ -2369,6 +3148,61 @@ class TestBioMajManagerManager(unittest.TestCase):
             manager.get_session_from_id(None)
         self.utils.drop_db()
 
+    @attr('manager')
+    @attr('manager.getsessionfromid')
+    def test_ManagerGetSessionFromIDIndexRebuiltOK(self):
+        """Check the sessions index follows changes of the 'sessions' list"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        data = {'name': 'alu',
+                'sessions': [{'id': 1, 'workflow_status': True},
+                             {'id': 1, 'workflow_status': False}]}
+        manager = Manager(bank='alu')
+        manager.bank.bank = data
+        # First session found wins
+        self.assertTrue(manager.get_session_from_id(1)['workflow_status'])
+        data['sessions'].append({'id': 2, 'workflow_status': True})
+        self.assertIsNotNone(manager.get_session_from_id(2))
+        manager.bank.bank = {'name': 'alu', 'sessions': [{'id': 3, 'workflow_status': True}]}
+        self.assertIsNone(manager.get_session_from_id(1))
+        self.assertIsNotNone(manager.get_session_from_id(3))
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.getproductionfrom')
+    def test_ManagerGetProductionFromReleaseOK(self):
+        """Check we retrieve the last production matching a release or a production dir"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        data = {'name': 'alu',
+                'production': [{'session': 1, 'release': '54', 'prod_dir': 'alu_54'},
+                               {'session': 2, 'release': '54', 'prod_dir': 'alu_54__1'},
+                               {'session': 3, 'release': '55', 'prod_dir': 'alu_55'}]}
+        manager = Manager(bank='alu')
+        manager.bank.bank = data
+        self.assertEqual(manager.get_production_from_release('54')['session'], 2)
+        self.assertEqual(manager.get_production_from_release(55)['session'], 3)
+        self.assertEqual(manager.get_production_from_release('alu_54')['session'], 1)
+        self.assertIsNone(manager.get_production_from_release('56'))
+        self.utils.drop_db()
+
+    @attr('manager')
+    @attr('manager.getproductionfrom')
+    def test_ManagerGetProductionFromSessionOK(self):
+        """Check we retrieve the production from its session id and index is reset with set_bank"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        data = {'name': 'alu',
+                'production': [{'session': 1, 'release': '54', 'prod_dir': 'alu_54'},
+                               {'session': 2, 'release': '55', 'prod_dir': 'alu_55'}]}
+        manager = Manager(bank='alu')
+        manager.bank.bank = data
+        self.assertEqual(manager.get_production_from_session(2)['release'], '55')
+        self.assertIsNone(manager.get_production_from_session(3))
+        # Same list object, same size, index must be reset by set_bank
+        data['production'][1] = {'session': 3, 'release': '56', 'prod_dir': 'alu_56'}
+        self.assertTrue(manager.set_bank(bank=manager.bank))
+        self.assertIsNone(manager.get_production_from_session(2))
+        self.assertEqual(manager.get_production_from_session(3)['release'], '56')
+        self.utils.drop_db()
+
     @attr('manager.getpendingsessions')
     def test_ManagerGetPendingSessionsOK(self):
         """Check method returns correct pending session"""
@@ -2525,6 +3359,83 @@ class TestBioMajManagerManager(unittest.TestCase):
         self.assertFalse(manager.synchronize_db(date_deleted="2016/01/01"))
         self.utils.drop_db()
 
+    @attr('manager')
+    @attr('manager.synchronizedb')
+    def test_ManagerSynchDBSessionAlreadyDeletedUntouched(self):
+        """Check 'sessions.deleted' is not changed for a removed production whose session is already deleted"""
+        document = self.synchronize_missing_production({'deleted': 5})
+        self.assertListEqual([prod['session'] for prod in document['production']], [1])
+        self.assertNotIn('deleted', document['sessions'][0])
+        self.assertEqual(document['sessions'][1]['deleted'], 5)
+
+    @attr('manager')
+    @attr('manager.synchronizedb')
+    def test_ManagerSynchDBSessionNotDeletedSetDeleted(self):
+        """Check 'sessions.deleted' is set for a removed production whose session is not deleted"""
+        document = self.synchronize_missing_production({})
+        self.assertListEqual([prod['session'] for prod in document['production']], [1])
+        self.assertNotIn('deleted', document['sessions'][0])
+        self.assertGreater(document['sessions'][1]['deleted'], 5)
+
+    @attr('manager')
+    @attr('manager.synchronizedb')
+    def test_ManagerSynchDBDeleteDirFailsDatabaseUpdated(self):
+        """Check the database is updated before reporting an extra directory that can't be removed"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager(bank='alu')
+        Manager.set_simulate(False)
+        production_data = [{'data_dir': self.utils.data_dir, 'release': "1", 'dir_version': "alu",
+                            'session': 1, 'prod_dir': "alu_1"},
+                           {'data_dir': self.utils.data_dir, 'release': "2", 'dir_version': "alu",
+                            'session': 2, 'prod_dir': "alu_2"}]
+        sessions_data = [{'id': 1, 'workflow_status': True, 'release': "1"},
+                         {'id': 2, 'workflow_status': True, 'release': "2"},
+                         {'id': 3, 'workflow_status': False, 'release': "3"}]
+        data = {'last_update_session': 1, 'current': 1, 'pending': [{'release': "3", 'id': 3}],
+                'production': production_data, 'sessions': sessions_data}
+        manager.bank.banks.update({'name': 'alu'}, {'$set': data})
+        manager.bank.bank.update(data)
+        os.makedirs(os.path.join(self.utils.data_dir, 'alu', 'alu_1'))
+        # shutil.rmtree refuses to remove a symlink
+        os.makedirs(os.path.join(self.utils.data_dir, 'alu_3'))
+        os.symlink(os.path.join(self.utils.data_dir, 'alu_3'), os.path.join(self.utils.data_dir, 'alu', 'alu_3'))
+        with self.assertRaises(SystemExit):
+            manager.synchronize_db()
+        document = manager.bank.banks.find_one({'name': 'alu'})
+        self.assertListEqual([prod['session'] for prod in document['production']], [1])
+        self.assertIn('deleted', document['sessions'][1])
+        self.assertListEqual(document['pending'], [{'release': "3", 'id': 3}])
+        self.assertTrue(os.path.isdir(os.path.join(self.utils.data_dir, 'alu', 'alu_3')))
+        self.utils.drop_db()
+
+    def synchronize_missing_production(self, session):
+        """
+        Run synchronize_db with production 'alu_2' (session 2) missing on disk
+
+        :param session: Extra fields for session 2
+        :type session: dict
+        :return: Bank document after synchronization
+        :rtype: dict
+        """
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager(bank='alu')
+        Manager.set_simulate(False)
+        production_data = [{'data_dir': self.utils.data_dir, 'release': "1", 'dir_version': "alu",
+                            'session': 1, 'prod_dir': "alu_1"},
+                           {'data_dir': self.utils.data_dir, 'release': "2", 'dir_version': "alu",
+                            'session': 2, 'prod_dir': "alu_2"}]
+        sessions_data = [{'id': 1, 'workflow_status': True, 'release': "1"},
+                         dict({'id': 2, 'workflow_status': True, 'release': "2"}, **session)]
+        data = {'last_update_session': 1, 'current': 1, 'pending': [], 'production': production_data,
+                'sessions': sessions_data}
+        manager.bank.banks.update({'name': 'alu'}, {'$set': data})
+        manager.bank.bank.update(data)
+        os.makedirs(os.path.join(self.utils.data_dir, 'alu', 'alu_1'))
+        self.assertTrue(manager.synchronize_db())
+        document = manager.bank.banks.find_one({'name': 'alu'})
+        self.utils.drop_db()
+        return document
+
     @attr('manager')
     @attr('manager.synchronizedb')
     def test_ManagerSynchDBWithCurrentReleaseAndPendingsAndMissingProductionSimulateONReturnsTrue(self):
@@ -4252,3 +5163,828 @@ class TestBiomajManagerPlugins(unittest.TestCase):
         manager.load_plugins()
         self.assertRaises(Exception, manager.plugins.myplugin.get_exception())
         self.assertRaises(Exception, manager.plugins.anotherplugin.get_exception())
+
+
+    @attr('plugins')
+    @attr('plugins.loading')
+    def test_PluginsLoadedOnce(self):
+        """Check the same plugins are returned by repeated loads"""
+        manager = Manager()
+        plugins = manager.load_plugins()
+        self.assertIs(manager.load_plugins(), plugins)
+        self.assertIs(plugins.myplugin, plugins.myplugin)
+
+    @attr('plugins')
+    @attr('plugins.loading')
+    def test_PluginsManagerCopyOwnPlugins(self):
+        """Check a Manager copy gets plugins set with the copy, sharing the plugins discovery"""
+        manager = Manager()
+        plugins = manager.load_plugins()
+        worker = copy.copy(manager)
+        worker_plugins = worker.load_plugins()
+        self.assertIsNot(worker_plugins, plugins)
+        self.assertIs(worker_plugins.myplugin.get_manager(), worker)
+        self.assertIs(plugins.myplugin.get_manager(), manager)
+        self.assertIs(worker_plugins.registry, plugins.registry)
+        self.assertIs(Manager().load_plugins().registry, plugins.registry)
+        self.assertIs(manager.load_plugins(), plugins)
+
+    @attr('plugins')
+    @attr('plugins.loading')
+    def test_PluginsLoadedOnDemand(self):
+        """Check plugins are found once per directory change and only imported when used"""
+        manager = Manager()
+        plugins = Plugins(manager=manager)
+        self.assertListEqual(plugins.plugins, ['anotherplugin', 'myplugin'])
+        self.assertIs(PluginRegistry.get(self.utils.plugins_dir), plugins.registry)
+        self.assertNotIn('myplugin', plugins.__dict__)
+        self.assertNotIn('myplugin', plugins.registry.classes)
+        self.assertEqual(plugins.myplugin.get_value(), 1)
+        self.assertNotIn('anotherplugin', plugins.registry.classes)
+        with self.assertRaises(AttributeError):
+            plugins.notaplugin
+        # Directory changed, plugins are found again
+        stat = os.stat(self.utils.plugins_dir)
+        os.utime(self.utils.plugins_dir, (stat.st_atime, stat.st_mtime + 10))
+        self.assertIsNot(PluginRegistry.get(self.utils.plugins_dir), plugins.registry)
+
+
+    @attr('plugins')
+    @attr('plugins.loading')
+    def test_PluginsPluginManager(self):
+        """Check the yapsy plugin manager is still available and shares the plugins objects"""
+        manager = Manager()
+        plugins = Plugins(manager=manager)
+        self.assertNotIn('myplugin', plugins.__dict__)
+        plugin_info = plugins.pm.getPluginByName('myplugin', category=Plugins.CATEGORY)
+        self.assertIs(plugin_info.plugin_object, plugins.myplugin)
+        self.assertTrue(plugin_info.is_activated)
+        self.assertIs(plugins.pm, plugins.pm)
+
+    @attr('plugins')
+    @attr('plugins.dispatch')
+    def test_PluginsDispatchOK(self):
+        """Check a hook is called on all plugins, a failing plugin does not stop the others"""
+        manager = Manager()
+        manager.load_plugins()
+        report = manager.plugins.dispatch('on_dispatch', value=2)
+        self.assertEqual(report['myplugin']['status'], 'ok')
+        self.assertEqual(report['myplugin']['result'], 2)
+        self.assertEqual(report['anotherplugin']['status'], 'error')
+        self.assertEqual(report['anotherplugin']['error'], 'anotherplugin failed')
+        self.assertDictEqual(manager.plugins.dispatch('not_a_hook'), {})
+
+    @attr('plugins')
+    @attr('plugins.dispatch')
+    def test_PluginsDispatchTimeout(self):
+        """Check a plugin not completing in time is reported, without waiting for it"""
+        manager = Manager()
+        manager.config.set('myplugin', 'myplugin.timeout', '0.1')
+        manager.load_plugins()
+        start = time.time()
+        report = manager.plugins.dispatch('on_dispatch', sleep=2)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(report['myplugin']['status'], 'timeout')
+        self.assertEqual(report['anotherplugin']['status'], 'error')
+
+    @attr('plugins')
+    @attr('plugins.dispatch')
+    def test_PluginsDispatchTimeoutNotOverwritten(self):
+        """Check a plugin completing after its timeout does not change the report"""
+        manager = Manager()
+        manager.config.set('myplugin', 'myplugin.timeout', '0.1')
+        manager.load_plugins()
+        report = manager.plugins.dispatch('on_dispatch', value='late', sleep=0.3)
+        time.sleep(0.5)
+        self.assertDictEqual(report['myplugin'], {'status': 'timeout', 'result': None, 'error': None, 'time': None})
+
+    @attr('plugins')
+    @attr('plugins.dispatch')
+    def test_PluginsDispatchThrows(self):
+        """Check wrong hook names and timeouts throw"""
+        manager = Manager()
+        manager.load_plugins()
+        with self.assertRaises(SystemExit):
+            manager.plugins.dispatch('_call_hook')
+        manager.config.set('PLUGINS', 'plugins.timeout', '0')
+        with self.assertRaises(SystemExit):
+            manager.plugins.dispatch('on_dispatch')
+
+
+class TestBiomajManagerConfig(unittest.TestCase):
+    """Class for testing biomajmanager.config class"""
+
+    def setUp(self):
+        """Setup stuff"""
+        self.utils = UtilsForTests()
+        # Make our test global.properties set as env var
+        os.environ['BIOMAJ_CONF'] = self.utils.global_properties
+
+    def tearDown(self):
+        """Clean"""
+        self.utils.clean()
+
+    @attr('config')
+    @attr('config.manager')
+    def test_ConfigCacheManagerConfigLoadedOnce(self):
+        """Check the manager configuration is shared between Manager instances"""
+        first = Manager()
+        second = Manager()
+        self.assertIs(first.config, second.config)
+        self.assertIs(Manager.load_config(), first.config)
+
+    @attr('config')
+    @attr('config.manager')
+    def test_ConfigCacheManagerConfigReloadedOnChange(self):
+        """Check the manager configuration is loaded again when a file changed"""
+        first = Manager()
+        with open(self.utils.manager_properties, 'a') as fout:
+            fout.write("\n[CACHE]\ncache.test=1\n")
+        second = Manager()
+        self.assertIsNot(first.config, second.config)
+        self.assertEqual(second.config.get('CACHE', 'cache.test'), '1')
+
+    @attr('config')
+    @attr('config.manager')
+    def test_ConfigCacheManagerConfigOtherFileReloaded(self):
+        """Check loading another manager configuration file is not served from cache"""
+        first = Manager()
+        self.utils.copy_file(ofile='manager-nomanager-section.properties', todir=self.utils.conf_dir)
+        other = Manager.load_config(cfg=os.path.join(self.utils.conf_dir, 'manager-nomanager-section.properties'))
+        self.assertFalse(other.has_section('MANAGER'))
+        self.assertTrue(Manager().config.has_section('MANAGER'))
+
+    @attr('config')
+    @attr('config.invalidate')
+    def test_ConfigCacheInvalidateOK(self):
+        """Check invalidating the cache loads the configuration again"""
+        first = Manager()
+        self.assertTrue(ConfigCache.invalidate())
+        self.assertIsNot(Manager().config, first.config)
+
+    @attr('config')
+    @attr('config.bank')
+    def test_ConfigCacheBankConfigOK(self):
+        """Check a bank configuration is loaded once and invalidated"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        config = ConfigCache.get_bank_config('alu')
+        self.assertEqual(config.get('db.name'), 'alu')
+        self.assertIs(ConfigCache.get_bank_config('alu'), config)
+        ConfigCache.invalidate(bank='alu')
+        self.assertIsNot(ConfigCache.get_bank_config('alu'), config)
+
+    @attr('config')
+    @attr('config.bank')
+    def test_ConfigCacheBankConfigConcurrentLoadedOnce(self):
+        """Check a bank configuration asked by concurrent workers is loaded once"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        ConfigCache.invalidate(bank='alu')
+        pool = ThreadPool(4)
+        try:
+            configs = pool.map(lambda _: ConfigCache.get_bank_config('alu'), range(8))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(set([id(config) for config in configs])), 1)
+        self.assertIs(ConfigCache.get_bank_config('alu'), configs[0])
+
+    @attr('config')
+    @attr('config.bank')
+    def test_ConfigCacheBankConfigThrows(self):
+        """Check a missing bank configuration raises"""
+        Manager()
+        with self.assertRaises(Exception):
+            ConfigCache.get_bank_config('nobank')
+
+    @attr('config')
+    @attr('config.parser')
+    def test_ConfigCacheGetParserOK(self):
+        """Check properties files are parsed once, and again when changed"""
+        parser = ConfigCache.get_parser([self.utils.global_properties])
+        self.assertTrue(parser.has_section('GENERAL'))
+        self.assertIs(ConfigCache.get_parser([self.utils.global_properties]), parser)
+        with open(self.utils.global_properties, 'a') as fout:
+            fout.write("\n")
+        self.assertIsNot(ConfigCache.get_parser([self.utils.global_properties]), parser)
+
+    @attr('config')
+    @attr('config.properties')
+    def test_PropertiesStoreBankPropertiesOK(self):
+        """Check bank properties are parsed once and stored into the cache database"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        properties = PropertiesStore.get_bank_properties('alu')
+        self.assertEqual(properties.get('db.packages'), 'blast@2.2.26,fasta@3.6')
+        self.assertEqual(properties.get('dir.version'), 'alu')
+        self.assertEqual(properties.get('keep.old.version'), '1')
+        self.assertIsNone(properties.get('db.notset'))
+        self.assertIs(PropertiesStore.get_bank_properties('alu'), properties)
+        self.assertTrue(os.path.isfile(os.path.join(self.utils.cache_dir, PropertiesStore.FILE)))
+
+    @attr('config')
+    @attr('config.properties')
+    def test_PropertiesStoreBankPropertiesFromDatabase(self):
+        """Check bank properties are read from the cache database on a new run"""
+        import sqlite3
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        PropertiesStore.get_bank_properties('alu')
+        connection = sqlite3.connect(os.path.join(self.utils.cache_dir, PropertiesStore.FILE))
+        with connection:
+            connection.execute("UPDATE properties SET properties = ? WHERE bank = ?",
+                               ('{"db.formats": "cached"}', 'alu'))
+        connection.close()
+        PropertiesStore.banks = {}
+        PropertiesStore.stored = None
+        self.assertEqual(PropertiesStore.get_bank_properties('alu').get('db.formats'), 'cached')
+
+    @attr('config')
+    @attr('config.properties')
+    def test_PropertiesStoreBankPropertiesReloadedOnChange(self):
+        """Check bank properties are parsed again when bank properties file changed"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        self.assertEqual(PropertiesStore.get_bank_properties('alu').get('db.formats'), 'fasta')
+        bank_file = os.path.join(self.utils.conf_dir, 'alu.properties')
+        with open(bank_file) as fin:
+            content = fin.read()
+        with open(bank_file, 'w') as fout:
+            fout.write(content.replace('db.formats=fasta', 'db.formats=fasta,blast'))
+        PropertiesStore.banks = {}
+        PropertiesStore.stored = None
+        self.assertEqual(PropertiesStore.get_bank_properties('alu').get('db.formats'), 'fasta,blast')
+
+    @attr('config')
+    @attr('config.properties')
+    def test_PropertiesStoreBankPropertiesEnvOverride(self):
+        """Check environment variables override bank properties"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        os.environ['BIOMAJ_DB_FORMATS'] = 'fromenv'
+        try:
+            self.assertEqual(PropertiesStore.get_bank_properties('alu').get('db.formats'), 'fromenv')
+        finally:
+            del os.environ['BIOMAJ_DB_FORMATS']
+
+    @attr('config')
+    @attr('config.properties')
+    def test_PropertiesStoreBankPropertiesNoFile(self):
+        """Check we get None for a bank without properties file"""
+        Manager()
+        self.assertIsNone(PropertiesStore.get_bank_properties('nobank'))
+
+    @attr('config')
+    @attr('config.properties')
+    def test_PropertiesStoreInvalidateOK(self):
+        """Check invalidating the cache parses bank properties again"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager()
+        properties = PropertiesStore.get_bank_properties('alu')
+        self.assertTrue(PropertiesStore.invalidate(bank='alu'))
+        self.assertIsNot(PropertiesStore.get_bank_properties('alu'), properties)
+        self.assertTrue(PropertiesStore.invalidate())
+        self.assertIsNone(PropertiesStore.stored)
+
+    @attr('config')
+    @attr('config.properties')
+    def test_PropertiesStoreManagerPackagesOK(self):
+        """Check manager reads bank packages and sections from the properties cache"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager()
+        manager.set_bank(bank=BankView('alu'))
+        self.assertIsInstance(manager.get_bank_properties(), BankProperties)
+        self.assertListEqual(manager.get_bank_packages(), ['pack@blast@2.2.26', 'pack@fasta@3.6'])
+        self.assertDictEqual(manager.get_bank_sections(tool='blast2'),
+                             {'nuc': {'dbs': ['alunuc'], 'sections': ['alunuc1', 'alunuc2']},
+                              'pro': {'dbs': ['alupro'], 'sections': ['alupro1', 'alupro2']}})
+        self.assertDictEqual(manager.formats(flat=True), {'blast': ['2.2.26'], 'fasta': ['3.6']})
+        self.assertIsNone(manager.bank._config)
+
+
+class TestBiomajManagerBankView(unittest.TestCase):
+    """Class for testing biomajmanager.bankview class"""
+
+    def setUp(self):
+        """Setup stuff"""
+        self.utils = UtilsForTests()
+        # Make our test global.properties set as env var
+        os.environ['BIOMAJ_CONF'] = self.utils.global_properties
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        manager = Manager(bank='alu')
+        manager.bank.banks.update({'name': 'alu'},
+                                  {'$set': {'current': 2, 'last_update_session': 3, 'pending': [],
+                                            'production': [{'session': 1, 'release': '54', 'prod_dir': 'alu_54'},
+                                                           {'session': 2, 'release': '55', 'prod_dir': 'alu_55'},
+                                                           {'session': 3, 'release': '56', 'prod_dir': 'alu_56'}],
+                                            'sessions': [{'id': 1, 'release': '54', 'workflow_status': True},
+                                                         {'id': 2, 'release': '55', 'workflow_status': True},
+                                                         {'id': 3, 'release': '56', 'workflow_status': True}]}})
+
+    def tearDown(self):
+        """Clean"""
+        self.utils.drop_db()
+        self.utils.clean()
+
+    @attr('bankview')
+    @attr('bankview.fetch')
+    def test_BankViewFetchOnlyRequestedFields(self):
+        """Check only requested fields are fetched"""
+        view = BankView('alu')
+        view.fetch(['current', 'production.session'])
+        self.assertTrue(view.is_fetched('current'))
+        self.assertFalse(view.is_fetched('sessions'))
+        self.assertListEqual(dict.__getitem__(view.bank, 'production'), [{'session': 1}, {'session': 2},
+                                                                        {'session': 3}])
+        self.assertFalse(view.is_loaded())
+
+    @attr('bankview')
+    @attr('bankview.fetch')
+    def test_BankViewFetchSliceThenFullField(self):
+        """Check a field fetched with a different projection is fetched completely"""
+        view = BankView('alu')
+        view.fetch([('production', {'$slice': -1})])
+        self.assertEqual(len(dict.__getitem__(view.bank, 'production')), 1)
+        self.assertEqual(dict.__getitem__(view.bank, 'production')[0]['session'], 3)
+        view.fetch(['production.session'])
+        self.assertEqual(len(view.bank['production']), 3)
+        self.assertEqual(view.bank['production'][0]['release'], '54')
+
+    @attr('bankview')
+    @attr('bankview.fetch')
+    def test_BankViewFetchUnknownBankThrows(self):
+        """Check fetching a bank not in database throws"""
+        view = BankView('notfound')
+        with self.assertRaises(SystemExit):
+            view.fetch(['current'])
+
+    @attr('bankview')
+    @attr('bankview.load')
+    def test_BankViewLazyLoadOnMissingField(self):
+        """Check accessing a field not fetched loads the complete document"""
+        view = BankView('alu')
+        view.fetch(['current'])
+        self.assertFalse(view.is_loaded())
+        self.assertEqual(len(view.bank['sessions']), 3)
+        self.assertTrue(view.is_loaded())
+
+    @attr('bankview')
+    @attr('bankview.fetch')
+    def test_BankViewSliceThenIndexFetchesCompleteField(self):
+        """Check a field fetched with $slice is not used to find other productions"""
+        manager = Manager()
+        manager.set_bank_from_name('alu', view=True)
+        self.assertEqual(manager.get_last_production_ok()['session'], 3)
+        self.assertEqual(manager.get_production_from_session(1)['release'], '54')
+        self.assertEqual(len(manager.bank.bank['production']), 3)
+        self.assertFalse(manager.bank.is_loaded())
+
+    @attr('bankview')
+    @attr('bankview.fetch')
+    def test_BankViewSubFieldThenOtherSubKeyFetchesCompleteField(self):
+        """Check sub fields fetched for a method are not read as complete by another one"""
+        view = BankView('alu', document={'sessions': [{'id': 1}, {'id': 2}, {'id': 3}]}, fields=['sessions.id'])
+        self.assertEqual(view.bank['sessions'][1]['release'], '55')
+        self.assertTrue(view.is_fetched('sessions', complete=True))
+        self.assertFalse(view.is_loaded())
+
+    @attr('bankview')
+    @attr('bankview.fetch')
+    def test_BankViewDeclaredSubFieldsNotFetchedAgain(self):
+        """Check sub fields declared by the running method are read as they are"""
+        view = BankView('alu', document={'sessions': [{'id': 1}]}, fields=['sessions.id'])
+        view.push_fields(['sessions.id'])
+        self.assertListEqual(view.bank['sessions'], [{'id': 1}])
+        view.pop_fields()
+        self.assertEqual(len(view.bank['sessions']), 3)
+
+    @attr('bankview')
+    @attr('bankview.getsession')
+    def test_BankViewGetSessionElemMatch(self):
+        """Check we get a single session without fetching all the sessions"""
+        view = BankView('alu')
+        self.assertEqual(view.get_session(2)['release'], '55')
+        self.assertIsNone(view.get_session(4))
+        self.assertFalse(view.is_fetched('sessions'))
+
+    @attr('bankview')
+    @attr('bankview.manager')
+    def test_BankViewManagerStatusOK(self):
+        """Check status methods give the same results with a bank view and a bank"""
+        bank = Manager(bank='alu')
+        view = Manager()
+        view.set_bank_from_name('alu', view=True)
+        self.assertEqual(view.current_release(), bank.current_release())
+        self.assertEqual(view.can_switch(), bank.can_switch())
+        self.assertEqual(view.get_pending_sessions(), bank.get_pending_sessions())
+        self.assertListEqual(view.check_production_size(max_release=1), bank.check_production_size(max_release=1))
+        self.assertDictEqual(view.get_last_production_ok(), bank.get_last_production_ok())
+        self.assertFalse(view.bank.is_loaded())
+
+
+class TestBiomajManagerFleet(unittest.TestCase):
+    """Class for testing biomajmanager.fleet class"""
+
+    def setUp(self):
+        """Setup stuff"""
+        self.utils = UtilsForTests()
+        # Make our test global.properties set as env var
+        os.environ['BIOMAJ_CONF'] = self.utils.global_properties
+
+    def tearDown(self):
+        """Clean"""
+        self.utils.clean()
+
+    @attr('fleet')
+    @attr('fleet.snapshot')
+    def test_FleetSnapshotWrongVisibilityThrows(self):
+        """Check snapshot throws with wrong visibility"""
+        with self.assertRaises(SystemExit):
+            FleetSnapshot(visibility="fake")
+
+    @attr('fleet')
+    @attr('fleet.snapshot')
+    def test_FleetSnapshotLoadsAllBanks(self):
+        """Check snapshot loads the same banks as get_bank_list, sorted by name"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        self.utils.copy_file(ofile='minium.properties', todir=self.utils.conf_dir)
+        Manager(bank='minium')
+        Manager(bank='alu')
+        snapshot = FleetSnapshot()
+        self.assertListEqual([bank.name for bank in snapshot], Manager.get_bank_list())
+        self.assertEqual(len(snapshot), 2)
+        self.assertTrue('alu' in snapshot)
+        self.utils.drop_db()
+
+    @attr('fleet')
+    @attr('fleet.snapshot')
+    def test_FleetSnapshotWithBanksAndFields(self):
+        """Check snapshot only loads requested banks and fields"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        self.utils.copy_file(ofile='minium.properties', todir=self.utils.conf_dir)
+        alu = Manager(bank='alu')
+        Manager(bank='minium')
+        alu.bank.banks.update({'name': 'alu'}, {'$set': {'sessions': [{'id': 1, 'release': '54',
+                                                                        'status': {'over': True}}]}})
+        snapshot = FleetSnapshot(banks=['alu', 'notfound'], fields=['name', 'sessions.id'])
+        self.assertListEqual(snapshot.get_names(), ['alu'])
+        self.assertIsNone(snapshot.get('notfound'))
+        self.assertListEqual(dict.__getitem__(snapshot.get('alu').bank, 'sessions'), [{'id': 1}])
+        self.utils.drop_db()
+
+    @attr('fleet')
+    @attr('fleet.banksnapshot')
+    def test_BankSnapshotReadOnlyView(self):
+        """Check the bank view gives the same info as the bank itself"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        alu = Manager(bank='alu')
+        alu.bank.banks.update({'name': 'alu'}, {'$set': {'production': [{'release': '54', 'prod_dir': 'alu_54',
+                                                                           'session': 1}]}})
+        view = FleetSnapshot(banks=['alu']).get('alu')
+        self.assertIsInstance(view, BankSnapshot)
+        self.assertEqual(view.config.get('db.fullname'), alu.bank.config.get('db.fullname'))
+        self.assertEqual(view.get_production('alu_54')['session'], 1)
+        self.assertIsNone(view.get_production('55'))
+        self.assertFalse(view.is_locked())
+        self.assertEqual(view.get_properties()['owner'], alu.bank.get_properties()['owner'])
+        self.utils.drop_db()
+
+    @attr('fleet')
+    @attr('fleet.banksnapshot')
+    def test_BankSnapshotHistoryNotLoaded(self):
+        """Check the history of a bank is built from the snapshot fields only"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        alu = Manager(bank='alu')
+        alu.bank.banks.update({'name': 'alu'},
+                              {'$set': {'current': 1,
+                                        'production': [{'release': '54', 'remoterelease': '54', 'session': 1}],
+                                        'sessions': [{'id': 1, 'release': '54', 'remoterelease': '54',
+                                                      'last_update_time': 1, 'status': {'over': True}},
+                                                     {'id': 0, 'release': '53', 'remoterelease': '53',
+                                                      'last_update_time': 0, 'deleted': 1}]}})
+        manager = Manager()
+        manager.set_bank(bank=FleetSnapshot(banks=['alu']).get('alu'))
+        history = manager.history()
+        self.assertListEqual([item['status'] for item in history], ['online', 'deleted'])
+        self.assertFalse(manager.bank.is_loaded())
+        self.utils.drop_db()
+
+    @attr('fleet')
+    @attr('fleet.banksnapshot')
+    def test_BankSnapshotPendingSessionsNoQuery(self):
+        """Check pending sessions last run are found from the snapshot fields, without querying the database"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        alu = Manager(bank='alu')
+        alu.bank.banks.update({'name': 'alu'},
+                              {'$set': {'pending': [{'release': '55', 'id': 2}, {'release': '56', 'id': 4}],
+                                        'sessions': [{'id': 1, 'release': '54', 'last_update_time': 10},
+                                                     {'id': 2, 'release': '55', 'last_update_time': 20}]}})
+        view = FleetSnapshot(banks=['alu'], fields=['name', 'pending', 'sessions.id',
+                                                    'sessions.last_update_time']).get('alu')
+        queries = []
+        find_one = view._find_one
+        view._find_one = lambda projection: queries.append(projection) or find_one(projection)
+        manager = Manager()
+        manager.set_bank(bank=view)
+        self.assertListEqual(manager.get_pending_sessions_last_run(),
+                             [{'release': '55', 'id': 2, 'last_update_time': 20},
+                              {'release': '56', 'id': 4, 'last_update_time': None}])
+        self.assertListEqual(queries, [])
+        self.utils.drop_db()
+
+    @attr('fleet')
+    @attr('fleet.banksnapshot')
+    def test_BankSnapshotSetBankOK(self):
+        """Check a manager accepts a bank view and uses it"""
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        Manager(bank='alu')
+        manager = Manager()
+        self.assertTrue(manager.set_bank(bank=FleetSnapshot(banks=['alu']).get('alu')))
+        self.assertListEqual(manager.formats(), ['blast@2.2.26', 'fasta@3.6'])
+        self.assertListEqual(manager.formats_available(banks=FleetSnapshot(banks=['alu'])), ['blast', 'fasta'])
+        self.utils.drop_db()
+
+
+class TestBiomajManagerCatalog(unittest.TestCase):
+    """Class for testing biomajmanager.catalog class"""
+
+    def setUp(self):
+        """Setup stuff"""
+        self.utils = UtilsForTests()
+        # Make our test global.properties set as env var
+        os.environ['BIOMAJ_CONF'] = self.utils.global_properties
+        self.utils.copy_file(ofile='alu.properties', todir=self.utils.conf_dir)
+        self.utils.copy_file(ofile='minium.properties', todir=self.utils.conf_dir)
+        Manager()
+
+    def tearDown(self):
+        """Clean"""
+        self.utils.clean()
+
+    @attr('catalog')
+    @attr('catalog.update')
+    def test_FormatCatalogBuildOK(self):
+        """Check the catalog is built from banks properties"""
+        catalog = FormatCatalog(banks=['alu', 'minium'])
+        self.assertEqual(len(catalog), 2)
+        self.assertDictEqual(catalog.get_formats('alu'), {'blast': ['2.2.26'], 'fasta': ['3.6']})
+        self.assertDictEqual(catalog.get_formats('minium'), {})
+        self.assertEqual(catalog.get_bank('alu')['raw'], 'fasta')
+        self.assertEqual(catalog.get_bank('alu')['fullname'], 'Alu : Select Alu repeats from REPBASE')
+        self.assertListEqual(catalog.get_tools(), ['blast', 'fasta'])
+        self.assertListEqual(catalog.get_tools(banks=['minium']), [])
+        self.assertListEqual([entry['name'] for entry in catalog.get_matrix()], ['alu', 'minium'])
+
+    @attr('catalog')
+    @attr('catalog.getbanks')
+    def test_FormatCatalogGetBanksOK(self):
+        """Check we get the banks providing a tool, at any or a specific version"""
+        catalog = FormatCatalog(banks=['alu', 'minium'])
+        self.assertListEqual(catalog.get_banks('blast'), ['alu'])
+        self.assertListEqual(catalog.get_banks('blast@2.2.26'), ['alu'])
+        self.assertListEqual(catalog.get_banks('blast', version='2.2.28'), [])
+        self.assertListEqual(catalog.get_banks('unknown'), [])
+        self.assertTrue(catalog.has_format('alu', 'fasta@3.6'))
+        self.assertFalse(catalog.has_format('minium', 'fasta'))
+
+    @attr('catalog')
+    @attr('catalog.update')
+    def test_FormatCatalogUpdateIncremental(self):
+        """Check only banks whose properties changed are rebuilt"""
+        catalog = FormatCatalog(banks=['alu', 'minium'])
+        self.assertEqual(catalog.update(['alu', 'minium']), 0)
+        bank_file = os.path.join(self.utils.conf_dir, 'alu.properties')
+        with open(bank_file) as fin:
+            content = fin.read()
+        with open(bank_file, 'w') as fout:
+            fout.write(content.replace('db.packages=blast@2.2.26,fasta@3.6', 'db.packages=blast@2.2.28'))
+        # Make sure the file stamp changes whatever the file system time resolution
+        os.utime(bank_file, (time.time() + 10, time.time() + 10))
+        self.assertEqual(catalog.update(['alu', 'minium']), 1)
+        self.assertListEqual(catalog.get_banks('blast@2.2.28'), ['alu'])
+        self.assertListEqual(catalog.get_banks('blast@2.2.26'), [])
+        self.assertListEqual(catalog.get_tools(), ['blast'])
+
+    @attr('catalog')
+    @attr('catalog.update')
+    def test_FormatCatalogUpdateNoPropertiesFile(self):
+        """Check a bank without properties file is not added"""
+        catalog = FormatCatalog(banks=['nobank'])
+        self.assertFalse('nobank' in catalog)
+        self.assertIsNone(catalog.get_bank('nobank'))
+
+    @attr('catalog')
+    @attr('catalog.remove')
+    def test_FormatCatalogRemoveOK(self):
+        """Check a bank removed from the catalog is removed from the index"""
+        catalog = FormatCatalog(banks=['alu'])
+        self.assertTrue(catalog.remove('alu'))
+        self.assertFalse(catalog.remove('alu'))
+        self.assertListEqual(catalog.get_banks('blast'), [])
+        self.assertDictEqual(catalog.tools, {})
+
+    @attr('catalog')
+    @attr('catalog.parsepackages')
+    def test_FormatCatalogParsePackagesOK(self):
+        """Check packages are split and empty ones ignored"""
+        self.assertListEqual(FormatCatalog.parse_packages('blast@2.2.26,\\\nfasta@3.6,'), ['blast@2.2.26', 'fasta@3.6'])
+        self.assertListEqual(FormatCatalog.parse_packages(None), [])
+
+    @attr('catalog')
+    @attr('catalog.manager')
+    def test_FormatCatalogManagerHasFormatsOK(self):
+        """Check manager checks bank formats using the catalog"""
+        manager = Manager()
+        manager.set_bank(bank=BankView('alu'))
+        self.assertTrue(manager.has_formats(fmt='blast'))
+        self.assertTrue(manager.has_formats(fmt='blast@2.2.26'))
+        self.assertFalse(manager.has_formats(fmt='blast@2.2.28'))
+        self.assertIs(manager.get_format_catalog(), manager.get_format_catalog(banks=['alu']))
+        self.assertTrue('alu' in manager.get_format_catalog())
+
+
+class TestBiomajManagerBioweb(unittest.TestCase):
+    """Class for testing the Bioweb plugin, using an in memory catalog collection"""
+
+    def setUp(self):
+        """Setup stuff"""
+        self.utils = UtilsForTests()
+        # Make our test global.properties set as env var
+        os.environ['BIOMAJ_CONF'] = self.utils.global_properties
+        self.bioweb = Bioweb()
+        self.bioweb.set_manager(Manager())
+        config = ConfigParser()
+        config.add_section(self.bioweb.get_name())
+        config.set(self.bioweb.get_name(), 'bioweb.mongo.bulk.size', '2')
+        self.bioweb.set_config(config)
+        self.bioweb.mongo_client = True
+
+    def tearDown(self):
+        """Clean"""
+        self.utils.clean()
+
+    def set_catalog(self, documents=None, errors=None):
+        """Set the catalog collection of the plugin"""
+        catalog = CollectionForTests(documents=documents, errors=errors)
+        self.bioweb.collections = {'catalog': catalog}
+        return catalog
+
+    @staticmethod
+    def get_operations(number):
+        """Get a list of catalog updates"""
+        return [UpdateOne({'_id': str(index)}, {'$set': {'_id': str(index), 'name': 'alu'}}, upsert=True)
+                for index in range(number)]
+
+    @attr('bioweb')
+    @attr('bioweb.bulk')
+    def test_BiowebGetBulkSize(self):
+        """Check the bulk size is read from the plugin section"""
+        self.assertEqual(self.bioweb.get_bulk_size(), 2)
+        self.bioweb.config.remove_option(self.bioweb.get_name(), 'bioweb.mongo.bulk.size')
+        self.assertEqual(self.bioweb.get_bulk_size(), Bioweb.BULK_SIZE)
+
+    @attr('bioweb')
+    @attr('bioweb.bulk')
+    def test_BiowebGetBulkSizeThrows(self):
+        """Check a bulk size which is not a positive integer throws"""
+        for size in ['0', 'many']:
+            self.bioweb.config.set(self.bioweb.get_name(), 'bioweb.mongo.bulk.size', size)
+            with self.assertRaises(SystemExit):
+                self.bioweb.get_bulk_size()
+
+    @attr('bioweb')
+    @attr('bioweb.bulk')
+    def test_BiowebBulkWriteExactMultiple(self):
+        """Check operations are sent with unordered bulk writes of bulk size"""
+        catalog = self.set_catalog()
+        self.assertTrue(self.bioweb._bulk_write('catalog', self.get_operations(4), bank='alu'))
+        self.assertListEqual(catalog.bulks, [{'size': 2, 'ordered': False}, {'size': 2, 'ordered': False}])
+        self.assertEqual(self.bioweb.doc_upserted, 4)
+
+    @attr('bioweb')
+    @attr('bioweb.bulk')
+    def test_BiowebBulkWriteRemainder(self):
+        """Check the last bulk write sends the remaining operations"""
+        catalog = self.set_catalog()
+        self.assertTrue(self.bioweb._bulk_write('catalog', self.get_operations(5), bank='alu'))
+        self.assertListEqual([bulk['size'] for bulk in catalog.bulks], [2, 2, 1])
+        self.assertEqual(len(catalog.documents), 5)
+
+    @attr('bioweb')
+    @attr('bioweb.bulk')
+    def test_BiowebBulkWritePartialErrorCounts(self):
+        """Check documents written by a failed bulk write are counted, and next bulk writes are sent"""
+        error = BulkWriteError({'nMatched': 1, 'nModified': 1, 'nUpserted': 0, 'upserted': [],
+                                'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'duplicate key'}]})
+        catalog = self.set_catalog(documents=[{'_id': '2', 'name': 'alu'}], errors=[error])
+        self.assertFalse(self.bioweb._bulk_write('catalog', self.get_operations(4), bank='alu'))
+        self.assertEqual(len(catalog.bulks), 2)
+        self.assertEqual(self.bioweb.doc_matched, 2)
+        self.assertEqual(self.bioweb.doc_modified, 2)
+        self.assertEqual(self.bioweb.doc_upserted, 1)
+
+    @attr('bioweb')
+    @attr('bioweb.bulk')
+    def test_BiowebBulkWriteConnectionErrorStops(self):
+        """Check a bulk write failing for another reason stops sending operations"""
+        catalog = self.set_catalog(errors=[PyMongoError("connection lost")])
+        self.assertFalse(self.bioweb._bulk_write('catalog', self.get_operations(4), bank='alu'))
+        self.assertEqual(len(catalog.bulks), 1)
+
+    @attr('bioweb')
+    @attr('bioweb.hash')
+    def test_BiowebDocumentHashStable(self):
+        """Check the document hash does not depend on keys order nor on the stored hash"""
+        document = {'_id': 'bank@alu@54', 'name': 'alu', 'version': '54', 'status': 'online'}
+        reordered = {'status': 'online', 'version': '54', 'name': 'alu', '_id': 'bank@alu@54'}
+        digest = Bioweb.get_document_hash(document)
+        self.assertEqual(Bioweb.get_document_hash(reordered), digest)
+        reordered[Bioweb.HASH_FIELD] = 'previous'
+        self.assertEqual(Bioweb.get_document_hash(reordered), digest)
+        reordered['status'] = 'deprecated'
+        self.assertNotEqual(Bioweb.get_document_hash(reordered), digest)
+
+    @attr('bioweb')
+    @attr('bioweb.incremental')
+    def test_BiowebIncrementalSendsChangedDocuments(self):
+        """Check unchanged documents are skipped, changed and new ones are sent"""
+        unchanged = {'_id': '1', 'name': 'alu', 'status': 'deprecated'}
+        changed = {'_id': '2', 'name': 'alu', 'status': 'online'}
+        stored = [dict(unchanged), dict(changed, status='unpublished')]
+        for doc in stored:
+            doc[Bioweb.HASH_FIELD] = Bioweb.get_document_hash(doc)
+        catalog = self.set_catalog(documents=stored)
+        new = {'_id': '3', 'name': 'alu', 'status': 'unpublished'}
+        history, removed = self.bioweb._get_changed_documents('alu', [unchanged, changed, new], incremental=True)
+        self.assertListEqual([item['_id'] for item in history], ['2', '3'])
+        self.assertEqual(history[0][Bioweb.HASH_FIELD], Bioweb.get_document_hash(changed))
+        self.assertEqual(removed, 0)
+        self.assertEqual(catalog.finds, 1)
+        history, _ = self.bioweb._get_changed_documents('alu', [unchanged, changed, new])
+        self.assertEqual(len(history), 3)
+
+    @attr('bioweb')
+    @attr('bioweb.incremental')
+    def test_BiowebIncrementalUnchangedBankWritesNothing(self):
+        """Check exporting again an unchanged bank sends nothing, the history documents are left untouched"""
+        catalog = self.set_catalog()
+        history = [{'_id': 'alu@54', 'name': 'alu', 'status': 'online'},
+                   {'_id': 'alu@55', 'name': 'alu', 'status': 'unpublished', Bioweb.HASH_FIELD: 'previous'}]
+        report = self.bioweb.export_fleet(iter([('alu', history)]), incremental=True)
+        self.assertEqual(report[0]['sent'], 2)
+        self.assertEqual(len(catalog.bulks), 1)
+        self.assertNotIn(Bioweb.HASH_FIELD, history[0])
+        self.assertEqual(history[1][Bioweb.HASH_FIELD], 'previous')
+        self.assertEqual(catalog.documents['alu@55'][Bioweb.HASH_FIELD], Bioweb.get_document_hash(history[1]))
+        report = self.bioweb.export_fleet(iter([('alu', history)]), incremental=True)
+        self.assertEqual(report[0]['sent'], 0)
+        self.assertEqual(len(catalog.bulks), 1)
+
+    @attr('bioweb')
+    @attr('bioweb.prune')
+    def test_BiowebPruneRemovesMissingDocuments(self):
+        """Check prune only removes the bank documents not in the history anymore"""
+        catalog = self.set_catalog(documents=[{'_id': '1', 'name': 'alu'}, {'_id': '2', 'name': 'alu'},
+                                              {'_id': '3', 'name': 'minium'}])
+        history, removed = self.bioweb._get_changed_documents('alu', [{'_id': '1', 'name': 'alu'}], prune=True)
+        self.assertEqual(removed, 1)
+        self.assertEqual(len(history), 1)
+        self.assertListEqual(sorted(catalog.documents), ['1', '3'])
+
+    @attr('bioweb')
+    @attr('bioweb.exportfleet')
+    def test_BiowebExportFleetOK(self):
+        """Check banks documents are sent with shared bulk writes and reported per bank"""
+        online = {'_id': 'alu@54', 'name': 'alu', 'status': 'online'}
+        stored = dict(online)
+        stored[Bioweb.HASH_FIELD] = Bioweb.get_document_hash(online)
+        catalog = self.set_catalog(documents=[stored, {'_id': 'alu@53', 'name': 'alu'},
+                                              {'_id': 'minium@1', 'name': 'minium'}])
+        histories = [('alu', [online, {'_id': 'alu@55', 'name': 'alu', 'status': 'unpublished'}]),
+                     ('minium', [{'_id': 'minium@1', 'name': 'minium', 'status': 'online'},
+                                 {'_id': 'minium@2', 'name': 'minium', 'status': 'unpublished'}])]
+        report = self.bioweb.export_fleet(iter(histories), incremental=True, prune=True)
+        self.assertListEqual([dict([(key, value) for key, value in item.items() if key != 'time'])
+                              for item in report],
+                             [{'bank': 'alu', 'documents': 2, 'sent': 1, 'removed': 1, 'errors': 0},
+                              {'bank': 'minium', 'documents': 2, 'sent': 2, 'removed': 0, 'errors': 0}])
+        # alu document is sent within the same bulk write as the first minium document
+        self.assertListEqual([bulk['size'] for bulk in catalog.bulks], [2, 1])
+        self.assertListEqual(sorted(catalog.documents), ['alu@54', 'alu@55', 'minium@1', 'minium@2'])
+        self.assertEqual(catalog.documents['minium@1']['status'], 'online')
+
+    @attr('bioweb')
+    @attr('bioweb.exportfleet')
+    def test_BiowebExportFleetErrorsPerBank(self):
+        """Check documents not updated by a shared bulk write are given to their bank, the last flush too"""
+        error = BulkWriteError({'nMatched': 0, 'nModified': 0, 'nUpserted': 1, 'upserted': [],
+                                'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'duplicate key'}]})
+        catalog = self.set_catalog(errors=[error, PyMongoError("connection lost")])
+        histories = [('alu', [{'_id': 'alu@54', 'name': 'alu'}]),
+                     ('minium', [{'_id': 'minium@1', 'name': 'minium'}, {'_id': 'minium@2', 'name': 'minium'}]),
+                     ('genbank', [])]
+        report = self.bioweb.export_fleet(iter(histories))
+        self.assertListEqual([bulk['size'] for bulk in catalog.bulks], [2, 1])
+        self.assertListEqual([(bank['bank'], bank['errors']) for bank in report],
+                             [('alu', 0), ('minium', 2), ('genbank', 0)])
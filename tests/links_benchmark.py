@@ -0,0 +1,91 @@
+"""
+Benchmark of link creation, path based calls against :class:`biomajmanager.links.LinkWriter`
+
+Creates a synthetic bank release of '--files' files spread into directories of '--per_dir' files, then links all of
+them into a production directory, once with path based calls (relative source computed for each file, link created
+from its complete path) and once with LinkWriter (relative source computed once per directory, links created
+relative to their open target directory).
+
+Usage: python tests/links_benchmark.py [--files 100000] [--per_dir 1000] [--hard]
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from biomajmanager.links import LinkWriter
+
+
+def create_tree(root, files, per_dir):
+    """Create the synthetic release, returns the list of (source file, link directory relative path)"""
+    entries = []
+    for index in range(files):
+        sub_dir = os.path.join('flat', 'part%04d' % (index // per_dir))
+        if index % per_dir == 0:
+            os.makedirs(os.path.join(root, sub_dir))
+        path = os.path.join(root, sub_dir, 'file%07d.dat' % index)
+        open(path, 'w').close()
+        entries.append((path, sub_dir))
+    return entries
+
+
+def make_targets(prod_dir, entries):
+    """Create the target directories, returns the list of (source file, link path, link directory)"""
+    links = []
+    for source, sub_dir in entries:
+        target_dir = os.path.join(prod_dir, sub_dir)
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        links.append((source, os.path.join(target_dir, os.path.basename(source)), target_dir))
+    return links
+
+
+def path_links(links, hard=False):
+    """Links created as done before LinkWriter"""
+    for source, target, target_dir in links:
+        if hard:
+            os.link(source, target)
+        else:
+            os.symlink(os.path.relpath(source, start=target_dir), target)
+
+
+def writer_links(links, hard=False):
+    """Links created with LinkWriter"""
+    with LinkWriter() as writer:
+        for source, target, target_dir in links:
+            writer.link(source if hard else writer.relative(source, target_dir), target, hard=hard)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark links creation")
+    parser.add_argument('--files', type=int, default=100000, help="Number of files to link")
+    parser.add_argument('--per_dir', type=int, default=1000, help="Number of files per directory")
+    parser.add_argument('--hard', action="store_true", default=False, help="Create hard links")
+    options = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='biomaj-manager_bench')
+    try:
+        # Deep enough production dir, like <root>/production/index/<tool>/<bank>
+        data_dir = os.path.join(root, 'data', 'bank', 'bank_1')
+        entries = create_tree(data_dir, options.files, options.per_dir)
+        print("%d files, %d per directory, %s links, dir_fd %s" %
+              (options.files, options.per_dir, 'hard' if options.hard else 'sym',
+               'supported' if LinkWriter.DIR_FD else 'not supported'))
+        timings = {}
+        for name, func in [('path', path_links), ('writer', writer_links)]:
+            prod_dir = os.path.join(root, 'production_' + name, 'index', 'tool', 'bank')
+            links = make_targets(prod_dir, entries)
+            start = time.time()
+            func(links, hard=options.hard)
+            timings[name] = time.time() - start
+            print("%-8s %f sec" % (name, timings[name]))
+        print("speedup  %.2fx" % (timings['path'] / timings['writer'] if timings['writer'] else 0))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,3 +28,6 @@ class anotherplugin(BMPlugin):
 
     def get_exception(self):
         return Exception()
+
+    def on_dispatch(self, value=None, sleep=0):
+        raise Exception("anotherplugin failed")
@@ -1,4 +1,5 @@
 from biomajmanager.plugins import BMPlugin
+import time
 
 
 class myplugin(BMPlugin):
@@ -28,3 +29,7 @@ class myplugin(BMPlugin):
 
     def get_exception(self):
         return Exception()
+
+    def on_dispatch(self, value=None, sleep=0):
+        time.sleep(sleep)
+        return value